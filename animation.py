@@ -0,0 +1,278 @@
+"""
+アニメーション出力
+
+アニメーション GIF / APNG の絵文字やアバターを含む画像を、フレームごとに合成して
+アニメーション画像にする（ANIMATED_OUTPUT=1 のときの魚拓・めいく）。
+
+- 元画像のフレームは一度だけデコードし、同じ内容のフレームは1枚にまとめる
+- 全アセットのフレームの切り替わり時刻を合わせたタイムラインを作り、出力のフレーム数と
+  ループの長さを上限で抑える。どのアセットも変わらない区間は1フレームにまとめる
+- 描画が時間の上限を超えたり、エンコード結果が送信サイズの上限を超えたりした場合は
+  None を返し、呼び出し側は静止画で出力する
+
+環境変数:
+    ANIMATION_MAX_FRAMES     出力するフレーム数の上限（既定 48）
+    ANIMATION_MAX_SECONDS    ループの長さの上限（秒、既定 6）
+    ANIMATION_TIME_BUDGET    フレームの描画にかけてよい時間（秒、既定 4）
+    ANIMATION_MAX_BYTES      出力サイズの上限（既定 8MB、Discord の 10MB 制限に余裕を持たせる）
+"""
+import bisect
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageChops
+
+import metrics
+from image_encoder import encode_animation
+from meme_store import AssetCache
+
+MAX_FRAMES = int(os.getenv('ANIMATION_MAX_FRAMES', '48'))
+MAX_MS = int(float(os.getenv('ANIMATION_MAX_SECONDS', '6')) * 1000)
+TIME_BUDGET = float(os.getenv('ANIMATION_TIME_BUDGET', '4'))
+MAX_BYTES = int(os.getenv('ANIMATION_MAX_BYTES', str(8 * 1024 * 1024)))
+
+# GIF の表示時間は 10ms 単位で、20ms 未満は多くのビューアで 100ms 扱いになる
+MIN_DELAY_MS = 20
+DEFAULT_DELAY_MS = 100
+
+
+def _delay(ms) -> int:
+    ms = int(ms or DEFAULT_DELAY_MS)
+    return max(MIN_DELAY_MS, (ms + 5) // 10 * 10)
+
+
+class Frames:
+    """
+    デコード済みのアニメーション
+
+    Args:
+        images: 重複を除いたフレーム（RGBA）
+        sequence: 再生順の (images のインデックス, 表示時間ミリ秒)
+    """
+
+    __slots__ = ('images', 'sequence', 'starts', 'total_ms')
+
+    def __init__(self, images, sequence):
+        self.images = images
+        self.sequence = sequence
+        self.starts = []
+        total = 0
+        for _, duration in sequence:
+            self.starts.append(total)
+            total += duration
+        self.total_ms = total
+
+    def index_at(self, t: int) -> int:
+        """時刻 t（ミリ秒、ループする）に表示されているフレームのインデックス"""
+        i = bisect.bisect_right(self.starts, t % self.total_ms) - 1
+        return self.sequence[i][0]
+
+
+_decoded = OrderedDict()  # (内容のキー, max_side) -> (Frames またはアニメーションでなければ None, バイト数)
+_decoded_bytes = 0
+_decoded_lock = threading.Lock()
+# デコード済みフレームのキャッシュ全体と、1つのアニメーションで持つフレームの上限（バイト）
+_DECODED_LIMIT = 128 * 1024 * 1024
+_FRAMES_LIMIT = 32 * 1024 * 1024
+
+
+def decode(data, max_side: int = None):
+    """
+    アニメーション画像をデコードする（静止画・読めないデータなら None）
+
+    同じ内容のフレームはまとめ、ループの長さやフレームの合計サイズの上限を超えた分は読まない。
+    結果は内容ごとにキャッシュする（同じ絵文字が何度出てきても一度だけデコードする）。
+
+    Args:
+        data: 画像の bytes
+        max_side: フレームをこの大きさ以下に縮小する（貼り付けるサイズに合わせてメモリを抑える）
+    """
+    global _decoded_bytes
+    if not isinstance(data, (bytes, bytearray)) or not data:
+        return None
+    key = (AssetCache.key_for(data), max_side)
+    with _decoded_lock:
+        if key in _decoded:
+            _decoded.move_to_end(key)
+            return _decoded[key][0]
+
+    frames = None
+    nbytes = 0
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            if getattr(im, 'is_animated', False):
+                images, sequence, seen = [], [], {}
+                total = 0
+                for i in range(getattr(im, 'n_frames', 1)):
+                    im.seek(i)
+                    frame = im.convert('RGBA')
+                    if max_side and max(frame.size) > max_side:
+                        frame.thumbnail((max_side, max_side), Image.LANCZOS)
+                    duration = _delay(im.info.get('duration'))
+                    raw = frame.tobytes()
+                    index = seen.get(raw)
+                    if index is None:
+                        if nbytes + len(raw) > _FRAMES_LIMIT:
+                            break
+                        index = seen[raw] = len(images)
+                        images.append(frame)
+                        nbytes += len(raw)
+                    if sequence and sequence[-1][0] == index:
+                        sequence[-1] = (index, sequence[-1][1] + duration)
+                    else:
+                        sequence.append((index, duration))
+                    total += duration
+                    if total >= MAX_MS:
+                        break
+                if len(images) > 1:
+                    frames = Frames(images, sequence)
+    except Exception as e:
+        print(f"アニメーションのデコードに失敗: {e}")
+        frames = None
+
+    with _decoded_lock:
+        if key not in _decoded:
+            _decoded[key] = (frames, nbytes)
+            _decoded_bytes += nbytes
+        while _decoded_bytes > _DECODED_LIMIT and len(_decoded) > 1:
+            _, (_, old_bytes) = _decoded.popitem(last=False)
+            _decoded_bytes -= old_bytes
+    return frames
+
+
+def plan(sources, max_frames: int = MAX_FRAMES, max_ms: int = MAX_MS):
+    """
+    複数のアニメーションをまとめて再生するタイムラインを作る
+
+    Args:
+        sources: Frames のリスト
+        max_frames: フレーム数の上限（超える場合は等間隔に間引く）
+        max_ms: ループの長さの上限
+
+    Returns:
+        list of (tuple, int): (sources ごとのフレームのインデックス, 表示時間ミリ秒)。
+        連続して同じ組み合わせになる区間は1つにまとめてある
+    """
+    loop = min(max(s.total_ms for s in sources), max_ms)
+    points = set()
+    for s in sources:
+        # 短いアニメーションはループさせて、切り替わり時刻を全体の長さまで並べる
+        for offset in range(0, loop, s.total_ms):
+            points.update(offset + start for start in s.starts if offset + start < loop)
+    times = sorted(points)
+    if len(times) > max_frames:
+        step = max(MIN_DELAY_MS, -(-loop // max_frames // 10) * 10)
+        times = list(range(0, loop, step))
+
+    entries = []
+    for i, t in enumerate(times):
+        end = times[i + 1] if i + 1 < len(times) else loop
+        indices = tuple(s.index_at(t) for s in sources)
+        if entries and (entries[-1][0] == indices or end - t < MIN_DELAY_MS):
+            # 変化がない区間と短すぎる区間は直前のフレームを延ばす
+            entries[-1][1] += end - t
+        else:
+            entries.append([indices, end - t])
+    return [(indices, duration) for indices, duration in entries]
+
+
+def animate(sources, render_frame, profile: str):
+    """
+    タイムラインに沿ってフレームを描画し、アニメーション画像にエンコードする
+
+    Args:
+        sources: Frames のリスト
+        render_frame: sources ごとのフレームのインデックスのタプルを受け取って PIL 画像を返す関数
+        profile: アニメーション用のエンコードプロファイル名
+
+    Returns:
+        EncodedImage。フレームが1枚しかない・時間やサイズの上限を超えた場合は None（静止画にする）
+    """
+    started = time.perf_counter()
+    timeline = plan(sources)
+    if len(timeline) <= 1:
+        return None
+
+    frames = []
+    for indices, duration in timeline:
+        if time.perf_counter() - started > TIME_BUDGET:
+            print(f"アニメーションの描画が {TIME_BUDGET:.1f} 秒を超えたため静止画にします（{len(frames)}/{len(timeline)} フレーム）")
+            metrics.observe('animation', time.perf_counter() - started, result='time_budget')
+            return None
+        img = render_frame(indices)
+        # 縮小などで見た目が同じになったフレームはまとめる
+        if frames and ImageChops.difference(frames[-1][0], img).getbbox() is None:
+            frames[-1][1] += duration
+            continue
+        frames.append([img, duration])
+    if len(frames) <= 1:
+        return None
+
+    encoded = encode_animation(frames, profile)
+    if encoded.size > MAX_BYTES:
+        print(f"アニメーションが {encoded.size / 1024 / 1024:.1f}MB になったため静止画にします（{len(frames)} フレーム）")
+        metrics.observe('animation', time.perf_counter() - started, result='size_budget')
+        return None
+    metrics.observe('animation', time.perf_counter() - started, result='ok')
+    return encoded
+
+
+class Placement:
+    """
+    描画済みの画像の上で、アニメーションするアセットを貼る位置
+
+    Args:
+        frames: アセットの Frames
+        origin: 貼り付ける左上の座標
+        size: 貼り付けるサイズ
+        mask: 貼り付けに使うマスク（None ならフレーム自身のアルファ）
+        under: 貼り付ける前のその範囲の画像（透過したフレームの下に敷く）
+    """
+
+    __slots__ = ('frames', 'origin', 'size', 'mask', 'under', '_patches')
+
+    def __init__(self, frames: Frames, origin, size, mask, under: Image.Image):
+        self.frames = frames
+        self.origin = origin
+        self.size = size
+        self.mask = mask
+        self.under = under
+        self._patches = {}
+
+    def moved(self, dx: int, dy: int) -> 'Placement':
+        x, y = self.origin
+        return Placement(self.frames, (x + dx, y + dy), self.size, self.mask, self.under)
+
+    def patch(self, index: int) -> Image.Image:
+        """index 番目のフレームを貼った範囲の画像（RGB、フレームごとにキャッシュ）"""
+        patch = self._patches.get(index)
+        if patch is None:
+            frame = self.frames.images[index].resize(self.size, Image.LANCZOS)
+            patch = self.under.copy()
+            patch.paste(frame, (0, 0), self.mask if self.mask is not None else frame)
+            patch = self._patches[index] = patch.convert('RGB')
+        return patch
+
+
+def animate_placements(base: Image.Image, placements, profile: str):
+    """
+    base の上の placements をアニメーションさせた画像をエンコードする（animate と同じく失敗時は None）
+
+    アセットごとに貼る範囲だけを差し替えるので、1フレームあたりの描画はコピーと貼り付けだけになる。
+    """
+    sources = []
+    for p in placements:
+        if p.frames not in sources:
+            sources.append(p.frames)
+    slots = [sources.index(p.frames) for p in placements]
+
+    def render_frame(indices):
+        img = base.copy()
+        for p, slot in zip(placements, slots):
+            img.paste(p.patch(indices[slot]), p.origin)
+        return img
+
+    return animate(sources, render_frame, profile)
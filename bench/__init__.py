@@ -0,0 +1,5 @@
+"""
+オフラインのベンチマーク
+
+リポジトリのルートから `python -m bench.render` / `python -m bench.inference` のように実行する。
+"""
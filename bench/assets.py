@@ -0,0 +1,85 @@
+"""
+ベンチマーク用の合成アセット
+
+アバター・カスタム絵文字（静止画/アニメーション）・サーバーバッジをその場で生成する。
+ネットワークや Discord の CDN には一切アクセスしない。乱数は固定シードで、毎回同じ画像になる。
+"""
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+
+def _png(img):
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def make_avatar(seed: int, size: int = 128) -> bytes:
+    """単色の背景に円と四角を重ねたアバター画像（PNG bytes）"""
+    rng = random.Random(seed)
+    bg = tuple(rng.randrange(40, 220) for _ in range(3))
+    img = Image.new('RGB', (size, size), bg)
+    draw = ImageDraw.Draw(img)
+    for _ in range(6):
+        color = tuple(rng.randrange(0, 256) for _ in range(3))
+        x0, y0 = rng.randrange(size), rng.randrange(size)
+        r = rng.randrange(size // 8, size // 3)
+        if rng.random() < 0.5:
+            draw.ellipse((x0 - r, y0 - r, x0 + r, y0 + r), fill=color)
+        else:
+            draw.rectangle((x0 - r, y0 - r, x0 + r, y0 + r), fill=color)
+    return _png(img)
+
+
+def make_photo_avatar(seed: int, size: int = 512) -> bytes:
+    """グラデーションとノイズを含む写真風のアバター（めいくの背景用、PNG bytes）"""
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient('L').resize((size, size))
+    noise = Image.effect_noise((size, size), 64)
+    r = Image.blend(gradient, noise, 0.3)
+    g = gradient.rotate(90)
+    b = Image.blend(gradient.rotate(180), noise, 0.5)
+    img = Image.merge('RGB', (r, g, b))
+    draw = ImageDraw.Draw(img)
+    for _ in range(4):
+        x0, y0 = rng.randrange(size), rng.randrange(size)
+        draw.ellipse((x0, y0, x0 + size // 4, y0 + size // 4), fill=tuple(rng.randrange(256) for _ in range(3)))
+    return _png(img)
+
+
+def make_emoji(seed: int, size: int = 48) -> bytes:
+    """透過 PNG のカスタム絵文字"""
+    rng = random.Random(seed)
+    img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    color = tuple(rng.randrange(0, 256) for _ in range(3)) + (255,)
+    draw.ellipse((2, 2, size - 2, size - 2), fill=color)
+    draw.ellipse((size // 4, size // 3, size // 4 + 6, size // 3 + 6), fill=(0, 0, 0, 255))
+    draw.ellipse((size * 3 // 4 - 6, size // 3, size * 3 // 4, size // 3 + 6), fill=(0, 0, 0, 255))
+    draw.arc((size // 4, size // 3, size * 3 // 4, size * 3 // 4), 20, 160, fill=(0, 0, 0, 255), width=3)
+    return _png(img)
+
+
+def make_animated_emoji(seed: int, size: int = 48, frames: int = 8) -> bytes:
+    """色が回転するアニメーション GIF の絵文字"""
+    rng = random.Random(seed)
+    base_hue = rng.random()
+    images = []
+    for i in range(frames):
+        hue = int(((base_hue + i / frames) % 1.0) * 255)
+        img = Image.new('HSV', (size, size), (hue, 200, 230)).convert('RGB')
+        ImageDraw.Draw(img).ellipse((size // 4, size // 4, size * 3 // 4, size * 3 // 4), fill=(255, 255, 255))
+        images.append(img)
+    buf = io.BytesIO()
+    images[0].save(buf, format='GIF', save_all=True, append_images=images[1:], duration=60, loop=0)
+    return buf.getvalue()
+
+
+def make_badge(seed: int, size: int = 32) -> bytes:
+    rng = random.Random(seed)
+    img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    color = tuple(rng.randrange(0, 256) for _ in range(3)) + (255,)
+    ImageDraw.Draw(img).rounded_rectangle((0, 0, size - 1, size - 1), radius=6, fill=color)
+    return _png(img)
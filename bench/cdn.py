@@ -0,0 +1,73 @@
+"""
+cdn.discordapp.com の代わりになるローカル aiohttp サーバー
+
+/emojis/<id>.<png|gif>、/avatars/<user_id>.png、/badges/<id>.png を bench.assets の合成画像で返す。
+画像は ID から決まるので何度取得しても同じ内容になる。latency を指定すると応答を遅らせる。
+
+bot.py は環境変数 DISCORD_CDN_BASE で CDN のベース URL を切り替えられる。
+"""
+import asyncio
+from functools import lru_cache
+
+from aiohttp import web
+
+from bench import assets
+
+
+@lru_cache(maxsize=4096)
+def _asset_bytes(kind, ident, ext):
+    seed = int(ident) % 100003
+    if kind == 'emojis':
+        return assets.make_animated_emoji(seed) if ext == 'gif' else assets.make_emoji(seed)
+    if kind == 'avatars':
+        return assets.make_avatar(seed)
+    return assets.make_badge(seed)
+
+
+class LocalCDN:
+    """
+    使い方:
+        cdn = LocalCDN(latency=0.02)
+        await cdn.start()
+        ... cdn.base_url ...
+        await cdn.stop()
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.requests = 0
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def _handle(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        kind = request.match_info['kind']
+        ident = request.match_info['ident']
+        ext = request.match_info['ext']
+        if kind not in ('emojis', 'avatars', 'badges') or not ident.isdigit():
+            raise web.HTTPNotFound()
+        content_type = 'image/gif' if ext == 'gif' else 'image/png'
+        return web.Response(body=_asset_bytes(kind, ident, ext), content_type=content_type)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(r'/{kind}/{ident}.{ext:png|gif}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # port=0 のときは OS が割り当てたポートを使う
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,74 @@
+"""
+ベンチマーク用の固定コーパス
+
+短い日本語・長い日本語・絵文字混じり・Markdown 多用のメッセージと、
+それらを組み合わせた 1〜50 件のメッセージスタックを決まった内容で生成する。
+"""
+import datetime
+
+from bench import assets
+
+SHORT_JA = "今日のお昼なに食べた？"
+
+LONG_JA = (
+    "昨日の夜、駅前の新しいラーメン屋に行ってみたんだけど、思っていたよりずっと並んでいて、"
+    "結局一時間くらい待つことになった。でもスープが本当に濃厚で、麺も細めのストレートで好みだったし、"
+    "チャーシューも分厚くて柔らかかったから、待った甲斐はあったと思う。今度は平日の昼に行ってみるつもり。"
+    "ちなみに隣の席の人が替え玉を三回頼んでいて、さすがにびっくりした。"
+)
+
+# カスタム絵文字トークン（<:name:id> と <a:name:id>）を含むメッセージ
+EMOJI_TOKENS = {
+    '<:smile:100000000000000001>': ('png', 1),
+    '<:cry:100000000000000002>': ('png', 2),
+    '<a:party:100000000000000003>': ('gif', 3),
+}
+EMOJI_MIX = (
+    "これ見て <:smile:100000000000000001> 最高すぎる <a:party:100000000000000003> "
+    "でも明日テストなんだよね <:cry:100000000000000002> 😭🎉✨ English words mixed in too"
+)
+
+MARKDOWN_HEAVY = (
+    "**太字のテキスト** と *斜体* と ***太字斜体*** と `inline code` と ~~取り消し線~~\n"
+    "__下線っぽい太字__ と _アンダースコア斜体_ を **混ぜて** *何度も* `使う` ~~テスト~~\n"
+    "最後の行は **長めの太字で折り返しが発生するくらいの文字数を入れておく。まだまだ続くよ。**"
+)
+
+CORPUS = {
+    'short_ja': SHORT_JA,
+    'long_ja': LONG_JA,
+    'emoji_mix': EMOJI_MIX,
+    'markdown_heavy': MARKDOWN_HEAVY,
+}
+
+STACK_SIZES = (1, 5, 10, 25, 50)
+
+_BASE_TIME = datetime.datetime(2025, 1, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+def emoji_images():
+    """EMOJI_TOKENS に対応する絵文字画像の dict（token -> bytes）"""
+    images = {}
+    for token, (kind, seed) in EMOJI_TOKENS.items():
+        images[token] = assets.make_animated_emoji(seed) if kind == 'gif' else assets.make_emoji(seed)
+    return images
+
+
+def message_item(index: int, text: str, with_avatar: bool = True) -> dict:
+    """render_messages_stack に渡す形式のメッセージ1件"""
+    return {
+        'author_name': f"ユーザー{index % 7}",
+        'content': text,
+        'avatar': assets.make_avatar(index % 7) if with_avatar else None,
+        'role_color': ['#e91e63', '#3498db', None, '#2ecc71'][index % 4],
+        'timestamp': _BASE_TIME + datetime.timedelta(minutes=index),
+        'emoji_images': emoji_images() if '<' in text else {},
+        'primary_guild': {'tag': 'TAKO', 'badge': assets.make_badge(index % 3), 'identity_enabled': True}
+        if with_avatar and index % 3 == 0 else None,
+    }
+
+
+def message_stack(size: int, with_avatar: bool = True) -> list:
+    """コーパスを順番に使った size 件のメッセージ"""
+    texts = list(CORPUS.values())
+    return [message_item(i, texts[i % len(texts)], with_avatar) for i in range(size)]
@@ -0,0 +1,211 @@
+"""
+Discord のメッセージ・チャンネル・メンバー・インタラクションの代用品
+
+bot.py のハンドラが参照する属性とメソッドだけを実装している。
+アバターとバッジの Asset.read() はローカル CDN（bench.cdn）から HTTP で取得するので、
+ダウンロードの待ち時間も含めて計測できる。送信された返信は channel.sent に記録する。
+"""
+import asyncio
+import datetime
+import itertools
+
+import aiohttp
+
+_ids = itertools.count(10 ** 17)
+
+
+def next_id():
+    return next(_ids)
+
+
+class FakeColour:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeRole:
+    def __init__(self, name, colour):
+        self.name = name
+        self.colour = FakeColour(colour)
+        self.color = self.colour
+
+
+class FakeAsset:
+    """discord.Asset の代用（read() で CDN から取得する）"""
+
+    def __init__(self, url):
+        self.url = url
+
+    async def read(self):
+        session = await _session()
+        async with session.get(self.url) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    def __bool__(self):
+        return True
+
+
+class FakePrimaryGuild:
+    def __init__(self, tag, badge):
+        self.tag = tag
+        self.badge = badge
+        self.identity_enabled = True
+
+
+class FakeUser:
+    def __init__(self, user_id, name, cdn_base, roles=(), tag=None):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.display_avatar = FakeAsset(f'{cdn_base}/avatars/{user_id}.png')
+        self.roles = list(roles)
+        self.top_role = self.roles[-1] if self.roles else None
+        self.display_color = self.top_role.colour if self.top_role else FakeColour(0)
+        self.primary_guild = FakePrimaryGuild(tag, FakeAsset(f'{cdn_base}/badges/{user_id % 7}.png')) if tag else None
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, guild_id, members, cache_ratio=1.0):
+        self.id = guild_id
+        self._members = {m.id: m for m in members}
+        # get_member でキャッシュから見つかる割合（残りは fetch_member で取得する）
+        self._cached = set(list(self._members)[:int(len(self._members) * cache_ratio)])
+        self.fetches = 0
+
+    def get_member(self, user_id):
+        return self._members.get(user_id) if user_id in self._cached else None
+
+    async def fetch_member(self, user_id):
+        self.fetches += 1
+        await asyncio.sleep(0)
+        return self._members[user_id]
+
+
+class FakeReference:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content, created_at=None, reference=None, message_id=None):
+        self.id = message_id or next_id()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.created_at = created_at or datetime.datetime.now(datetime.timezone.utc)
+        self.edited_at = None
+        self.reference = FakeReference(reference.id) if reference is not None else None
+        self.attachments = []
+
+    async def reply(self, content=None, *, file=None, files=None, view=None, **kwargs):
+        return await self.channel.send(content, file=file, files=files, view=view, reference=self)
+
+
+class FakeChannel:
+    """
+    メッセージ履歴を持つチャンネル
+
+    fetch_message / history は REST 呼び出しに見立てて rest_latency 秒待つ。
+    """
+
+    def __init__(self, guild, rest_latency=0.0):
+        self.id = next_id()
+        self.guild = guild
+        self.rest_latency = rest_latency
+        self.messages = []      # 古い順
+        self._by_id = {}
+        self.sent = []          # (返信先, 本文, ファイル名, バイト数, view)
+
+    def add_message(self, author, content, created_at=None):
+        msg = FakeMessage(self, author, content, created_at)
+        self.messages.append(msg)
+        self._by_id[msg.id] = msg
+        return msg
+
+    async def fetch_message(self, message_id):
+        if self.rest_latency:
+            await asyncio.sleep(self.rest_latency)
+        try:
+            return self._by_id[message_id]
+        except KeyError:
+            raise LookupError(f'Unknown Message {message_id}') from None
+
+    async def history(self, limit=100, before=None):
+        if self.rest_latency:
+            await asyncio.sleep(self.rest_latency)
+        count = 0
+        for msg in reversed(self.messages):
+            if before is not None and msg.created_at >= before:
+                continue
+            if limit is not None and count >= limit:
+                break
+            count += 1
+            yield msg
+
+    async def send(self, content=None, *, file=None, files=None, view=None, reference=None):
+        files = list(files or []) + ([file] if file is not None else [])
+        size = sum(len(f.fp.read()) for f in files)
+        filename = files[0].filename if files else None
+        self.sent.append((reference, content, filename, size, view))
+        return FakeMessage(self, None, content or '')
+
+
+class _FakeResponse:
+    def __init__(self):
+        self.deferred = False
+        self.messages = []
+
+    async def defer(self):
+        self.deferred = True
+
+    async def send_message(self, content=None, ephemeral=False, **kwargs):
+        self.messages.append(content)
+
+
+class _FakeFollowup:
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, ephemeral=False, **kwargs):
+        self._interaction.followups.append(content)
+
+
+class FakeInteraction:
+    """MemeEditView のボタン押下に渡すインタラクション"""
+
+    def __init__(self, user, channel):
+        self.user = user
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id if channel.guild is not None else None
+        self.response = _FakeResponse()
+        self.followup = _FakeFollowup(self)
+        self.followups = []
+        self.edits = []
+
+    async def edit_original_response(self, attachments=None, view=None, **kwargs):
+        for file in attachments or []:
+            self.edits.append((file.filename, len(file.fp.read())))
+
+
+_shared_session = None
+
+
+async def _session():
+    # Asset.read() 用の共有セッション（close_session で閉じる）
+    global _shared_session
+    if _shared_session is None or _shared_session.closed:
+        _shared_session = aiohttp.ClientSession()
+    return _shared_session
+
+
+async def close_session():
+    global _shared_session
+    if _shared_session is not None:
+        await _shared_session.close()
+        _shared_session = None
@@ -0,0 +1,135 @@
+"""
+ベンチマーク共通処理
+
+各ケースを warmup 回実行したあと iterations 回計測し、ops/sec・p50/p99・ピークメモリを求める。
+結果は JSON のベースラインに保存でき、次回以降はベースラインと比較して遅くなったケースを報告する。
+
+ピークメモリは Linux では /proc/self/clear_refs でピーク RSS (VmHWM) をリセットしてから測る。
+Pillow の画像バッファは tracemalloc では追えないため、RSS が使えない環境では tracemalloc の値で代用する。
+"""
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+
+def _read_vm_hwm_kb():
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # "5" を書き込むとピーク RSS がリセットされる（Linux 4.0 以降）
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class PeakMemory:
+    """with ブロック内のピークメモリ（MB）を測る"""
+
+    def __enter__(self):
+        gc.collect()
+        self.use_rss = _reset_peak_rss() and _read_vm_hwm_kb() is not None
+        if not self.use_rss:
+            tracemalloc.start()
+        self.peak_mb = 0.0
+        return self
+
+    def __exit__(self, *exc):
+        if self.use_rss:
+            self.peak_mb = _read_vm_hwm_kb() / 1024
+        else:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.peak_mb = peak / (1024 * 1024)
+        return False
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def run_case(func, iterations=20, warmup=2):
+    """func() を繰り返し実行して統計を返す（時間はミリ秒）"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    with PeakMemory() as mem:
+        for _ in range(iterations):
+            started = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - started)
+    samples.sort()
+    total = sum(samples)
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total else 0.0,
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'peak_mb': mem.peak_mb,
+        'peak_source': 'rss' if mem.use_rss else 'tracemalloc',
+    }
+
+
+def environment():
+    """ベースラインと一緒に保存する実行環境の情報"""
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def print_results(results, baseline=None, threshold=0.10):
+    """
+    結果を表で表示し、ベースラインより p50 が threshold 以上遅いケースの名前を返す
+    """
+    regressions = []
+    header = f"{'case':<40}{'ops/s':>10}{'p50[ms]':>10}{'p99[ms]':>10}{'peak[MB]':>10}"
+    if baseline:
+        header += f"{'vs base':>10}"
+    print(header)
+    for name, r in results.items():
+        line = f"{name:<40}{r['ops_per_sec']:>10.2f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['peak_mb']:>10.1f}"
+        base = (baseline or {}).get(name)
+        if base and base.get('p50_ms'):
+            change = r['p50_ms'] / base['p50_ms'] - 1
+            mark = ' !' if change > threshold else ''
+            line += f"{change * 100:>+9.1f}%{mark}"
+            if change > threshold:
+                regressions.append(name)
+        elif baseline:
+            line += f"{'new':>10}"
+        print(line)
+    return regressions
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('results')
+
+
+def save_baseline(path, results):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f"ベースラインを保存しました: {path}")
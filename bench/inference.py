@@ -0,0 +1,227 @@
+"""
+推論のベンチマークとゴールデンスコアの回帰チェック
+
+emotion.get_emotion_scores_batch と seiteki.sexual_scores_batch を、ローカルのテキストコーパスに対して
+バッチサイズ 1〜64 で実行し、スループット（texts/sec）・p50/p99・トークナイズと推論の内訳・ピーク RSS を表示する。
+
+ゴールデンスコアを保存しておくと、量子化・バッチ化・truncation の変更などでスコアがずれていないかを
+全バッチサイズの出力について確認できる（許容誤差 --tolerance を超えたら exit 1）。
+
+--offline を付けると HF_HUB_OFFLINE / MODEL_LOCAL_ONLY を設定し、キャッシュ済みの重みだけで動かす。
+
+使い方:
+    python -m bench.inference --offline --save-golden
+    python -m bench.inference --offline --batch-sizes 1,8,32 --baseline bench/inference_baseline.json
+    python -m bench.inference --corpus texts.txt --model emotion
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from bench import corpus
+from bench.harness import PeakMemory, load_baseline, print_results, run_case, save_baseline
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GOLDEN = os.path.join(BENCH_DIR, 'golden_scores.json')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'inference_baseline.json')
+DEFAULT_BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64)
+
+# 組み込みのコーパス（--corpus を指定しない場合）。長さと話題をばらけさせてある
+BUILTIN_TEXTS = [
+    corpus.SHORT_JA,
+    corpus.LONG_JA,
+    corpus.EMOJI_MIX,
+    corpus.MARKDOWN_HEAVY,
+    "やったー！合格した！！",
+    "なんでいつもこうなるの、本当に腹が立つ",
+    "明日の発表がこわくて眠れない",
+    "ありがとう、すごく助かったよ",
+    "えっ、それ本当？信じられない",
+    "別にどうでもいいけど",
+    "猫がかわいすぎて仕事にならない",
+    "やっと終わった…ほっとした",
+    "恥ずかしくて顔から火が出そう",
+    "あの映画、最後で泣いてしまった",
+    "ちょっと気持ち悪いかも",
+    "週末は温泉に行く予定！楽しみ",
+    "w",
+    "？",
+    "今日は特に何もなかった。",
+    "このコード、誰が書いたんだろう。コメントが一つもない",
+] * 4
+
+
+def load_texts(path=None):
+    if not path:
+        return list(BUILTIN_TEXTS)
+    with open(path, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class _Model:
+    """ベンチマーク対象のモデル1つ分"""
+
+    def __init__(self, name):
+        self.name = name
+        if name == 'emotion':
+            import emotion
+            self.module = emotion
+        else:
+            import seiteki
+            self.module = seiteki
+
+    def load(self):
+        self.module.preload()
+
+    def tokenizer(self):
+        if self.name == 'emotion':
+            return self.module.tokenizer
+        return self.module.classifier.tokenizer
+
+    def tokenize(self, texts):
+        return self.tokenizer()(texts, return_tensors='pt', padding=True, truncation=True, max_length=512)
+
+    def scores(self, texts):
+        """texts のスコアをリストで返す（emotion はラベルごとの dict、seiteki は生スコア）"""
+        if self.name == 'emotion':
+            return self.module.get_emotion_scores_batch(texts)
+        return self.module.sexual_scores_batch(texts)
+
+
+def _max_drift(expected, actual):
+    # スコアの最大絶対誤差（dict ならラベルごと）
+    drift = 0.0
+    for e, a in zip(expected, actual):
+        if isinstance(e, dict):
+            for label, value in e.items():
+                drift = max(drift, abs(value - a.get(label, float('inf'))))
+        else:
+            drift = max(drift, abs(e - a))
+    return drift
+
+
+def benchmark(model, texts, batch_sizes, iterations, warmup):
+    results = {}
+    outputs = {}
+    for size in batch_sizes:
+        batches = _chunks(texts, size)
+        state = {'i': 0}
+
+        def step():
+            batch = batches[state['i'] % len(batches)]
+            state['i'] += 1
+            model.scores(batch)
+
+        def tokenize_step():
+            batch = batches[state['i'] % len(batches)]
+            state['i'] += 1
+            model.tokenize(batch)
+
+        r = run_case(step, iterations=iterations, warmup=warmup)
+        tok = run_case(tokenize_step, iterations=iterations, warmup=0)
+        r['texts_per_sec'] = r['ops_per_sec'] * size
+        r['tokenize_p50_ms'] = tok['p50_ms']
+        r['forward_p50_ms'] = max(0.0, r['p50_ms'] - tok['p50_ms'])
+        results[f'{model.name}/batch{size:02d}'] = r
+
+        # 全テキストをこのバッチサイズで推論した結果（ゴールデンとの比較用）
+        outputs[size] = [score for batch in batches for score in model.scores(batch)]
+    return results, outputs
+
+
+def check_golden(golden, model_name, texts, outputs, tolerance):
+    entry = golden.get(model_name)
+    if entry is None:
+        print(f"{model_name}: ゴールデンスコアがありません（--save-golden で作成）")
+        return True
+    if entry['texts'] != texts:
+        print(f"{model_name}: コーパスがゴールデンスコア作成時と異なるため比較できません")
+        return False
+    ok = True
+    for size, scores in outputs.items():
+        drift = _max_drift(entry['scores'], scores)
+        status = 'OK' if drift <= tolerance else 'DRIFT'
+        print(f"{model_name}/batch{size:02d}: 最大誤差 {drift:.2e} {status}")
+        ok = ok and drift <= tolerance
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='推論のベンチマーク')
+    parser.add_argument('--model', choices=('emotion', 'seiteki', 'all'), default='all')
+    parser.add_argument('--corpus', help='1行1テキストのコーパスファイル（省略時は組み込みのコーパス）')
+    parser.add_argument('--batch-sizes', default=','.join(map(str, DEFAULT_BATCH_SIZES)),
+                        help='カンマ区切りのバッチサイズ（既定: 1,2,4,8,16,32,64）')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--offline', action='store_true', help='キャッシュ済みの重みだけを使う')
+    parser.add_argument('--golden', default=DEFAULT_GOLDEN, help='ゴールデンスコアの JSON')
+    parser.add_argument('--save-golden', action='store_true', help='バッチサイズ1の出力をゴールデンスコアとして保存する')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='ゴールデンスコアとの許容誤差')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    if args.offline:
+        # transformers / huggingface_hub の import より前に設定する
+        os.environ['HF_HUB_OFFLINE'] = '1'
+        os.environ['TRANSFORMERS_OFFLINE'] = '1'
+        os.environ['MODEL_LOCAL_ONLY'] = '1'
+
+    texts = load_texts(args.corpus)
+    batch_sizes = sorted({int(s) for s in args.batch_sizes.split(',') if s.strip()})
+    if args.save_golden and 1 not in batch_sizes:
+        batch_sizes.insert(0, 1)
+    names = ('emotion', 'seiteki') if args.model == 'all' else (args.model,)
+
+    golden = {}
+    if os.path.exists(args.golden):
+        with open(args.golden, encoding='utf-8') as f:
+            golden = json.load(f)
+
+    results = {}
+    golden_ok = True
+    for name in names:
+        model = _Model(name)
+        with PeakMemory() as mem:
+            started = time.perf_counter()
+            model.load()
+        print(f"{name}: 読み込み {time.perf_counter() - started:.1f} 秒, ピークメモリ {mem.peak_mb:.0f} MB", file=sys.stderr)
+
+        model_results, outputs = benchmark(model, texts, batch_sizes, args.iterations, args.warmup)
+        results.update(model_results)
+
+        if args.save_golden:
+            golden[name] = {'texts': texts, 'scores': outputs[1]}
+        else:
+            golden_ok = check_golden(golden, name, texts, outputs, args.tolerance) and golden_ok
+
+    print()
+    baseline = None if args.save_baseline else load_baseline(args.baseline)
+    regressions = print_results(results, baseline, args.threshold)
+    print()
+    print(f"{'case':<40}{'texts/s':>10}{'tok[ms]':>10}{'fwd[ms]':>10}")
+    for case, r in results.items():
+        print(f"{case:<40}{r['texts_per_sec']:>10.1f}{r['tokenize_p50_ms']:>10.2f}{r['forward_p50_ms']:>10.2f}")
+
+    if args.save_golden:
+        with open(args.golden, 'w', encoding='utf-8') as f:
+            json.dump(golden, f, ensure_ascii=False, indent=1)
+        print(f"ゴールデンスコアを保存しました: {args.golden}")
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+
+    if regressions or not golden_ok:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+描画パイプラインのベンチマーク
+
+Discord 風メッセージ（単体・1〜50件のスタック、アバター有無）、めいく画像、感情チャートを
+固定コーパスと合成アセットで描画し、ops/sec・p50/p99・ピークメモリを表示する。
+ネットワークにも Discord にも接続しない。
+
+使い方:
+    python -m bench.render
+    python -m bench.render --save-baseline                 # bench/baseline.json に保存
+    python -m bench.render --threshold 0.15 --filter stack  # ベースラインと比較（遅くなったら exit 1）
+    python -m bench.render --encode                          # エンコード込みで計測
+"""
+import argparse
+import os
+import sys
+
+from bench import assets, corpus
+from bench.harness import load_baseline, print_results, run_case, save_baseline
+from emotion import emotion_mapping
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# 感情チャートの元にする固定の推論結果（モデルが出力するラベルごと）。
+# 本番と同じく prepare_chart_scores で上位5つを選んでスケーリングし、日本語のラベル画像の経路を通す
+CHART_RAW_SCORES = dict(zip(emotion_mapping.values(), (0.41, 0.02, 0.12, 0.23, 0.05, 0.82, 0.55, 0.09, 0.03, 0.01)))
+
+
+def build_cases(encode=False):
+    """ケース名 -> 引数なしの関数 の dict を返す"""
+    from discord_renderer import (
+        render_discord_like_message,
+        render_discord_like_message_image,
+        render_messages_stack,
+        render_messages_stack_image,
+    )
+    from meme_generator import generate_meme_image, render_meme_image
+    from emotion_chart import prepare_chart_scores, render_emotion_chart, render_emotion_chart_image
+
+    message = render_discord_like_message if encode else render_discord_like_message_image
+    stack = render_messages_stack if encode else render_messages_stack_image
+    meme = generate_meme_image if encode else render_meme_image
+    chart = render_emotion_chart if encode else render_emotion_chart_image
+
+    cases = {}
+    for name, text in corpus.CORPUS.items():
+        item = corpus.message_item(0, text)
+        cases[f'message/{name}'] = lambda item=item: message(**item)
+
+    for size in corpus.STACK_SIZES:
+        for with_avatar in (True, False):
+            items = corpus.message_stack(size, with_avatar)
+            suffix = 'avatar' if with_avatar else 'noavatar'
+            cases[f'stack/{size:02d}/{suffix}'] = lambda items=items: stack(items, max_width=900)
+
+    avatar = assets.make_photo_avatar(1)
+    for name in ('short_ja', 'long_ja'):
+        text = corpus.CORPUS[name]
+        cases[f'meme/{name}'] = lambda text=text: meme(text=text, author_name='ベンチ', avatar_image=avatar)
+        cases[f'meme/{name}/rainbow'] = lambda text=text: meme(
+            text=text, author_name='ベンチ', avatar_image=avatar, rainbow_text=True)
+        cases[f'meme/{name}/rainbow_smooth'] = lambda text=text: meme(
+            text=text, author_name='ベンチ', avatar_image=avatar, rainbow_text=True, rainbow_smooth=True)
+    cases['meme/short_ja/noavatar'] = lambda: meme(text=corpus.SHORT_JA, author_name='ベンチ')
+
+    chart_scores = prepare_chart_scores(CHART_RAW_SCORES)
+    cases['chart/emotion'] = lambda: chart(chart_scores)
+    return cases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='描画パイプラインのベンチマーク')
+    parser.add_argument('--iterations', type=int, default=20, help='計測回数（既定: 20）')
+    parser.add_argument('--warmup', type=int, default=2, help='計測前の空回し回数（既定: 2）')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='ベースラインの JSON')
+    parser.add_argument('--save-baseline', action='store_true', help='結果をベースラインとして保存する')
+    parser.add_argument('--threshold', type=float, default=0.10, help='回帰とみなす p50 の悪化率（既定: 0.10）')
+    parser.add_argument('--filter', default='', help='ケース名にこの文字列を含むものだけ実行する')
+    parser.add_argument('--encode', action='store_true', help='PNG エンコードまで含めて計測する')
+    args = parser.parse_args(argv)
+
+    cases = build_cases(encode=args.encode)
+    results = {}
+    for name, func in cases.items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = run_case(func, iterations=args.iterations, warmup=args.warmup)
+        print(f"  {name}: p50 {results[name]['p50_ms']:.2f} ms", file=sys.stderr)
+
+    baseline = None if args.save_baseline else load_baseline(args.baseline)
+    regressions = print_results(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+    elif regressions:
+        print(f"\n{len(regressions)} 件のケースがベースラインより {args.threshold * 100:.0f}% 以上遅くなりました")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
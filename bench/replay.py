@@ -0,0 +1,254 @@
+"""
+エンドツーエンドの負荷試験
+
+偽の Discord オブジェクト（bench.fake_discord）とローカル CDN（bench.cdn）を使い、
+「きもち」「きもい」「魚拓」「めいく」のリプライと、めいく画像のボタン操作を指定したレートで
+bot.on_message / MemeEditView に流し込む。Discord には接続しない。
+
+スループット・コマンドごとの成功/混雑/エラー件数とレイテンシ・イベントループの遅延を表示する。
+「きもち」「きもい」はモデルが必要なので、既定の配分には含めていない（--mix で指定する）。
+
+使い方:
+    python -m bench.replay --events 2000 --rate 100
+    python -m bench.replay --mix kimochi=1,kimoi=1,gyotaku=2,meme=2,meme_edit=2 --offline
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import sys
+import time
+
+from bench import corpus
+from bench.harness import percentile
+
+DEFAULT_MIX = 'gyotaku=3,meme=2,meme_edit=2'
+EDIT_BUTTONS = ('🌈 虹色', '⚫️ 黒背景', '⚪️ 白背景', '🔄 左右反転', '📝 フォント')
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip():
+            mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class LoopLagMonitor:
+    """interval ごとに起床し、予定時刻からの遅れをイベントループの遅延として記録する"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class Replay:
+    def __init__(self, bot_module, channel, users, mix, seed=0):
+        self.bot = bot_module
+        self.channel = channel
+        self.users = users
+        self.mix = mix
+        self.rng = random.Random(seed)
+        self.views = []         # 送信済みのめいく画像の view（ボタン操作の対象）
+        self.results = {}       # command -> {'ok', 'busy', 'error', 'latencies'}
+        self.exceptions = []
+
+    def _record(self, command, outcome, seconds):
+        r = self.results.setdefault(command, {'ok': 0, 'busy': 0, 'error': 0, 'latencies': []})
+        r[outcome] += 1
+        r['latencies'].append(seconds)
+
+    def _classify(self, replies):
+        if not replies:
+            return 'error'
+        for _, content, filename, size, view in replies:
+            if filename and size:
+                if view is not None:
+                    self.views.append(view)
+                return 'ok'
+        # 混雑とレート制限のクールダウンは busy として数える
+        if any(content == self.bot.BUSY_MESSAGE or '秒ほどで使えます' in (content or '') for _, content, *_ in replies):
+            return 'busy'
+        return 'error'
+
+    def _command_text(self, command):
+        if command == 'gyotaku':
+            a = self.rng.randint(1, 5)
+            b = a + self.rng.choice((0, 0, 2, 5, 10))
+            return f'魚拓{a}-{b}' if b != a else f'魚拓{a}'
+        return {'kimochi': 'きもち', 'kimoi': 'きもい', 'meme': 'めいく'}[command]
+
+    async def _message_event(self, command):
+        from bench.fake_discord import FakeMessage
+        target = self.rng.choice(self.channel.messages[len(self.channel.messages) // 2:])
+        author = self.rng.choice(self.users)
+        msg = FakeMessage(self.channel, author, self._command_text(command), reference=target)
+        started = time.perf_counter()
+        try:
+            await self.bot.on_message(msg)
+            outcome = self._classify([s for s in self.channel.sent if s[0] is msg])
+        except Exception as e:
+            self.exceptions.append(repr(e))
+            outcome = 'error'
+        self._record(command, outcome, time.perf_counter() - started)
+
+    async def _edit_event(self):
+        from bench.fake_discord import FakeInteraction
+        if not self.views:
+            # 押せるボタンがまだ無いときはめいくを先に実行する
+            await self._message_event('meme')
+            return
+        view = self.rng.choice(self.views)
+        label = self.rng.choice(EDIT_BUTTONS)
+        interaction = FakeInteraction(self.rng.choice(self.users), self.channel)
+        started = time.perf_counter()
+        try:
+            button = next(item for item in view.children if getattr(item, 'label', None) == label)
+            await button.callback(interaction)
+            if interaction.edits:
+                outcome = 'ok'
+            elif self.bot.BUSY_MESSAGE in interaction.followups or interaction.response.messages:
+                outcome = 'busy'
+            else:
+                outcome = 'error'
+        except Exception as e:
+            self.exceptions.append(repr(e))
+            outcome = 'error'
+        self._record('meme_edit', outcome, time.perf_counter() - started)
+
+    def _pick(self):
+        names = list(self.mix)
+        return self.rng.choices(names, weights=[self.mix[n] for n in names])[0]
+
+    async def run(self, events, rate):
+        tasks = []
+        interval = 1.0 / rate if rate > 0 else 0.0
+        loop = asyncio.get_running_loop()
+        next_at = loop.time()
+        for _ in range(events):
+            command = self._pick()
+            coro = self._edit_event() if command == 'meme_edit' else self._message_event(command)
+            tasks.append(asyncio.create_task(coro))
+            next_at += interval
+            delay = next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await asyncio.gather(*tasks)
+
+
+def build_channel(users, history, rest_latency):
+    from bench.fake_discord import FakeChannel, FakeGuild
+    guild = FakeGuild(1, users, cache_ratio=0.8)
+    channel = FakeChannel(guild, rest_latency=rest_latency)
+    texts = list(corpus.CORPUS.values())
+    started = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    for i in range(history):
+        channel.add_message(users[i % len(users)], texts[i % len(texts)], started + datetime.timedelta(seconds=30 * i))
+    return channel
+
+
+def make_users(count, cdn_base):
+    from bench.fake_discord import FakeRole, FakeUser
+    users = []
+    for i in range(count):
+        roles = [FakeRole('member', 0), FakeRole(f'role{i % 5}', [0xe91e63, 0x3498db, 0, 0x2ecc71, 0xf1c40f][i % 5])]
+        users.append(FakeUser(1000 + i, f'ユーザー{i}', cdn_base, roles=roles, tag='TAKO' if i % 3 == 0 else None))
+    return users
+
+
+def report(replay, wall, lag):
+    total = sum(len(r['latencies']) for r in replay.results.values())
+    print(f"イベント {total} 件 / {wall:.1f} 秒 = {total / wall:.1f} events/s")
+    print()
+    print(f"{'command':<12}{'count':>8}{'ok':>8}{'busy':>8}{'error':>8}{'p50[ms]':>10}{'p99[ms]':>10}{'max[ms]':>10}")
+    for command, r in sorted(replay.results.items()):
+        lat = sorted(r['latencies'])
+        print(f"{command:<12}{len(lat):>8}{r['ok']:>8}{r['busy']:>8}{r['error']:>8}"
+              f"{percentile(lat, 0.5) * 1000:>10.1f}{percentile(lat, 0.99) * 1000:>10.1f}{lat[-1] * 1000:>10.1f}")
+    samples = sorted(lag.samples)
+    if samples:
+        print()
+        print(f"イベントループ遅延: p50 {percentile(samples, 0.5) * 1000:.1f} ms, "
+              f"p99 {percentile(samples, 0.99) * 1000:.1f} ms, max {samples[-1] * 1000:.1f} ms "
+              f"({len(samples)} サンプル)")
+    errors = sum(r['error'] for r in replay.results.values())
+    print(f"エラー率: {errors / total * 100 if total else 0:.2f}%")
+    for e in sorted(set(replay.exceptions))[:10]:
+        print(f"  {e}")
+
+
+async def amain(args):
+    from bench.cdn import LocalCDN
+    cdn = await LocalCDN(latency=args.cdn_latency).start()
+    # bot.py は import 時に環境変数を読むので、CDN を起動してから import する
+    os.environ['DISCORD_CDN_BASE'] = cdn.base_url
+    os.environ.setdefault('WARMUP', '0')
+    # 少数の合成ユーザーから大量に送るので、既定ではレート制限を外して処理能力を測る
+    if not args.rate_limit:
+        os.environ['RATE_LIMIT'] = '0'
+    import bot
+    from bench.fake_discord import close_session
+
+    users = make_users(args.users, cdn.base_url)
+    channel = build_channel(users, args.history, args.rest_latency)
+    replay = Replay(bot, channel, users, parse_mix(args.mix), seed=args.seed)
+
+    lag = LoopLagMonitor()
+    lag.start()
+    started = time.perf_counter()
+    try:
+        await replay.run(args.events, args.rate)
+    finally:
+        wall = time.perf_counter() - started
+        await lag.stop()
+        await close_session()
+        await cdn.stop()
+    report(replay, wall, lag)
+    print(f"CDN リクエスト: {cdn.requests}, fetch_member: {channel.guild.fetches}")
+    errors = sum(r['error'] for r in replay.results.values())
+    return 1 if errors > args.max_errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='エンドツーエンドの負荷試験')
+    parser.add_argument('--events', type=int, default=500, help='流し込むイベント数')
+    parser.add_argument('--rate', type=float, default=50.0, help='1秒あたりのイベント数（0 なら一度に投入）')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'コマンドの配分（既定: {DEFAULT_MIX}）')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--history', type=int, default=200, help='チャンネルに用意するメッセージ数')
+    parser.add_argument('--cdn-latency', type=float, default=0.02, help='CDN の応答遅延（秒）')
+    parser.add_argument('--rest-latency', type=float, default=0.05, help='fetch_message/history の遅延（秒）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-errors', type=int, default=0, help='これを超えるエラーがあれば exit 1')
+    parser.add_argument('--offline', action='store_true', help='キャッシュ済みのモデルだけを使う')
+    parser.add_argument('--rate-limit', action='store_true', help='ボットのレート制限を有効にしたまま流す')
+    args = parser.parse_args(argv)
+    if args.offline:
+        os.environ['HF_HUB_OFFLINE'] = '1'
+        os.environ['TRANSFORMERS_OFFLINE'] = '1'
+        os.environ['MODEL_LOCAL_ONLY'] = '1'
+    return asyncio.run(amain(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
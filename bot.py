@@ -1,759 +1,946 @@
+import time
+_BOOT_STARTED = time.perf_counter()
+
 import discord
 from discord.ext import commands
-import matplotlib.pyplot as plt
-import numpy as np
+import asyncio
 import io
 import traceback
-import random
 import os
 from dotenv import load_dotenv
-from emotion import get_emotion_scores
-from seiteki import classify_sexual_content  # seiteki.pyから関数をインポート
-from discord_renderer import render_discord_like_message, render_messages_stack
-from meme_generator import generate_meme_image
-import re
-import aiohttp
-import matplotlib as mpl
-from matplotlib.colors import LinearSegmentedColormap
-import matplotlib.font_manager as fm
-from collections import defaultdict
 
 # 環境変数から設定を読み込む
+# 以下のモジュールには import 時に設定を読むものがあるので、それより先に .env を読み込む
 load_dotenv()  # .env ファイルを読み込む
 
+# emotion / seiteki はモデルを初回利用時に読み込む（起動後はバックグラウンドでウォームアップ）
+# INFERENCE_SOCKET が指定されていれば推論デーモンに問い合わせ、使えなければこのプロセスで推論する
+import emotion
+import seiteki
+import inference_client
+from inference_client import get_emotion_scores, classify_sexual_content
+from meme_store import AssetCache, MemeSettingsStore, MEME_VIEW_TIMEOUT
+from render_queue import RenderScheduler, SchedulerBusy
+from render_pool import asset_ref, create_render_backend
+from tile_cache import author_state, tile_key
+from message_cache import HistoryCache
+from rate_limit import RateLimiter, command_cost, cooldown_message
+from single_flight import SingleFlight, edited_marker
+from result_cache import ResultUrlCache
+from image_encoder import encoder_stats, profile_for
+import kimoi_images
+from kimoi_images import open_kimoi_image
+import metrics
+import loop_monitor
+import sampling_profiler
+import re
+import aiohttp
+
 # Discordボットの設定
 intents = discord.Intents.default()
 intents.message_content = True
 intents.messages = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# SHARD_COUNT が指定されていればシャード分割モード（launcher.py が SHARD_IDS を割り当てて起動する）
+# auto（.env の launcher 用の既定値）のまま直接起動した場合は、Discord の推奨数で全シャードをこのプロセスで動かす
+SHARD_COUNT = os.getenv('SHARD_COUNT')
+if SHARD_COUNT:
+    if SHARD_COUNT == 'auto':
+        shard_count, SHARD_IDS = None, None
+    else:
+        shard_count = int(SHARD_COUNT)
+        SHARD_IDS = [int(x) for x in os.getenv('SHARD_IDS', '').split(',') if x.strip()] or None
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_count=shard_count, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
+
+# めいく画像の設定ストア（メッセージIDをキーとする）
+# アバター画像は asset_cache に共有して保持し、TTL とエントリ数上限で自動的に破棄する
+asset_cache = AssetCache(max_bytes=int(os.getenv('MEME_ASSET_CACHE_BYTES', str(32 * 1024 * 1024))))
+meme_settings = MemeSettingsStore(
+    asset_cache,
+    ttl=MEME_VIEW_TIMEOUT,
+    max_entries=int(os.getenv('MEME_SETTINGS_MAX', '2000')),
+)
+
+# 画像生成ジョブのスケジューラ（優先度つきキュー、混雑時は SchedulerBusy）
+# 描画バックエンド（RENDER_PROCESSES>0 ならプロセスプール）
+render_backend = create_render_backend()
+
+# ワーカースレッドはジョブの完了を待つので、プロセスプールより少ないとプロセスが余る
+render_scheduler = RenderScheduler(
+    workers=max(int(os.getenv('RENDER_WORKERS', '2')), getattr(render_backend, 'processes', 0)),
+    max_queue=int(os.getenv('RENDER_MAX_QUEUE', '32')),
+    per_guild=int(os.getenv('RENDER_PER_GUILD', '6')),
+    per_user=int(os.getenv('RENDER_PER_USER', '2')),
+)
+BUSY_MESSAGE = "混み合っています。少し待ってからもう一度試してください。"
+EDIT_PENDING_MESSAGE = "前の変更を反映しています。画像が更新されてからもう一度押してください。"
+MEME_EXPIRED_MESSAGE = "この画像の編集は期限が切れました。もう一度「めいく」してください。"
+
+# カスタム絵文字を取得する CDN（負荷試験ではローカルのサーバーに向ける）
+DISCORD_CDN_BASE = os.getenv('DISCORD_CDN_BASE', 'https://cdn.discordapp.com').rstrip('/')
+
+# 同じメッセージへの同時リクエストをまとめる
+single_flight = SingleFlight()
+
+# 送信済み画像の URL（同じ結果は再アップロードせずに URL で返す）
+result_urls = ResultUrlCache(max_entries=int(os.getenv('RESULT_URL_CACHE_MAX', '2000')))
+
+# コマンドのレート制限（ユーザー・チャンネル・ギルドごとのトークンバケット）
+rate_limiter = RateLimiter.from_env()
+
+# 魚拓画像の最大幅（タイルキャッシュのキーにも使う）
+GYOTAKU_MAX_WIDTH = 900
+# 魚拓で遡れる件数・1回でまとめる件数・1枚の画像に入れる件数
+GYOTAKU_MAX_DEPTH = int(os.getenv('GYOTAKU_MAX_DEPTH', '100'))
+GYOTAKU_MAX_MESSAGES = int(os.getenv('GYOTAKU_MAX_MESSAGES', '50'))
+GYOTAKU_PAGE_SIZE = int(os.getenv('GYOTAKU_PAGE_SIZE', '10'))
+
+# ANIMATED_OUTPUT=1 なら魚拓・めいくでアニメーションする絵文字・アバターを動かした画像にする
+# （プロファイルは IMAGE_PROFILE_ANIMATED で変更できる。上限は animation.py を参照）
+ANIMATED_PROFILE = profile_for('animated') if os.getenv('ANIMATED_OUTPUT') == '1' else None
+
+# 魚拓用のメッセージ履歴キャッシュ
+history_cache = HistoryCache(ttl=int(os.getenv('HISTORY_CACHE_TTL', '120')))
+
+
+def _guild_key(guild):
+    return {'guild_id': guild.id if guild is not None else None}
+
+
+def _job_owner(message):
+    """スケジューラの同時実行上限に使うギルドID/ユーザーIDを返す"""
+    return {
+        'guild_id': message.guild.id if message.guild is not None else None,
+        'user_id': message.author.id,
+    }
+
+
+def _asset_key(asset):
+    """discord.Asset の内容を表すキー（ハッシュが無ければ URL）"""
+    if asset is None:
+        return None
+    return getattr(asset, 'key', None) or getattr(asset, 'url', None)
+
+
+def _may_animate(avatar_asset, text):
+    """アバターかカスタム絵文字がアニメーションしているか（アニメーションで出力するときに使う）"""
+    if '<a:' in text:
+        return True
+    is_animated = getattr(avatar_asset, 'is_animated', None)
+    return bool(is_animated and is_animated())
+
+
+def render_kimochi(text):
+    """感情分析からグラフ画像までを行う（スコアが無ければ None）"""
+    # matplotlib を含むので起動時には読み込まない
+    from emotion_chart import prepare_chart_scores
+    scores = prepare_chart_scores(get_emotion_scores(text))
+    if scores is None:
+        return None
+    return render_backend.render('chart', {'scores': scores}, profile=profile_for('kimochi'))
+
+
+def render_gyotaku_pages(pages, assets, profile):
+    """魚拓のページ（メッセージのリスト）ごとに画像を生成する"""
+    return [
+        render_backend.render('stack', {'items': page, 'options': {'max_width': GYOTAKU_MAX_WIDTH, 'animate': ANIMATED_PROFILE}}, assets, profile)
+        for page in pages
+    ]
+
+
+def render_meme(settings, avatar, command='meme'):
+    """めいく設定から画像を生成する"""
+    assets = {}
+    payload = {
+        'text': settings['text'],
+        'bg_color': settings['bg_color'],
+        'rainbow_text': settings['rainbow_text'],
+        'swap_layout': settings['swap_layout'],
+        'author_name': settings['author_name'],
+        'font_name': settings['font_name'],
+        'avatar_image': asset_ref(assets, avatar),
+        'animate': ANIMATED_PROFILE,
+    }
+    return render_backend.render('meme', payload, assets, profile=profile_for(command))
 
-# 画像設定を保存する辞書（メッセージIDをキーとする）
-meme_settings = {}
+
+# メトリクスのエクスポート時に一緒に出力する値
+metrics.register_collector('scheduler', render_scheduler.metrics)
+metrics.register_collector('encoder', encoder_stats)
+metrics.register_collector('meme_settings', lambda: {'entries': len(meme_settings), **asset_cache.stats()})
+metrics.register_collector('history', history_cache.stats)
+metrics.register_collector('rate_limit', rate_limiter.stats)
+metrics.register_collector('single_flight', single_flight.stats)
+metrics.register_collector('result_urls', result_urls.stats)
 
 
 # ボタンのViewクラス
 class MemeEditView(discord.ui.View):
     def __init__(self, settings: dict):
-        super().__init__(timeout=300)  # 5分でタイムアウト
-        self.settings = settings.copy()
+        super().__init__(timeout=MEME_VIEW_TIMEOUT)  # 5分でタイムアウト
+        # 設定 dict はストアと共有する（コピーするとアバター参照が二重管理になる）
+        self.settings = settings
+        self.message_id = None
+        # 再生成のジョブがスケジューラにある間は True
+        self._pending = False
+
+    async def on_timeout(self):
+        if self.message_id is not None:
+            meme_settings.discard(self.message_id)
+
+    async def _rerender(self, interaction: discord.Interaction, change):
+        with metrics.timed('command', command='meme_edit'):
+            await self._regenerate(interaction, change)
+
+    async def _regenerate(self, interaction: discord.Interaction, change):
+        """
+        設定を変更して画像を作り直す
+
+        Args:
+            change: 現在の設定を受け取り、変更する項目の dict を返す関数
+        """
+        # ストアにあればアクセスして有効期限を延長する
+        if self.message_id is not None:
+            settings = meme_settings.get(self.message_id)
+            if settings is None:
+                # 件数の上限などで設定が破棄されている（アバターの参照も解放済みなので作り直せない）
+                await interaction.response.send_message(MEME_EXPIRED_MESSAGE, ephemeral=True)
+                self.stop()
+                try:
+                    await interaction.message.edit(view=None)
+                except discord.HTTPException:
+                    pass
+                return
+            self.settings = settings
 
-    @discord.ui.button(label="🌈 虹色", style=discord.ButtonStyle.primary)
-    async def rainbow_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        # 虹色トグル
-        self.settings['rainbow_text'] = not self.settings['rainbow_text']
-
-        # 画像を再生成
-        img_buf = generate_meme_image(
-            text=self.settings['text'],
-            bg_color=self.settings['bg_color'],
-            rainbow_text=self.settings['rainbow_text'],
-            swap_layout=self.settings['swap_layout'],
-            author_name=self.settings['author_name'],
-            font_name=self.settings['font_name'],
-            avatar_image=self.settings.get('avatar_image')
+        # 前の再生成が終わるまでは次の操作を受け付けない（その変更はまだ設定に入っていないので、
+        # ここで受け付けると古い設定から変更を計算してしまう）
+        if self._pending:
+            await interaction.response.send_message(EDIT_PENDING_MESSAGE, ephemeral=True)
+            return
+
+        decision = rate_limiter.check(
+            'meme_edit', command_cost('meme_edit'),
+            user_id=interaction.user.id, channel_id=interaction.channel_id, **_guild_key(interaction.guild),
         )
+        if not decision.allowed:
+            await interaction.response.send_message(cooldown_message(decision), ephemeral=True)
+            return
+
+        # 変更は画像ができるまで設定に書き込まない（断られた操作で表示中の画像と設定がずれないように）
+        updates = change(self.settings)
+        settings = {**self.settings, **updates}
+
+        # ボタン操作は3秒以内に応答する必要があるので先に defer してから再生成する
+        self._pending = True
+        try:
+            await interaction.response.defer()
+            encoded = await render_scheduler.submit(
+                'meme_edit',
+                render_meme,
+                settings,
+                meme_settings.avatar_for(settings),
+                'meme_edit',
+                guild_id=interaction.guild_id,
+                user_id=interaction.user.id,
+            )
+        except SchedulerBusy:
+            await interaction.followup.send(BUSY_MESSAGE, ephemeral=True)
+            return
+        finally:
+            self._pending = False
+        self.settings.update(updates)
 
         # メッセージを更新
-        file = discord.File(img_buf, filename='meme.png')
-        await interaction.response.edit_message(attachments=[file], view=self)
+        file = discord.File(encoded.buffer, filename=encoded.filename('meme'))
+        with metrics.timed('upload', command='meme_edit'):
+            await interaction.edit_original_response(attachments=[file], view=self)
+
+    @discord.ui.button(label="🌈 虹色", style=discord.ButtonStyle.primary)
+    async def rainbow_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        # 虹色トグル
+        await self._rerender(interaction, lambda s: {'rainbow_text': not s['rainbow_text']})
 
     @discord.ui.button(label="⚫️ 黒背景", style=discord.ButtonStyle.secondary)
     async def black_bg_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         # 背景色を黒に
-        self.settings['bg_color'] = 'black'
-
-        # 画像を再生成
-        img_buf = generate_meme_image(
-            text=self.settings['text'],
-            bg_color=self.settings['bg_color'],
-            rainbow_text=self.settings['rainbow_text'],
-            swap_layout=self.settings['swap_layout'],
-            author_name=self.settings['author_name'],
-            font_name=self.settings['font_name'],
-            avatar_image=self.settings.get('avatar_image')
-        )
-
-        # メッセージを更新
-        file = discord.File(img_buf, filename='meme.png')
-        await interaction.response.edit_message(attachments=[file], view=self)
+        await self._rerender(interaction, lambda s: {'bg_color': 'black'})
 
     @discord.ui.button(label="⚪️ 白背景", style=discord.ButtonStyle.secondary)
     async def white_bg_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         # 背景色を白に
-        self.settings['bg_color'] = 'white'
-
-        # 画像を再生成
-        img_buf = generate_meme_image(
-            text=self.settings['text'],
-            bg_color=self.settings['bg_color'],
-            rainbow_text=self.settings['rainbow_text'],
-            swap_layout=self.settings['swap_layout'],
-            author_name=self.settings['author_name'],
-            font_name=self.settings['font_name'],
-            avatar_image=self.settings.get('avatar_image')
-        )
-
-        # メッセージを更新
-        file = discord.File(img_buf, filename='meme.png')
-        await interaction.response.edit_message(attachments=[file], view=self)
+        await self._rerender(interaction, lambda s: {'bg_color': 'white'})
 
     @discord.ui.button(label="🔄 左右反転", style=discord.ButtonStyle.secondary)
     async def swap_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         # レイアウトを反転
-        self.settings['swap_layout'] = not self.settings['swap_layout']
-
-        # 画像を再生成
-        img_buf = generate_meme_image(
-            text=self.settings['text'],
-            bg_color=self.settings['bg_color'],
-            rainbow_text=self.settings['rainbow_text'],
-            swap_layout=self.settings['swap_layout'],
-            author_name=self.settings['author_name'],
-            font_name=self.settings['font_name'],
-            avatar_image=self.settings.get('avatar_image')
-        )
-
-        # メッセージを更新
-        file = discord.File(img_buf, filename='meme.png')
-        await interaction.response.edit_message(attachments=[file], view=self)
+        await self._rerender(interaction, lambda s: {'swap_layout': not s['swap_layout']})
 
     @discord.ui.button(label="📝 フォント", style=discord.ButtonStyle.secondary)
     async def font_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         # フォントを切り替え（default -> noto -> gg-sans -> default）
         font_cycle = ['default', 'noto', 'gg-sans']
-        current_index = font_cycle.index(self.settings['font_name'])
-        next_index = (current_index + 1) % len(font_cycle)
-        self.settings['font_name'] = font_cycle[next_index]
-
-        # 画像を再生成
-        img_buf = generate_meme_image(
-            text=self.settings['text'],
-            bg_color=self.settings['bg_color'],
-            rainbow_text=self.settings['rainbow_text'],
-            swap_layout=self.settings['swap_layout'],
-            author_name=self.settings['author_name'],
-            font_name=self.settings['font_name'],
-            avatar_image=self.settings.get('avatar_image')
-        )
-
-        # メッセージを更新
-        file = discord.File(img_buf, filename='meme.png')
-        await interaction.response.edit_message(attachments=[file], view=self)
 
+        def next_font(s):
+            next_index = (font_cycle.index(s['font_name']) + 1) % len(font_cycle)
+            return {'font_name': font_cycle[next_index]}
 
-# カスタムフォントを登録して使用する関数
-def setup_custom_font():
-    # 優先順: ./gg-sans-2/gg sans Regular.ttf -> ./NotoSansCJKjp-Regular.ttf
-    repo_dir = os.path.dirname(__file__)
-    gg_sans_path = os.path.join(repo_dir, 'gg-sans-2', 'gg sans Regular.ttf')
-    noto_path = os.path.join(repo_dir, 'NotoSansCJKjp-Regular.ttf')
+        await self._rerender(interaction, next_font)
 
-    for custom_font_path in (gg_sans_path, noto_path):
-        if os.path.exists(custom_font_path):
-            print(f"カスタムフォントを登録します: {custom_font_path}")
-            try:
-                # フォントを明示的に登録
-                font_prop = fm.FontProperties(fname=custom_font_path)
-                custom_font = fm.FontEntry(
-                    fname=custom_font_path,
-                    name=font_prop.get_name(),
-                    style='normal',
-                    variant='normal',
-                    weight='normal',
-                    stretch='normal',
-                    size='medium'
-                )
-                fm.fontManager.ttflist.insert(0, custom_font)
-                print(f"フォント登録成功: {font_prop.get_name()}")
-                return font_prop.get_name()
-            except Exception as e:
-                print(f"カスタムフォントの登録に失敗しました: {e}")
-    return None
 
-# 利用可能な日本語フォントを検出する関数
-def get_available_japanese_font():
-    # まず指定のTTFファイルを確認
-    custom_font_path = "./NotoSansCJKjp-Regular.ttf"
-    if (os.path.exists(custom_font_path)):
-        return setup_custom_font()
-    
-    # Ubuntu環境で一般的に利用可能な日本語フォント候補
-    font_candidates = [
-        "Noto Sans CJK JP",  # 正しいフォント名に修正
-        'MS Gothic',  # Windows用も一応残す
-        'IPAGothic',  # 他の一般的な日本語フォント
+def _warm_up():
+    """重いサブシステムを読み込む（ゲートウェイ接続後にワーカースレッドで実行する）"""
+    loaders = [
+        ('グラフ描画', lambda: __import__('emotion_chart').prerender_label_sprites()),
+        ('きもい画像', kimoi_images.preload),
     ]
-    
-    for font in font_candidates:
+    # 推論デーモンを使う場合はこのプロセスにモデルを読み込まない
+    if not inference_client.uses_remote():
+        loaders[:0] = [('感情分析モデル', emotion.preload), ('性的表現分類モデル', seiteki.preload)]
+    for name, loader in loaders:
+        started = time.perf_counter()
         try:
-            fm.findfont(font, fallback_to_default=False)
-            print(f"利用可能な日本語フォントを発見: {font}")
-            return font
-        except:
-            pass
-    
-    print("日本語フォントが見つかりませんでした。デフォルトフォントを使用します。")
-    return 'sans-serif'
-
-# 日本語フォントの設定（システムに合わせて自動検出）
-plt.style.use('default')
-# まずカスタムフォントを直接登録
-custom_font_name = setup_custom_font()
-if custom_font_name:
-    plt.rcParams['font.family'] = 'sans-serif'
-    plt.rcParams['font.sans-serif'] = [custom_font_name]
-    plt.rcParams['font.family'] = custom_font_name
-else:
-    # カスタムフォントが登録できなかった場合は従来の方法で検出
-    japanese_font = get_available_japanese_font()
-    plt.rcParams['font.family'] = japanese_font
-
-# Discord色の設定は維持
-plt.rcParams['axes.facecolor'] = '#36393F'  # 背景色をDiscordのダークテーマ色に変更
-plt.rcParams['figure.facecolor'] = '#36393F'  # 外枠も同じ色に統一
-plt.rcParams['axes.edgecolor'] = '#ffffff'  # 軸の色を白に
-plt.rcParams['axes.labelcolor'] = 'white'  # ラベルの色
-plt.rcParams['xtick.color'] = 'white'  # X軸の目盛りの色
-plt.rcParams['ytick.color'] = 'white'  # Y軸の目盛りの色
+            loader()
+            print(f"[ウォームアップ] {name}: {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            print(f"[ウォームアップ] {name} の読み込みに失敗: {e}")
+
+
+_warm_up_task = None
+
 
 @bot.event
 async def on_ready():
-    print(f'ボットの準備完了。ログイン名: {bot.user}')
+    global _warm_up_task
+    print(f'ボットの準備完了。ログイン名: {bot.user}（起動から {time.perf_counter() - _BOOT_STARTED:.2f}s）')
+    if SHARD_COUNT:
+        print(f'シャード: {sorted(bot.shards)} / {bot.shard_count}')
+    # on_ready は再接続のたびに呼ばれるので、ウォームアップは一度だけ行う
+    if _warm_up_task is None and os.getenv('WARMUP', '1') != '0':
+        _warm_up_task = asyncio.create_task(asyncio.to_thread(_warm_up))
+    loop_monitor.start()
+    await metrics.start_exporter()
+
+
+# イベントループの slow callback 警告を切り替える（例: !loopdebug on 0.05）
+@bot.command(name='loopdebug')
+@commands.is_owner()
+async def loopdebug(ctx, mode: str = 'status', slow_callback: float = None):
+    monitor = loop_monitor.running()
+    if monitor is None:
+        await ctx.reply("ループ監視は無効になっています（LOOP_MONITOR=0）。")
+        return
+    if mode in ('on', 'off'):
+        monitor.set_debug(mode == 'on', slow_callback)
+    stats = monitor.stats()
+    await ctx.reply(
+        f"asyncio debug: {'on' if stats['debug'] else 'off'}（slow callback {stats['slow_callback_seconds']}s）\n"
+        f"停止検出: {stats['stalls']} 回, 最大遅延 {stats['max_lag_seconds'] * 1000:.0f} ms, "
+        f"直近: {stats['last_stall_handler'] or '-'}"
+    )
+
+
+# 実行中のボットを seconds 秒間サンプリングし、フレームグラフ SVG と collapsed stack を返す（例: !profile 30）
+@bot.command(name='profile')
+@commands.is_owner()
+async def profile(ctx, seconds: float = 15.0):
+    seconds = max(1.0, min(seconds, sampling_profiler.MAX_SECONDS))
+    await ctx.reply(f"{seconds:.0f} 秒間プロファイルを取ります…")
+    try:
+        stacks = await asyncio.to_thread(sampling_profiler.sample, seconds)
+    except sampling_profiler.ProfilerBusy:
+        await ctx.reply("別のプロファイルを実行中です。")
+        return
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    svg = sampling_profiler.flamegraph_svg(stacks, title=f'emotionbot {stamp} ({seconds:.0f}s)')
+    top = '\n'.join(f"{count:>6}  {frame}" for frame, count in sampling_profiler.top_frames(stacks))
+    files = [
+        discord.File(io.BytesIO(svg.encode('utf-8')), filename=f'profile-{stamp}.svg'),
+        discord.File(io.BytesIO(sampling_profiler.collapsed(stacks).encode('utf-8')), filename=f'profile-{stamp}.txt'),
+    ]
+    await ctx.reply(f"サンプル数の多い関数:\n```\n{top or '-'}\n```", files=files)
+
+# 編集・削除されたメッセージを魚拓に古い内容で残さないよう、チャンネルの履歴キャッシュを捨てる
+# 送信済み画像の URL は、そのメッセージに依存する結果（と、削除された返信の結果）だけを捨てる
+@bot.event
+async def on_raw_message_edit(payload):
+    history_cache.invalidate(payload.channel_id)
+    result_urls.message_edited(payload.message_id)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    history_cache.invalidate(payload.channel_id)
+    result_urls.message_deleted(payload.message_id)
 
 @bot.event
 async def on_message(message):
     # ボット自身のメッセージは無視
     if message.author == bot.user:
         return
-        
-    # 「きもち」というリプライを検出
-    if message.reference and message.content == "きもち":
-        # リプライ先のメッセージを取得
-        referenced_msg = await message.channel.fetch_message(message.reference.message_id)
-        
-        # メッセージの内容がない場合は処理しない
-        if not referenced_msg.content:
-            await message.reply("テキストメッセージにのみ反応できます。")
-            return
-            
-        # リプライ先メッセージの感情分析
-        text = referenced_msg.content
-        
-        try:
-            # 全ての感情スコアを取得
-            emotion_scores = get_emotion_scores(text)
-            
-            # 先にneutralを明示的に除外（大文字小文字を区別しない）
-            emotion_scores = {k: v for k, v in emotion_scores.items() 
-                             if k.lower() != 'neutral'}
-            
-            # スコアが存在するか確認
-            if not emotion_scores:
-                await message.reply("感情スコアを取得できませんでした。別のテキストで試してください。")
+
+    # コマンドごとの処理全体の所要時間を記録する
+    if message.reference:
+        command = _match_command(message.content)
+        if command is not None:
+            # 形式や上限の誤りは、レート制限のトークンを消費せずにそのまま知らせる
+            error = _command_error(command, message.content)
+            if error is not None:
+                await message.reply(error)
                 return
-                
-            # スコア上位5つを選択（neutralを除外したので最大5つ）
-            top_emotions = get_top_emotions(emotion_scores, 5)
-            
-            # スコアをスケーリング
-            scaled_emotions = scale_emotion_scores(top_emotions)
-            
-            # 5角形グラフの生成
-            fig = create_emotion_polygon(scaled_emotions)
-            
-            # グラフを画像に変換
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', dpi=100)
-            buf.seek(0)
-            plt.close(fig)
-            
-            # グラフと元メッセージをリプライ
-            file = discord.File(buf, filename='emotions.png')
-            # 参照メッセージの作成時刻をローカル時間で表示
-            try:
-                ts = referenced_msg.created_at
-                try:
-                    ts_local = ts.astimezone()
-                except Exception:
-                    ts_local = ts
-                # 表示は HH:MM の24時間形式
-                timestr = ts_local.strftime('%H:%M')
-            except Exception:
-                timestr = ''
-
-            time_line = f"時間: {timestr}\n" if timestr else ''
-            await message.reply(f'{time_line}メッセージ: "{text}"\n感情分析結果:', file=file)
-        except KeyError as ke:
-            print(f"キーエラーが発生しました: {ke}")
-            traceback.print_exc()
-            await message.reply(f"感情解析中にキーエラーが発生しました: {ke}")
-        except Exception as e:
-            print(f"エラーが発生しました: {e}")
-            # traceback モジュールはファイル先頭でインポート済みのため
-            # ここで再度 import すると関数スコープで名前が束縛されて
-            # 他の except 節で UnboundLocalError が発生するため削除
-            traceback.print_exc()  # より詳細なエラー情報を表示
-            await message.reply(f"処理中にエラーが発生しました: {e}")
-    
-    if message.reference and message.content == "きもい":
-        referenced_msg = await message.channel.fetch_message(message.reference.message_id)
-        text = referenced_msg.content
-        score = classify_sexual_content(text)
-        img_path = f"./kimoi/{score}.png"
-        if os.path.exists(img_path):
-            with open(img_path, "rb") as f:
-                file = discord.File(f, filename=f"{score}.png")
-                await message.reply(f"エロ度: {score}", file=file)
-        else:
-            await message.reply(f"画像ファイルが見つかりませんでした: {score}.png")
-
-    # 「ぎょたく」「魚拓」「snapshot」コマンド（参照を起点にN件をまとめる）
-    if message.reference and re.match(r'^(?:ぎょたく|魚拓)', message.content):
-        # コマンド解析: 例 '魚拓', '魚拓3', '魚拓2-4'
-        mcmd = re.match(r'^(?:ぎょたく|魚拓)\s*(\d+)?(?:-(\d+))?$', message.content)
-        if not mcmd:
-            await message.reply("コマンド形式が正しくありません。例: '魚拓', '魚拓3', '魚拓2-5' または 'snapshot' など。")
+            decision = rate_limiter.check(
+                command, _command_cost(command, message.content),
+                user_id=message.author.id, channel_id=message.channel.id, **_guild_key(message.guild),
+            )
+            if not decision.allowed:
+                if decision.notify:
+                    await message.reply(cooldown_message(decision))
+                return
+            with metrics.timed('command', command=command):
+                await COMMAND_HANDLERS[command](message)
             return
 
-        num1 = mcmd.group(1)
-        num2 = mcmd.group(2)
-        if num1 is None:
-            A = 1
-            B = 1
-        else:
-            A = int(num1)
-            if num2 is None:
-                B = A
-            else:
-                B = int(num2)
-
-        # A-B を 1-based index として解釈 (1 が参照メッセージ)
-        if A < 1:
-            A = 1
-        if B < A:
-            B = A
+    # 上記以外のコマンドは本ボットでは処理しない
+
+    await bot.process_commands(message)
+
 
+def _command_error(command, content):
+    """実行する前に分かるコマンドの誤り（返信するメッセージ、無ければ None）"""
+    if command == 'gyotaku':
+        return _check_gyotaku(content)[3]
+    return None
+
+
+def _command_cost(command, content):
+    """レート制限のコスト（魚拓はまとめる件数で重み付けする）"""
+    if command == 'gyotaku':
+        A, B, _, error = _check_gyotaku(content)
+        if error is None:
+            return command_cost(command, B - A + 1)
+    return command_cost(command)
+
+
+def _match_command(content):
+    """リプライの本文からコマンド名を判定する（該当しなければ None）"""
+    if content == "きもち":
+        return 'kimochi'
+    if content == "きもい":
+        return 'kimoi'
+    if re.match(r'^(?:ぎょたく|魚拓)', content):
+        return 'gyotaku'
+    if content == "めいく":
+        return 'meme'
+    return None
+
+
+async def _reply_with_cached_result(message, key, content=None):
+    """
+    key の結果を以前送っていれば、その添付ファイルの URL を埋め込みで参照して返信する
+
+    Returns:
+        bool: 返信できたか（False なら通常どおり生成してアップロードする）
+    """
+    urls = result_urls.get(key)
+    if not urls:
+        return False
+    embeds = [discord.Embed().set_image(url=url) for url in urls]
+    try:
+        with metrics.timed('resend', command=key[0]):
+            await message.reply(content, embeds=embeds)
+        return True
+    except discord.HTTPException as e:
+        # URL が使えなくなっていたら捨てて再アップロードする
+        print(f"送信済み画像の再利用に失敗（再アップロードします）: {e}")
+        result_urls.invalidate(key)
+        return False
+
+
+def _remember_result(key, sent_msg, message_ids=()):
+    """
+    送信した返信の添付ファイル URL を key の結果として覚える
+
+    返信が削除されたとき、message_ids のメッセージが編集・削除されたときに捨てられる。
+    """
+    urls = [a.url for a in getattr(sent_msg, 'attachments', None) or []]
+    result_urls.put(key, urls, reply_id=getattr(sent_msg, 'id', None), message_ids=message_ids)
+
+
+# 「きもち」: リプライ先メッセージの感情をレーダーチャートにする
+async def handle_kimochi(message):
+    # リプライ先のメッセージを取得
+    referenced_msg = await history_cache.fetch_message(message.channel, message.reference.message_id)
+    
+    # メッセージの内容がない場合は処理しない
+    if not referenced_msg.content:
+        await message.reply("テキストメッセージにのみ反応できます。")
+        return
+        
+    # リプライ先メッセージの感情分析
+    text = referenced_msg.content
+    key = ('kimochi', referenced_msg.id, edited_marker(referenced_msg))
+
+    # 参照メッセージの作成時刻をローカル時間で表示
+    try:
+        ts = referenced_msg.created_at
         try:
-            referenced_msg = await message.channel.fetch_message(message.reference.message_id)
+            ts_local = ts.astimezone()
         except Exception:
-            await message.reply("参照メッセージを取得できませんでした。")
-            return
+            ts_local = ts
+        # 表示は HH:MM の24時間形式
+        timestr = ts_local.strftime('%H:%M')
+    except Exception:
+        timestr = ''
 
-        # 最大取得数は B
-        to_fetch = max(0, B - 1)
-        try:
-            before_msgs = [m async for m in message.channel.history(limit=to_fetch, before=referenced_msg.created_at)]
-        except Exception as e:
-            print(f"メッセージ履歴取得エラー: {e}")
-            await message.reply("メッセージ履歴を取得できませんでした。権限を確認してください。")
+    time_line = f"時間: {timestr}\n" if timestr else ''
+    caption = f'{time_line}メッセージ: "{text}"\n感情分析結果:'
+
+    # 同じメッセージのグラフを送ったことがあれば、その URL を参照して返す
+    if await _reply_with_cached_result(message, key, caption):
+        return
+
+    try:
+        # 感情分析とグラフ生成はスケジューラ経由でワーカーに任せる（同じメッセージへの同時リクエストは1回にまとめる）
+        chart = await single_flight.do(
+            key,
+            lambda: render_scheduler.submit('kimochi', render_kimochi, text, **_job_owner(message)),
+        )
+        chart = chart.copy() if chart is not None else None
+
+        # スコアが存在するか確認
+        if chart is None:
+            await message.reply("感情スコアを取得できませんでした。別のテキストで試してください。")
             return
 
-        # list_with_ref: index 0 => referenced_msg, index1 => newest before, etc.
-        list_with_ref = [referenced_msg] + before_msgs
-        # 切り取り（A-B 1-based）
-        slice_items = list_with_ref[A-1:B]
-        # 表示は古い順にしたいので逆順で並べ替え
-        slice_items = list(reversed(slice_items))
-
-        # 取得したメッセージごとに avatar/role/emoji を収集
-        message_items = []
-        emoji_token_re = re.compile(r'(<a?:\w+:(\d+)>)')
-        async with aiohttp.ClientSession() as session:
-            for msg in slice_items:
-                text = msg.content or ''
-                # avatar と member の解決
-                avatar_bytes = None
-                member_obj = None
-                try:
-                    # 可能なら Guild の Member に解決して roles 等を取得できるようにする
-                    if getattr(msg, 'guild', None) is not None:
-                        try:
+        # グラフと元メッセージをリプライ
+        file = discord.File(chart.buffer, filename=chart.filename('emotions'))
+        with metrics.timed('upload', command='kimochi'):
+            sent_msg = await message.reply(caption, file=file)
+        _remember_result(key, sent_msg)
+    except SchedulerBusy:
+        await message.reply(BUSY_MESSAGE)
+    except KeyError as ke:
+        print(f"キーエラーが発生しました: {ke}")
+        traceback.print_exc()
+        await message.reply(f"感情解析中にキーエラーが発生しました: {ke}")
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        # traceback モジュールはファイル先頭でインポート済みのため
+        # ここで再度 import すると関数スコープで名前が束縛されて
+        # 他の except 節で UnboundLocalError が発生するため削除
+        traceback.print_exc()  # より詳細なエラー情報を表示
+        await message.reply(f"処理中にエラーが発生しました: {e}")
+
+
+# 「きもい」: リプライ先メッセージのエロ度を画像で返す
+async def handle_kimoi(message):
+    referenced_msg = await history_cache.fetch_message(message.channel, message.reference.message_id)
+    text = referenced_msg.content
+    try:
+        score = await single_flight.do(
+            ('kimoi', referenced_msg.id, edited_marker(referenced_msg)),
+            lambda: render_scheduler.submit('kimoi', classify_sexual_content, text, **_job_owner(message)),
+        )
+    except SchedulerBusy:
+        await message.reply(BUSY_MESSAGE)
+        return
+    # 返信画像はスコアごとに決まっているので、一度送った画像は URL で使い回す
+    key = ('kimoi', score)
+    if await _reply_with_cached_result(message, key, f"エロ度: {score}"):
+        return
+    kimoi_image = open_kimoi_image(score)
+    if kimoi_image is not None:
+        fp, filename = kimoi_image
+        file = discord.File(fp, filename=filename)
+        with metrics.timed('upload', command='kimoi'):
+            sent_msg = await message.reply(f"エロ度: {score}", file=file)
+        _remember_result(key, sent_msg)
+    else:
+        await message.reply(f"画像ファイルが見つかりませんでした: {score}.png")
+
+
+class HistoryUnavailable(Exception):
+    """魚拓のメッセージ履歴を取得できなかった"""
+
+
+def _parse_gyotaku_range(content):
+    """'魚拓', '魚拓3', '魚拓2-4' から (A, B) を返す（1 が参照メッセージ、形式が違えば None）"""
+    mcmd = re.match(r'^(?:ぎょたく|魚拓)\s*(\d+)?(?:-(\d+))?$', content)
+    if not mcmd:
+        return None
+
+    num1 = mcmd.group(1)
+    num2 = mcmd.group(2)
+    if num1 is None:
+        A = 1
+        B = 1
+    else:
+        A = int(num1)
+        if num2 is None:
+            B = A
+        else:
+            B = int(num2)
+
+    # A-B を 1-based index として解釈 (1 が参照メッセージ)
+    if A < 1:
+        A = 1
+    if B < A:
+        B = A
+    return A, B
+
+
+# 「ぎょたく」「魚拓」コマンド（参照を起点にN件をまとめる）
+def _check_gyotaku(content):
+    """
+    魚拓コマンドを解釈して上限を確かめる
+
+    Returns:
+        (A, B, notice, error): error があればそれを返信して終わる。
+        まとめる件数の上限を超えた範囲は切り詰め、notice でそのことを知らせる
+    """
+    parsed = _parse_gyotaku_range(content)
+    if parsed is None:
+        return None, None, None, "コマンド形式が正しくありません。例: '魚拓', '魚拓3', '魚拓2-5' または 'snapshot' など。"
+    A, B = parsed
+
+    # 遡れる件数と1回でまとめる件数の上限（超えた分は切り詰めて知らせる）
+    if B > GYOTAKU_MAX_DEPTH:
+        return A, B, None, f"魚拓は {GYOTAKU_MAX_DEPTH} 件前までです。"
+    notice = None
+    if B - A + 1 > GYOTAKU_MAX_MESSAGES:
+        B = A + GYOTAKU_MAX_MESSAGES - 1
+        notice = f"一度にまとめられるのは {GYOTAKU_MAX_MESSAGES} 件までなので、{A}-{B} を魚拓にしました。"
+    return A, B, notice, None
+
+
+async def handle_gyotaku(message):
+    A, B, notice, error = _check_gyotaku(message.content)
+    if error is not None:
+        await message.reply(error)
+        return
+
+    try:
+        referenced_msg = await history_cache.fetch_message(message.channel, message.reference.message_id)
+    except Exception:
+        await message.reply("参照メッセージを取得できませんでした。")
+        return
+
+    # 同じ範囲の魚拓を送ったことがあれば、その URL を参照して返す
+    key = ('gyotaku', referenced_msg.id, edited_marker(referenced_msg), A, B)
+    if await _reply_with_cached_result(message, key, notice):
+        return
+
+    try:
+        images, message_ids = await single_flight.do(
+            key,
+            lambda: _render_gyotaku(message, referenced_msg, A, B),
+        )
+        images = [img.copy() for img in images]
+        if len(images) == 1:
+            files = [discord.File(images[0].buffer, filename=images[0].filename('gyotaku'))]
+        else:
+            files = [discord.File(img.buffer, filename=img.filename(f'gyotaku-{n}')) for n, img in enumerate(images, 1)]
+        with metrics.timed('upload', command='gyotaku'):
+            sent_msg = await message.reply(notice, files=files)
+        # 範囲までのメッセージが編集・削除されたら捨てられるよう、それらの ID を付けて登録する
+        _remember_result(key, sent_msg, message_ids)
+    except HistoryUnavailable:
+        await message.reply("メッセージ履歴を取得できませんでした。権限を確認してください。")
+    except SchedulerBusy:
+        await message.reply(BUSY_MESSAGE)
+    except Exception as e:
+        print(f"ぎょたく画像生成エラー: {e}")
+        traceback.print_exc()
+        await message.reply(f"画像生成中にエラーが発生しました: {e}")
+
+
+async def _render_gyotaku(message, referenced_msg, A, B):
+    """
+    参照メッセージから数えて A〜B 件目を取得して描画する
+
+    Returns:
+        (ページごとの画像のリスト, 結果が依存するメッセージ ID のリスト)。
+        参照メッセージから B 件目までのどれかが編集・削除されると範囲の内容が変わる
+    """
+    # 最大取得数は B（キャッシュにある分は再取得しない）
+    to_fetch = max(0, B - 1)
+    try:
+        before_msgs = await history_cache.history_before(message.channel, referenced_msg, to_fetch)
+    except Exception as e:
+        print(f"メッセージ履歴取得エラー: {e}")
+        raise HistoryUnavailable() from e
+
+    # list_with_ref: index 0 => referenced_msg, index1 => newest before, etc.
+    list_with_ref = [referenced_msg] + before_msgs
+    # 切り取り（A-B 1-based）
+    slice_items = list_with_ref[A-1:B]
+    # 表示は古い順にしたいので逆順で並べ替え
+    slice_items = list(reversed(slice_items))
+
+    # 取得したメッセージごとに avatar/role/emoji を収集
+    message_items = []
+    # アバター・絵文字などの bytes は描画バックエンドへアセットとして渡す
+    stack_assets = {}
+    emoji_token_re = re.compile(r'(<a?:\w+:(\d+)>)')
+    async with aiohttp.ClientSession() as session:
+        for msg in slice_items:
+            text = msg.content or ''
+            # member の解決
+            member_obj = None
+            avatar_asset = None
+            try:
+                # 可能なら Guild の Member に解決して roles 等を取得できるようにする
+                if getattr(msg, 'guild', None) is not None:
+                    try:
+                        with metrics.timed('member_resolve'):
                             member_obj = msg.guild.get_member(msg.author.id)
                             if member_obj is None:
                                 member_obj = await msg.guild.fetch_member(msg.author.id)
-                        except Exception:
-                            member_obj = None
+                    except Exception:
+                        member_obj = None
 
-                    asset = (member_obj.display_avatar if member_obj is not None else msg.author.display_avatar)
-                    avatar_bytes = await asset.read()
-                except Exception:
-                    avatar_bytes = None
+                avatar_asset = (member_obj.display_avatar if member_obj is not None else msg.author.display_avatar)
+            except Exception:
+                avatar_asset = None
 
-                # role color: member_obj のロール情報を優先して取得し、フォールバックを試す
-                role_color_hex = None
+            # role color: member_obj のロール情報を優先して取得し、フォールバックを試す
+            role_color_hex = None
+            try:
                 try:
-                    try:
-                        roles = getattr(member_obj, 'roles', None)
-                        if roles:
-                            for role in reversed(roles):
-                                col = getattr(role, 'colour', None) or getattr(role, 'color', None)
-                                if col is not None and getattr(col, 'value', 0):
-                                    role_color_hex = f"#{col.value:06x}"
-                                    break
-                    except Exception:
-                        role_color_hex = None
-
-                    # フォールバック: Member.display_color / msg.author の display_color
-                    if not role_color_hex:
-                        display_color = None
-                        if member_obj is not None:
-                            display_color = getattr(member_obj, 'display_color', None) or getattr(member_obj, 'display_colour', None)
-                        if not display_color:
-                            display_color = getattr(msg.author, 'display_color', None) or getattr(msg.author, 'display_colour', None)
-                        if display_color is not None and getattr(display_color, 'value', 0):
-                            role_color_hex = f"#{display_color.value:06x}"
-
-                    # フォールバック2: top_role
-                    try:
-                        tr = None
-                        if member_obj is not None and hasattr(member_obj, 'top_role'):
-                            tr = getattr(member_obj, 'top_role')
-                        elif hasattr(msg.author, 'top_role'):
-                            tr = getattr(msg.author, 'top_role')
-                        if tr is not None:
-                            col = getattr(tr, 'colour', None) or getattr(tr, 'color', None)
-                            if col is not None and getattr(col, 'value', 0) and not role_color_hex:
+                    roles = getattr(member_obj, 'roles', None)
+                    if roles:
+                        for role in reversed(roles):
+                            col = getattr(role, 'colour', None) or getattr(role, 'color', None)
+                            if col is not None and getattr(col, 'value', 0):
                                 role_color_hex = f"#{col.value:06x}"
-                    except Exception:
-                        pass
-
-                    # デバッグログ
-                    try:
-                        author_name_dbg = getattr(member_obj, 'display_name', None) or getattr(msg.author, 'display_name', None) or str(msg.author)
-                        if role_color_hex:
-                            print(f"[DEBUG] {author_name_dbg} role color -> {role_color_hex}")
-                        else:
-                            roles_dbg = []
-                            try:
-                                roles_src = getattr(member_obj, 'roles', None) or getattr(msg.author, 'roles', None) or []
-                                for r in roles_src:
-                                    val = getattr(getattr(r, 'colour', None) or getattr(r, 'color', None), 'value', 0)
-                                    roles_dbg.append(f"{getattr(r, 'name', '')}:{val:06x}")
-                            except Exception:
-                                roles_dbg = ['<roles unavailable>']
-                            print(f"[DEBUG] {author_name_dbg} has no role color, roles: {roles_dbg}")
-                    except Exception:
-                        pass
+                                break
                 except Exception:
                     role_color_hex = None
 
-                # collect emoji images for this message
-                emoji_images = {}
-                for m in emoji_token_re.finditer(text):
-                    token = m.group(1)
-                    emoji_id = m.group(2)
-                    animated = token.startswith('<a:')
-                    ext = 'gif' if animated else 'png'
-                    url = f'https://cdn.discordapp.com/emojis/{emoji_id}.{ext}'
-                    try:
-                        async with session.get(url) as resp:
-                            if resp.status == 200:
-                                emoji_images[token] = await resp.read()
-                    except Exception:
-                        pass
-
-                # サーバータグ情報の取得（ユーザーのプライマリサーバーから）
-                primary_guild_info = None
+                # フォールバック: Member.display_color / msg.author の display_color
+                if not role_color_hex:
+                    display_color = None
+                    if member_obj is not None:
+                        display_color = getattr(member_obj, 'display_color', None) or getattr(member_obj, 'display_colour', None)
+                    if not display_color:
+                        display_color = getattr(msg.author, 'display_color', None) or getattr(msg.author, 'display_colour', None)
+                    if display_color is not None and getattr(display_color, 'value', 0):
+                        role_color_hex = f"#{display_color.value:06x}"
+
+                # フォールバック2: top_role
                 try:
-                    # member_obj が取得できていればそこから、なければ msg.author から primary_guild を取得
-                    user_obj = member_obj if member_obj is not None else msg.author
-                    pg = getattr(user_obj, 'primary_guild', None)
-
-                    if pg and pg.tag and pg.identity_enabled is not False:
-                        # タグ文字列を取得（最大4文字）
-                        tag = pg.tag
+                    tr = None
+                    if member_obj is not None and hasattr(member_obj, 'top_role'):
+                        tr = getattr(member_obj, 'top_role')
+                    elif hasattr(msg.author, 'top_role'):
+                        tr = getattr(msg.author, 'top_role')
+                    if tr is not None:
+                        col = getattr(tr, 'colour', None) or getattr(tr, 'color', None)
+                        if col is not None and getattr(col, 'value', 0) and not role_color_hex:
+                            role_color_hex = f"#{col.value:06x}"
+                except Exception:
+                    pass
 
-                        # バッジ画像を取得（Asset から bytes を取得）
-                        badge_bytes = None
+                # デバッグログ
+                try:
+                    author_name_dbg = getattr(member_obj, 'display_name', None) or getattr(msg.author, 'display_name', None) or str(msg.author)
+                    if role_color_hex:
+                        print(f"[DEBUG] {author_name_dbg} role color -> {role_color_hex}")
+                    else:
+                        roles_dbg = []
                         try:
-                            if pg.badge:
-                                badge_bytes = await pg.badge.read()
-                        except Exception as e:
-                            print(f"バッジ画像取得エラー: {e}")
-                            badge_bytes = None
-
-                        primary_guild_info = {
-                            'tag': tag,
-                            'badge': badge_bytes,
-                            'identity_enabled': True
-                        }
-                except Exception as e:
-                    print(f"プライマリサーバー情報取得エラー: {e}")
-                    primary_guild_info = None
-
-                message_items.append({
-                    'author_name': getattr(msg.author, 'display_name', str(msg.author)),
-                    'content': text,
-                    'avatar': avatar_bytes,
-                    'role_color': role_color_hex,
-                    'timestamp': msg.created_at,
-                    'emoji_images': emoji_images,
-                    'primary_guild': primary_guild_info,
-                })
-
-        try:
-            buf = render_messages_stack(message_items, max_width=900)
-            file = discord.File(buf, filename='gyotaku.png')
-            await message.reply(file=file)
-        except Exception as e:
-            print(f"ぎょたく画像生成エラー: {e}")
-            traceback.print_exc()
-            await message.reply(f"画像生成中にエラーが発生しました: {e}")
-    
-    # 「めいく」コマンド（リプライで画像生成）
-    if message.reference and message.content == "めいく":
-        try:
-            referenced_msg = await message.channel.fetch_message(message.reference.message_id)
-            text = referenced_msg.content
+                            roles_src = getattr(member_obj, 'roles', None) or getattr(msg.author, 'roles', None) or []
+                            for r in roles_src:
+                                val = getattr(getattr(r, 'colour', None) or getattr(r, 'color', None), 'value', 0)
+                                roles_dbg.append(f"{getattr(r, 'name', '')}:{val:06x}")
+                        except Exception:
+                            roles_dbg = ['<roles unavailable>']
+                        print(f"[DEBUG] {author_name_dbg} has no role color, roles: {roles_dbg}")
+                except Exception:
+                    pass
+            except Exception:
+                role_color_hex = None
 
-            if not text:
-                await message.reply("テキストメッセージにのみ反応できます。")
-                return
+            # 描画済みのタイルがあれば、アバター・絵文字・バッジを取得せずにそのまま使う
+            user_obj = member_obj if member_obj is not None else msg.author
+            pg = getattr(user_obj, 'primary_guild', None)
+            author_name = getattr(msg.author, 'display_name', str(msg.author))
+            key = tile_key(
+                msg.id,
+                getattr(msg, 'edited_at', None),
+                GYOTAKU_MAX_WIDTH,
+                author_hash=author_state(
+                    author_name,
+                    role_color_hex,
+                    _asset_key(avatar_asset),
+                    getattr(pg, 'tag', None) if pg and pg.identity_enabled is not False else None,
+                    _asset_key(getattr(pg, 'badge', None)),
+                ),
+            )
+            # アニメーションで出力する場合、動くメッセージは配置を知るためにアセットを揃えて描き直す
+            animated = ANIMATED_PROFILE is not None and _may_animate(avatar_asset, text)
+            tile = None if animated else render_backend.cached_tile(key)
+            if tile is not None:
+                message_items.append({'tile_key': key, 'tile': tile})
+                continue
 
-            # ユーザーのアバター画像を取得
             avatar_bytes = None
+            if avatar_asset is not None:
+                try:
+                    with metrics.timed('asset_download', asset='avatar'):
+                        avatar_bytes = await avatar_asset.read()
+                except Exception:
+                    avatar_bytes = None
+
+            # collect emoji images for this message
+            emoji_images = {}
+            for m in emoji_token_re.finditer(text):
+                token = m.group(1)
+                emoji_id = m.group(2)
+                animated = token.startswith('<a:')
+                ext = 'gif' if animated else 'png'
+                url = f'{DISCORD_CDN_BASE}/emojis/{emoji_id}.{ext}'
+                try:
+                    with metrics.timed('asset_download', asset='emoji'):
+                        async with session.get(url) as resp:
+                            if resp.status == 200:
+                                emoji_images[token] = asset_ref(stack_assets, await resp.read())
+                except Exception:
+                    pass
+
+            # サーバータグ情報の取得（ユーザーのプライマリサーバーから）
+            primary_guild_info = None
             try:
-                avatar_asset = referenced_msg.author.display_avatar
-                avatar_bytes = await avatar_asset.read()
+                # member_obj が取得できていればそこから、なければ msg.author から primary_guild を取得（上で解決済み）
+                if pg and pg.tag and pg.identity_enabled is not False:
+                    # タグ文字列を取得（最大4文字）
+                    tag = pg.tag
+
+                    # バッジ画像を取得（Asset から bytes を取得）
+                    badge_bytes = None
+                    try:
+                        if pg.badge:
+                            with metrics.timed('asset_download', asset='badge'):
+                                badge_bytes = await pg.badge.read()
+                    except Exception as e:
+                        print(f"バッジ画像取得エラー: {e}")
+                        badge_bytes = None
+
+                    primary_guild_info = {
+                        'tag': tag,
+                        'badge': asset_ref(stack_assets, badge_bytes),
+                        'identity_enabled': True
+                    }
             except Exception as e:
-                print(f"アバター画像の取得に失敗: {e}")
-                avatar_bytes = None
-
-            # デフォルト設定で画像生成
-            settings = {
-                'text': text,
-                'bg_color': 'black',
-                'rainbow_text': False,
-                'swap_layout': False,
-                'author_name': referenced_msg.author.display_name,
-                'font_name': 'default',
-                'avatar_image': avatar_bytes
-            }
-
-            # 画像生成
-            img_buf = generate_meme_image(
-                text=settings['text'],
-                bg_color=settings['bg_color'],
-                rainbow_text=settings['rainbow_text'],
-                swap_layout=settings['swap_layout'],
-                author_name=settings['author_name'],
-                font_name=settings['font_name'],
-                avatar_image=settings['avatar_image']
-            )
+                print(f"プライマリサーバー情報取得エラー: {e}")
+                primary_guild_info = None
 
-            # ボタンを作成
-            view = MemeEditView(settings)
+            message_items.append({
+                'tile_key': key,
+                'author_name': author_name,
+                'content': text,
+                'avatar': asset_ref(stack_assets, avatar_bytes),
+                'role_color': role_color_hex,
+                'timestamp': msg.created_at,
+                'emoji_images': emoji_images,
+                'primary_guild': primary_guild_info,
+            })
+
+    # GYOTAKU_PAGE_SIZE 件ずつ別の画像にする（1枚あたりのメモリと描画時間を抑える）
+    pages = [message_items[k:k + GYOTAKU_PAGE_SIZE] for k in range(0, len(message_items), GYOTAKU_PAGE_SIZE)]
+    images = await render_scheduler.submit(
+        'gyotaku',
+        render_gyotaku_pages,
+        pages,
+        stack_assets,
+        profile_for('gyotaku'),
+        **_job_owner(message),
+    )
+    return images, [m.id for m in list_with_ref[:B]]
+
+
+def _default_meme_settings(referenced_msg, avatar_bytes):
+    return {
+        'text': referenced_msg.content,
+        'bg_color': 'black',
+        'rainbow_text': False,
+        'swap_layout': False,
+        'author_name': referenced_msg.author.display_name,
+        'font_name': 'default',
+        'avatar_image': avatar_bytes
+    }
 
-            # 画像を送信
-            file = discord.File(img_buf, filename='meme.png')
-            sent_msg = await message.reply(file=file, view=view)
 
-            # 設定を保存（後でボタンから参照）
-            meme_settings[sent_msg.id] = settings
+async def _render_meme_reply(message, referenced_msg):
+    """アバターを取得してデフォルト設定でめいく画像を生成し、(画像, アバター bytes) を返す"""
+    # ユーザーのアバター画像を取得
+    avatar_bytes = None
+    try:
+        avatar_asset = referenced_msg.author.display_avatar
+        with metrics.timed('asset_download', asset='avatar'):
+            avatar_bytes = await avatar_asset.read()
+    except Exception as e:
+        print(f"アバター画像の取得に失敗: {e}")
+        avatar_bytes = None
+
+    # デフォルト設定で画像生成
+    settings = _default_meme_settings(referenced_msg, avatar_bytes)
+    encoded = await render_scheduler.submit(
+        'meme', render_meme, settings, settings['avatar_image'], **_job_owner(message))
+    return encoded, avatar_bytes
+
+
+# 「めいく」コマンド（リプライで画像生成）
+async def handle_meme(message):
+    try:
+        referenced_msg = await history_cache.fetch_message(message.channel, message.reference.message_id)
+        text = referenced_msg.content
 
-        except Exception as e:
-            print(f"めいく画像生成エラー: {e}")
-            traceback.print_exc()
-            await message.reply(f"画像生成中にエラーが発生しました: {e}")
+        if not text:
+            await message.reply("テキストメッセージにのみ反応できます。")
+            return
 
-    # 上記以外のコマンドは本ボットでは処理しない
+        # アバター取得と画像生成は、同じメッセージへの同時リクエストなら1回にまとめる
+        encoded, avatar_bytes = await single_flight.do(
+            ('meme', referenced_msg.id, edited_marker(referenced_msg)),
+            lambda: _render_meme_reply(message, referenced_msg),
+        )
+        encoded = encoded.copy()
 
-    await bot.process_commands(message)
+        # 返信ごとに設定を持つ（ボタン操作は返信ごとに独立）
+        settings = _default_meme_settings(referenced_msg, avatar_bytes)
 
-# スコアが高い感情を取得する関数
-def get_top_emotions(emotion_scores, n=5):  # デフォルトを5に変更（6から5へ）
-    """
-    感情スコアの中から上位n個を選択する
-    """
-    # 辞書が空の場合にエラー回避
-    if not emotion_scores:
-        raise ValueError("感情スコアが空です")
-    
-    # neutralを再確認して除外（大文字小文字を区別しない）
-    filtered_scores = {}
-    for k, v in emotion_scores.items():
-        if k.lower() != 'neutral':
-            filtered_scores[k] = v
-        else:
-            print(f"Excluded neutral emotion: {k} with score {v}")
-    
-    emotion_scores = filtered_scores
-    
-    # スコア値がゼロでないものだけを対象にする
-    non_zero_scores = {k: v for k, v in emotion_scores.items() if v > 0.001}  # しきい値を調整
-    
-    # 非ゼロのスコアがない場合は、元のすべてのスコアから選択
-    if not non_zero_scores:
-        print("警告: すべての感情スコアがほぼゼロです")
-        non_zero_scores = emotion_scores
-    
-    # スコアで降順ソートして上位n個を選択
-    top_n = sorted(non_zero_scores.items(), key=lambda x: x[1], reverse=True)[:min(n, len(non_zero_scores))]
-    
-    # 選択された感情が少なくとも1つ以上あることを確認
-    if not top_n:
-        raise ValueError("有効な感情スコアがありません")
-    
-    return dict(top_n)
+        # ボタンを作成
+        view = MemeEditView(settings)
 
-# 感情スコアをスケーリングする関数を追加
-def scale_emotion_scores(scores):
-    """
-    小さな感情スコアを視覚化しやすくスケーリングする
-    方法1: 最大値を1.0にスケーリング
-    方法2: すべての値を一定倍にする
-    方法3: 最小閾値を設定（一定値以下は最低値にする）
-    """
-    if not scores:
-        return {}
-        
-    # 最大値を基準にスケーリング
-    max_val = max(scores.values())
-    if max_val > 0:
-        return {k: v/max_val for k, v in scores.items()}
-    
-    return scores  # スケーリングできない場合は元の値を返す
+        # 画像を送信
+        file = discord.File(encoded.buffer, filename=encoded.filename('meme'))
+        with metrics.timed('upload', command='meme'):
+            sent_msg = await message.reply(file=file, view=view)
 
-# グラフ作成関数を修正（動的に感情の数に対応）
-def create_emotion_polygon(emotion_scores):
-    # データの検証
-    if not emotion_scores:
-        raise ValueError("感情スコアが空です")
-    
-    # 念のため最終確認でneutralを除外
-    emotion_scores = {k: v for k, v in emotion_scores.items() if k.lower() != 'neutral'}
-    
-    # 感情の英語から日本語への対応表 - 新しいモデルの形式に対応
-    emotion_names_ja = {
-        # 新しいモデルの感情マッピング
-        "amaze": "びっくり！",
-        "anger": "おこったぞおおおお",
-        "dislike": "きらい、、、",
-        "excite": "興奮するぅうう",
-        "fear": "こわいよぉ",
-        "joy": "うれしいい！",
-        "like": "好きだよぉ",
-        "relief": "安心すりゅぅ",
-        "sad": "悲しいよぉ",
-        "shame": "恥ずかしい ///"
-    }
-    
-    # 英語のラベルを日本語に変換
-    japanese_scores = {}
-    for eng_key, score in emotion_scores.items():
-        ja_key = emotion_names_ja.get(eng_key)
-        if ja_key:
-            japanese_scores[ja_key] = score
-        else:
-            # 未知の感情ラベルの場合はデバッグ出力して英語のまま使用
-            japanese_scores[eng_key] = score
-            print(f"警告: 未知の感情ラベル '{eng_key}' が検出されました")
-    
-    # 日本語変換後のスコアで置き換え
-    emotion_scores = japanese_scores
-    
-    # カテゴリーの順序をランダム化する
-    items = list(emotion_scores.items())
-    random.shuffle(items)  # 順序をランダムに並べ替え
-    emotion_scores = dict(items)
-    
-    # カテゴリーとスコアを取得
-    categories = list(emotion_scores.keys())
-    values = [emotion_scores[cat] for cat in categories]
-    
-    # データ検証
-    if len(categories) < 1:
-        raise ValueError("表示する感情がありません")
-    
-    # 角度の計算 - カテゴリが1つしかない場合の特別処理
-    num_categories = len(categories)
-    if num_categories == 1:
-        # 1つだけの場合は円グラフに変更
-        fig, ax = plt.subplots(figsize=(12, 8))  # 16:9のアスペクト比に変更
-        
-        # カスタムカラーで装飾したバー - 青系の色に変更
-        color = '#5865F2'  # Discord Blurple（Discordの青色）に変更
-        bar = ax.bar([categories[0]], [values[0]], width=0.5, color=color, alpha=0.9)
-        ax.set_ylim(0, 1.1)  # 少し余裕を持たせる
-        
-        # 枠線の色を変更
-        for spine in ax.spines.values():
-            spine.set_color('#ffffff')
-        
-        # タイトルを装飾
-        plt.title(f"感情分析結果: {categories[0]}", fontsize=18, color='white', fontweight='bold')
-        
-        # バーの上に値を表示
-        ax.text(0, values[0] + 0.05, f"{values[0]:.2f}", ha='center', fontsize=14, color='#7289DA')
-        
-        # グリッドを追加 - 白色で鮮明に
-        ax.yaxis.grid(True, linestyle='-', alpha=0.7, color='white', linewidth=1.5)
-        
-        # 背景色を設定
-        ax.set_facecolor('#36393F')  # 既に設定済み
-        fig.patch.set_facecolor('#36393F')  # 外枠もDiscordの背景色に
-        
-        return fig
-    
-    # 角度の計算 (n等分) とデータの繰り返し
-    angles = np.linspace(0, 2 * np.pi, num_categories, endpoint=False).tolist()
-    values += values[:1]  # 最初の値を最後にも追加して円を閉じる
-    angles += angles[:1]  # 最初の角度を最後にも追加
+        # 設定を保存（後でボタンから参照）。アバター bytes はここで asset_cache に移る
+        view.message_id = sent_msg.id
+        meme_settings.put(sent_msg.id, settings)
+
+    except SchedulerBusy:
+        await message.reply(BUSY_MESSAGE)
+    except Exception as e:
+        print(f"めいく画像生成エラー: {e}")
+        traceback.print_exc()
+        await message.reply(f"画像生成中にエラーが発生しました: {e}")
+
+
+COMMAND_HANDLERS = {
+    'kimochi': handle_kimochi,
+    'kimoi': handle_kimoi,
+    'gyotaku': handle_gyotaku,
+    'meme': handle_meme,
+}
 
-    # 極座標プロットの設定
-    fig, ax = plt.subplots(figsize=(12, 9), subplot_kw={'projection': 'polar'})
-    
-    # 背景色とグリッドの設定
-    ax.set_facecolor('#36393F')  # Discordのダークテーマカラー
-    fig.patch.set_facecolor('#36393F')  # 外枠も同じ色に
-    
-    # 角度の設定
-    ax.set_theta_offset(np.pi / 2)
-    ax.set_theta_direction(-1)
 
-    # カスタムカラーマップを作成
-    colors = [(0.35, 0.4, 0.95, 0.7), (0.45, 0.6, 0.95, 0.8), (0.55, 0.7, 0.95, 0.9)]  # 青系グラデーション
-    cmap = LinearSegmentedColormap.from_list('custom_cmap', colors, N=256)
-    
-    # データ描画
-    line = ax.plot(angles, values, linewidth=4, linestyle='-', color='#7289DA')[0]  # データ線は青のまま、太く
-    # グラデーションカラーで塗り潰し
-    ax.fill(angles, values, alpha=0.7, color='#5865F2')  # 透明度を下げてよりはっきりと
-    
-    # マーカーを別途追加（より大きく装飾的に）
-    ax.scatter(angles[:-1], values[:-1], s=180, c='#40E0D0', alpha=1.0, 
-               edgecolors='#00BFFF', linewidth=3, zorder=10)  # サイズと線の太さを増加
-    
-    # 放射状の線を白色で太く、はっきりと設定
-    ax.grid(True, color='white', alpha=0.7, linestyle='-', linewidth=1.5)
-    
-    # 軸ラベル設定 - Ubuntu環境を考慮してフォントサイズを調整
-    ax.set_xticks(angles[:-1])
-    ax.set_xticklabels(categories, fontsize=24)  # フォントサイズを調整（40から24に）
-    
-    # 半径の範囲を設定
-    ax.set_ylim(0, 1)
-    
-    # 同心円のグリッド線をスタイリング - 白色で鮮明に
-    ax.set_rticks([0.25, 0.5, 0.75, 1.0])  # より目立つ値に調整
-    gridlines = ax.yaxis.get_gridlines()
-    for gl in gridlines:
-        gl.set_color('white')
-        gl.set_alpha(0.6)  # 透明度を下げてはっきりと
-        gl.set_linestyle('-')
-        gl.set_linewidth(1.5)  # 線を太く
-    
-    # 目盛りを非表示に設定
-    ax.set_yticklabels([])  # 数値を非表示
-    
-    # ラベルサイズを拡大（色はすでに白っぽい色に設定済み）
-    ax.tick_params(labelsize=40, colors='white', grid_color='white')
-    
-    # 外枠を非表示
-    ax.spines['polar'].set_visible(False)
-    
-    return fig
 
 # ボットトークンを設定してボットを実行
-bot.run(os.getenv('DISCORD_TOKEN'))  # .envファイルからトークンを読み込む
\ No newline at end of file
+# （描画ワーカープロセスが spawn 時にこのモジュールを読み込んでも起動しないようにする）
+if __name__ == '__main__':
+    bot.run(os.getenv('DISCORD_TOKEN'))  # .envファイルからトークンを読み込む
\ No newline at end of file
@@ -5,7 +5,17 @@ import os
 import re
 from typing import List, Tuple, Optional
 
+import animation
+import font_cache
+import text_layout
+from image_encoder import PROFILES, encode_image, shared_palette, stream_png
 
+
+# アニメーションするアバター・絵文字はこの大きさまで縮小してデコードする（描画は 56px 以下）
+ANIMATION_MAX_SIDE = 128
+
+
+@font_cache.per_thread
 def _load_font(size, weight='Regular'):
     # 優先してリポジトリ内のフォントを使用（gg-sans-2 の指定ウェイトを優先）
     # weight: 'Regular', 'Medium', 'Semibold', 'Bold'
@@ -73,6 +83,7 @@ def _load_font(size, weight='Regular'):
     return ImageFont.load_default()
 
 
+@font_cache.per_thread
 def _get_fallback_fonts(size, weight='Regular'):
     """
     フォールバックフォントのリストを返す（優先順位順）
@@ -158,6 +169,18 @@ def _has_cjk_character(text):
     return False
 
 
+def _primary_font(text, fonts):
+    """
+    _draw_text_with_fallback が text の描画に使うフォント（幅の計測用）
+    """
+    if _has_cjk_character(text):
+        for font in fonts:
+            font_path = getattr(font, '_font_path', '').lower()
+            if getattr(font, '_is_cjk', False) or 'noto' in font_path or 'cjk' in font_path:
+                return font
+    return fonts[0]
+
+
 def _draw_text_with_fallback(draw, pos, text, fonts, fill):
     """
     複数のフォントを使って文字列を描画する
@@ -297,7 +320,7 @@ def _parse_markdown(text):
     return tokens
 
 
-def render_discord_like_message(author_name, content, avatar=None, role_color=None, primary_guild=None, emoji_images=None, width=1100, max_width=900, min_width=420, timestamp=None):
+def render_discord_like_message(author_name, content, avatar=None, role_color=None, primary_guild=None, emoji_images=None, width=1100, max_width=900, min_width=420, timestamp=None, profile='png_fast'):
     """
     Discord風メッセージを画像化してBytesIOを返す。
 
@@ -306,9 +329,25 @@ def render_discord_like_message(author_name, content, avatar=None, role_color=No
         content (str): メッセージ内容（複数行可）
         avatar_path (str|None): アバター画像のパス（無ければ丸い色ブロック）
         width (int): 出力画像の幅
+        profile (str): image_encoder のプロファイル名
 
     Returns:
-        io.BytesIO: PNGデータが入ったバッファ（seekは0の状態）
+        io.BytesIO: エンコード済みデータが入ったバッファ（seekは0の状態）
+    """
+    im = render_discord_like_message_image(
+        author_name, content, avatar=avatar, role_color=role_color, primary_guild=primary_guild,
+        emoji_images=emoji_images, width=width, max_width=max_width, min_width=min_width, timestamp=timestamp
+    )
+    return encode_image(im, profile).buffer
+
+
+def render_discord_like_message_image(author_name, content, avatar=None, role_color=None, primary_guild=None, emoji_images=None, width=1100, max_width=900, min_width=420, timestamp=None, placements=None):
+    """
+    Discord風メッセージを描画して PIL.Image (RGB) を返す。
+    引数は render_discord_like_message と同じ。
+
+    placements: リストを渡すと、アニメーションするアバター・絵文字（bytes のもの）を貼った位置を
+        animation.Placement として追加する（画像には最初のフレームが描かれる）
     """
     # スタイル設定
     bg_color = '#36393F'  # Discordダーク
@@ -325,7 +364,8 @@ def render_discord_like_message(author_name, content, avatar=None, role_color=No
     text_font = _load_font(21)
 
     # テキストの折り返し（カスタム絵文字対応）
-    max_text_width = width - (padding * 2 + avatar_size + gap)
+    # 画像は max_width に収めるので、折り返し幅もそれを超えないようにする
+    max_text_width = min(width, max_width) - (padding * 2 + avatar_size + gap)
 
     # emoji_images は token -> bytes のマッピング（例: '<:name:123>' -> b'...')
     if emoji_images is None:
@@ -356,6 +396,11 @@ def render_discord_like_message(author_name, content, avatar=None, role_color=No
     paragraphs = content.split('\n')
     lines = []  # 各行は [(text, style, is_emoji)] のリスト
 
+    def token_font(text, style):
+        # 描画と同じフォントで測る（太字は太字のフォント、CJK を含むトークンは CJK フォント）
+        fonts = fallback_fonts_bold if style.get('bold') else fallback_fonts
+        return _primary_font(text, fonts) if fonts else text_font
+
     def measure_token(text, style, is_emoji=False):
         # 絵文字トークンの場合は画像の幅
         if is_emoji and text in emoji_images:
@@ -365,13 +410,7 @@ def render_discord_like_message(author_name, content, avatar=None, role_color=No
             except Exception:
                 return 24
 
-        # コードや太字の場合は適切なフォントを使う
-        if style.get('bold'):
-            font = fallback_fonts_bold[0] if fallback_fonts_bold else text_font
-        else:
-            font = text_font
-
-        bbox = tmp_draw.textbbox((0, 0), text, font=font)
+        bbox = tmp_draw.textbbox((0, 0), text, font=token_font(text, style))
         width = bbox[2] - bbox[0]
 
         # コードブロックの場合は背景のパディングを追加
@@ -403,13 +442,32 @@ def render_discord_like_message(author_name, content, avatar=None, role_color=No
             text, style, is_emoji = token
             w = measure_token(text, style, is_emoji)
 
-            if cur_width + w > max_text_width and cur_line:
-                lines.append(cur_line)
-                cur_line = [token]
-                cur_width = w
-            else:
+            if cur_width + w <= max_text_width:
                 cur_line.append(token)
                 cur_width += w
+                continue
+            if is_emoji:
+                if cur_line:
+                    lines.append(cur_line)
+                cur_line = [token]
+                cur_width = w
+                continue
+
+            # 収まらないテキストは行の残り幅で切り、続きは次の行へ（日本語は文字単位で禁則処理つき）
+            breaker = text_layout.LineBreaker(text, token_font(text, style))
+            pad = 8 if style.get('code') else 0
+            start = 0
+            while start < len(text):
+                end, next_start = breaker.fit(start, max_text_width - cur_width - pad, force=not cur_line)
+                if end > start:
+                    piece = text[start:end]
+                    cur_line.append((piece, style, False))
+                    cur_width += measure_token(piece, style)
+                if next_start < len(text) or end == start:
+                    lines.append(cur_line)
+                    cur_line = []
+                    cur_width = 0
+                start = next_start
 
         # 末尾の行を追加
         if cur_line:
@@ -518,6 +576,11 @@ def render_discord_like_message(author_name, content, avatar=None, role_color=No
                 mask = Image.new('L', (avatar_size, avatar_size), 0)
                 ImageDraw.Draw(mask).ellipse((0, 0, avatar_size, avatar_size), fill=255)
 
+            if placements is not None:
+                frames = animation.decode(avatar, ANIMATION_MAX_SIDE)
+                if frames is not None:
+                    box = (avatar_x, avatar_y, avatar_x + avatar_size, avatar_y + avatar_size)
+                    placements.append(animation.Placement(frames, box[:2], av.size, mask, im.crop(box)))
             im.paste(av, (avatar_x, avatar_y), mask)
         except Exception:
             # 失敗したら単色の円を描画
@@ -695,6 +758,11 @@ def render_discord_like_message(author_name, content, avatar=None, role_color=No
                     em_h = line_height - 4
                     em_w = int(em_img.width * (em_h / em_img.height)) if em_img.height else em_h
                     em_img = em_img.resize((em_w, em_h), Image.LANCZOS)
+                    if placements is not None:
+                        frames = animation.decode(emoji_images[text], ANIMATION_MAX_SIDE)
+                        if frames is not None:
+                            box = (int(x), int(y), int(x) + em_w, int(y) + em_h)
+                            placements.append(animation.Placement(frames, box[:2], em_img.size, None, im.crop(box)))
                     im.paste(em_img, (int(x), int(y)), em_img)
                     x += em_w + 2
                 except Exception:
@@ -740,7 +808,6 @@ def render_discord_like_message(author_name, content, avatar=None, role_color=No
                     strike_y = y + text_h // 2
                     draw.line((start_x, strike_y, x, strike_y), fill=fill_color, width=2)
 
-    # 余白を持たせた保存
     # 最終的に透明部分が残らないよう、背景色で合成して RGB にする
     try:
         bg = Image.new('RGB', im.size, bg_color)
@@ -748,52 +815,147 @@ def render_discord_like_message(author_name, content, avatar=None, role_color=No
             bg.paste(im, mask=im.split()[3])  # alpha チャネルをマスクとして合成
         else:
             bg.paste(im)
-        out = io.BytesIO()
-        bg.save(out, format='PNG')
-        out.seek(0)
-        return out
+        return bg
     except Exception:
-        # フォールバックで元のイメージを保存
-        out = io.BytesIO()
-        im.save(out, format='PNG')
-        out.seek(0)
-        return out
+        # フォールバックで元のイメージを返す
+        return im.convert('RGB')
 
 
-def render_messages_stack(message_items, width=None, max_width=900, bg_color='#36393F'):
+def render_messages_stack(message_items, width=None, max_width=900, bg_color='#36393F', profile='png_fast'):
     """
     複数メッセージを縦に積んだ画像を返す。
 
     message_items: list of dict with keys: author_name, content, avatar (bytes|path|None), role_color (hex|None), emoji_images (dict token->bytes)
     width: 固定幅を指定（None なら内部で算出）
+    profile: image_encoder のプロファイル名
+    """
+    return encode_messages_stack(message_items, profile, width=width, max_width=max_width, bg_color=bg_color).buffer
+
+
+def encode_messages_stack(message_items, profile='png_fast', width=None, max_width=900, bg_color='#36393F', tile_cache=None, animate=None):
+    """
+    複数メッセージを縦に積んだ画像をエンコードして EncodedImage を返す。
+    引数は render_messages_stack_image と同じ。
+
+    PNG のプロファイルでは全体の画像を作らず、タイルを1枚ずつ帯にしながら逐次エンコードする。
+    全体の幅を決めるためにタイルは先に描画するが、エンコードしたタイルから手放すので、
+    全体の画像や減色用の画像（大きさは一定）のように件数に比例して増えるものは持たない。
+
+    animate: アニメーション用のプロファイル名。指定するとアニメーションする絵文字・アバターを
+        動かした画像にする（動くものがない・上限を超えた場合は profile の静止画）
     """
-    # 各メッセージを個別にレンダリングして PIL.Image に変換
+    if animate:
+        img, placements = render_messages_stack_layers(message_items, width=width, max_width=max_width, bg_color=bg_color, tile_cache=tile_cache)
+        encoded = animation.animate_placements(img, placements, animate) if placements else None
+        return encoded or encode_image(img, profile)
+
+    spec = PROFILES.get(profile)
+    if spec is None or spec['format'] != 'PNG':
+        img = render_messages_stack_image(message_items, width=width, max_width=max_width, bg_color=bg_color, tile_cache=tile_cache)
+        return encode_image(img, profile)
+
+    imgs = _stack_tiles(message_items, width, max_width, tile_cache)
+    if not imgs:
+        return encode_image(Image.new('RGB', (min(420, max_width), 80), bg_color), profile)
+
+    total_width = min(max(im.width for im in imgs), max_width)
+    total_height = sum(im.height for im in imgs)
+    palette = shared_palette(imgs, spec['quantize']) if spec.get('quantize') else None
+    return stream_png((total_width, total_height), _stack_bands(imgs, total_width, bg_color), profile, palette)
+
+
+def _stack_tiles(message_items, width, max_width, tile_cache, placements=None):
+    # 各メッセージを個別にレンダリング（エンコードせず PIL.Image のまま扱う）
+    # placements を渡すと、タイルごとのアニメーションの配置のリストを追加する
     imgs = []
     for item in message_items:
-        buf = render_discord_like_message(
-            item.get('author_name', ''),
-            item.get('content', ''),
-            avatar=item.get('avatar'),
-            role_color=item.get('role_color'),
-            primary_guild=item.get('primary_guild'),
-            emoji_images=item.get('emoji_images', {}),
-            timestamp=item.get('timestamp', None),
-            width=width or max_width,
-            max_width=max_width
-        )
-        try:
-            im = Image.open(buf).convert('RGB')
-            imgs.append(im)
-        except Exception:
-            # バッファから開けない場合はスキップ
+        im = item.get('tile')
+        key = item.get('tile_key')
+        tile_placements = []
+        # 動くアセットがあるタイルは配置を知るためにキャッシュがあっても描き直す
+        animated = placements is not None and im is None and _has_animation(item)
+        if im is None and tile_cache is not None and not animated:
+            im = tile_cache.get(key)
+        if im is None:
+            im = render_message_tile(item, width=width, max_width=max_width, placements=tile_placements if animated else None)
+            if tile_cache is not None:
+                tile_cache.put(key, im)
+        imgs.append(im)
+        if placements is not None:
+            placements.append(tile_placements)
+    return imgs
+
+
+def _has_animation(item):
+    assets = [item.get('avatar')] + list((item.get('emoji_images') or {}).values())
+    return any(animation.decode(data, ANIMATION_MAX_SIDE) is not None for data in assets)
+
+
+def _stack_bands(imgs, total_width, bg_color):
+    # タイル1枚分ずつ全体の幅の帯にして返す（横幅が合わない場合は左右に余白を入れて中央に寄せる）
+    # 返したタイルは imgs から外すので、エンコードが進むにつれて解放される
+    imgs.reverse()
+    while imgs:
+        im = imgs.pop()
+        if im.width == total_width and im.mode == 'RGB':
+            yield im
             continue
+        band = Image.new('RGB', (total_width, im.height), bg_color)
+        band.paste(im, (_stack_x(im, total_width), 0))
+        yield band
+
+
+def _stack_x(im, total_width):
+    # 幅の足りないタイルは中央に寄せる。全体より広いタイル（max_width を超えたもの）は左端から置いて右を切る
+    return max(0, (total_width - im.width) // 2)
+
+
+def render_message_tile(item, width=None, max_width=900, placements=None):
+    """render_messages_stack の1件分（message_items の要素）を描画する"""
+    return render_discord_like_message_image(
+        item.get('author_name', ''),
+        item.get('content', ''),
+        avatar=item.get('avatar'),
+        role_color=item.get('role_color'),
+        primary_guild=item.get('primary_guild'),
+        emoji_images=item.get('emoji_images', {}),
+        timestamp=item.get('timestamp', None),
+        width=width or max_width,
+        max_width=max_width,
+        placements=placements,
+    )
 
+
+def render_messages_stack_image(message_items, width=None, max_width=900, bg_color='#36393F', tile_cache=None):
+    """
+    複数メッセージを縦に積んだ PIL.Image (RGB) を返す。
+    引数は render_messages_stack と同じ。
+
+    tile_cache: tile_cache.TileCache。要素に 'tile' があればそれを、'tile_key' がキャッシュにあれば
+        そのタイルを使い、どちらも無いものだけ描画してキャッシュに入れる。
+    """
+    return _compose_stack(_stack_tiles(message_items, width, max_width, tile_cache), max_width, bg_color)[0]
+
+
+def render_messages_stack_layers(message_items, width=None, max_width=900, bg_color='#36393F', tile_cache=None):
+    """
+    render_messages_stack_image と同じ画像と、その上でアニメーションする絵文字・アバターの配置を返す
+
+    Returns:
+        (PIL.Image, list of animation.Placement)
+    """
+    tile_placements = []
+    imgs = _stack_tiles(message_items, width, max_width, tile_cache, tile_placements)
+    dst, offsets = _compose_stack(imgs, max_width, bg_color)
+    placements = [p.moved(x, y) for (x, y), ps in zip(offsets, tile_placements) for p in ps]
+    return dst, placements
+
+
+def _compose_stack(imgs, max_width, bg_color):
+    # タイルを縦に並べた画像と、各タイルを置いた左上の座標を返す
     if not imgs:
         # 空の場合は空画像を返す
-        out = io.BytesIO()
-        Image.new('RGB', (min(420, max_width), 80), bg_color).save(out, format='PNG')
-        out.seek(0)
-        return out
+        return Image.new('RGB', (min(420, max_width), 80), bg_color), []
 
     # 幅は max of widths but capped by max_width
     total_width = min(max((im.width for im in imgs)), max_width)
@@ -802,17 +964,13 @@ def render_messages_stack(message_items, width=None, max_width=900, bg_color='#3
 
     # 新しい画像を作る
     dst = Image.new('RGB', (total_width, total_height), bg_color)
+    offsets = []
     y = 0
     for im in imgs:
-        # 横幅が合わない場合は左右に余白を入れて中央に寄せる
-        if im.width != total_width:
-            x = (total_width - im.width) // 2
-        else:
-            x = 0
+        # 横幅が合わない場合は左右に余白を入れて中央に寄せる（逐次エンコードの _stack_bands と同じ配置）
+        x = _stack_x(im, total_width)
         dst.paste(im, (x, y))
+        offsets.append((x, y))
         y += im.height
 
-    out = io.BytesIO()
-    dst.save(out, format='PNG')
-    out.seek(0)
-    return out
+    return dst, offsets
@@ -1,11 +1,16 @@
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
-import torch
-import torch.nn.functional as F
+import os
+import threading
+
+import metrics
 
 # 新しいモデルに変更
 model_name = "alter-wang/bert-base-japanese-emotion-lily"
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-model = AutoModelForSequenceClassification.from_pretrained(model_name)
+
+# モデルは初回利用時（またはウォームアップ時）に読み込む
+# torch / transformers の import 自体が重いので、ボットの起動をブロックしないようにする
+tokenizer = None
+model = None
+_load_lock = threading.Lock()
 
 # 感情ラベルのマッピングを追加
 emotion_mapping = {
@@ -21,21 +26,48 @@ emotion_mapping = {
     9: 'shame'
 }
 
+def preload():
+    """トークナイザとモデルを読み込む（読み込み済みなら何もしない）"""
+    global tokenizer, model
+    if model is not None:
+        return
+    with _load_lock:
+        if model is not None:
+            return
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+        # MODEL_LOCAL_ONLY=1 のときはキャッシュ済みの重みだけを使い、ネットワークに接続しない
+        # （.env を読み込んだ後に判断するよう、import 時ではなくここで参照する）
+        local_only = os.getenv('MODEL_LOCAL_ONLY') == '1'
+        tokenizer = AutoTokenizer.from_pretrained(model_name, local_files_only=local_only)
+        # model を最後に代入して、他スレッドが読み込み途中の状態を見ないようにする
+        loaded = AutoModelForSequenceClassification.from_pretrained(model_name, local_files_only=local_only)
+        model = loaded
+
 def get_emotion_scores(text):
-    inputs = tokenizer(text, return_tensors="pt", padding=True, truncation=True, max_length=512)
-    
-    with torch.no_grad():
+    return get_emotion_scores_batch([text])[0]
+
+def get_emotion_scores_batch(texts):
+    """
+    複数のテキストをまとめて推論する
+
+    Args:
+        texts: テキストのリスト
+
+    Returns:
+        list: テキストごとの {感情ラベル: スコア} の dict（texts と同じ順番）
+    """
+    import torch
+    import torch.nn.functional as F
+
+    preload()
+    with metrics.timed('tokenize', model='emotion'):
+        inputs = tokenizer(list(texts), return_tensors="pt", padding=True, truncation=True, max_length=512)
+
+    with torch.no_grad(), metrics.timed('forward', model='emotion'):
         outputs = model(**inputs)
         logits = outputs.logits
         # このモデルはソフトマックス確率を使用する
-        probabilities = F.softmax(logits, dim=1).squeeze().tolist()
+        probabilities = F.softmax(logits, dim=1).tolist()
 
     # 感情スコアを辞書形式で返す
-    if isinstance(probabilities, list):
-        # バッチサイズが1の場合
-        scores = {emotion_mapping[i]: score for i, score in enumerate(probabilities)}
-    else:
-        # スカラー値の場合（確率が1つだけの場合）
-        scores = {emotion_mapping[0]: probabilities}
-        
-    return scores
\ No newline at end of file
+    return [{emotion_mapping[i]: score for i, score in enumerate(row)} for row in probabilities]
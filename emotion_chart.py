@@ -0,0 +1,406 @@
+"""
+感情レーダーチャートの描画
+
+bot.py から切り出したグラフ生成処理。Discord や推論モデルに依存しないため、
+レンダリング用のワーカープロセスからも import できる。
+"""
+import os
+import random
+import threading
+import matplotlib as mpl
+mpl.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.font_manager as fm
+import numpy as np
+from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.offsetbox import AnnotationBbox, OffsetImage
+from PIL import Image
+
+from image_encoder import encode_image
+
+
+# カスタムフォントを登録して使用する関数
+def setup_custom_font():
+    # 優先順: ./gg-sans-2/gg sans Regular.ttf -> ./NotoSansCJKjp-Regular.ttf
+    repo_dir = os.path.dirname(__file__)
+    gg_sans_path = os.path.join(repo_dir, 'gg-sans-2', 'gg sans Regular.ttf')
+    noto_path = os.path.join(repo_dir, 'NotoSansCJKjp-Regular.ttf')
+
+    for custom_font_path in (gg_sans_path, noto_path):
+        if os.path.exists(custom_font_path):
+            print(f"カスタムフォントを登録します: {custom_font_path}")
+            try:
+                # フォントを明示的に登録
+                font_prop = fm.FontProperties(fname=custom_font_path)
+                custom_font = fm.FontEntry(
+                    fname=custom_font_path,
+                    name=font_prop.get_name(),
+                    style='normal',
+                    variant='normal',
+                    weight='normal',
+                    stretch='normal',
+                    size='medium'
+                )
+                fm.fontManager.ttflist.insert(0, custom_font)
+                print(f"フォント登録成功: {font_prop.get_name()}")
+                return font_prop.get_name()
+            except Exception as e:
+                print(f"カスタムフォントの登録に失敗しました: {e}")
+    return None
+
+# 利用可能な日本語フォントを検出する関数
+def get_available_japanese_font():
+    # まず指定のTTFファイルを確認
+    custom_font_path = "./NotoSansCJKjp-Regular.ttf"
+    if (os.path.exists(custom_font_path)):
+        return setup_custom_font()
+    
+    # Ubuntu環境で一般的に利用可能な日本語フォント候補
+    font_candidates = [
+        "Noto Sans CJK JP",  # 正しいフォント名に修正
+        'MS Gothic',  # Windows用も一応残す
+        'IPAGothic',  # 他の一般的な日本語フォント
+    ]
+    
+    for font in font_candidates:
+        try:
+            fm.findfont(font, fallback_to_default=False)
+            print(f"利用可能な日本語フォントを発見: {font}")
+            return font
+        except:
+            pass
+    
+    print("日本語フォントが見つかりませんでした。デフォルトフォントを使用します。")
+    return 'sans-serif'
+
+# 日本語フォントの設定（システムに合わせて自動検出）
+plt.style.use('default')
+# まずカスタムフォントを直接登録
+custom_font_name = setup_custom_font()
+if custom_font_name:
+    plt.rcParams['font.family'] = 'sans-serif'
+    plt.rcParams['font.sans-serif'] = [custom_font_name]
+    plt.rcParams['font.family'] = custom_font_name
+else:
+    # カスタムフォントが登録できなかった場合は従来の方法で検出
+    japanese_font = get_available_japanese_font()
+    plt.rcParams['font.family'] = japanese_font
+
+# Discord色の設定は維持
+plt.rcParams['axes.facecolor'] = '#36393F'  # 背景色をDiscordのダークテーマ色に変更
+plt.rcParams['figure.facecolor'] = '#36393F'  # 外枠も同じ色に統一
+plt.rcParams['axes.edgecolor'] = '#ffffff'  # 軸の色を白に
+plt.rcParams['axes.labelcolor'] = 'white'  # ラベルの色
+plt.rcParams['xtick.color'] = 'white'  # X軸の目盛りの色
+plt.rcParams['ytick.color'] = 'white'  # Y軸の目盛りの色
+
+# スコアが高い感情を取得する関数
+def get_top_emotions(emotion_scores, n=5):  # デフォルトを5に変更（6から5へ）
+    """
+    感情スコアの中から上位n個を選択する
+    """
+    # 辞書が空の場合にエラー回避
+    if not emotion_scores:
+        raise ValueError("感情スコアが空です")
+    
+    # neutralを再確認して除外（大文字小文字を区別しない）
+    filtered_scores = {}
+    for k, v in emotion_scores.items():
+        if k.lower() != 'neutral':
+            filtered_scores[k] = v
+        else:
+            print(f"Excluded neutral emotion: {k} with score {v}")
+    
+    emotion_scores = filtered_scores
+    
+    # スコア値がゼロでないものだけを対象にする
+    non_zero_scores = {k: v for k, v in emotion_scores.items() if v > 0.001}  # しきい値を調整
+    
+    # 非ゼロのスコアがない場合は、元のすべてのスコアから選択
+    if not non_zero_scores:
+        print("警告: すべての感情スコアがほぼゼロです")
+        non_zero_scores = emotion_scores
+    
+    # スコアで降順ソートして上位n個を選択
+    top_n = sorted(non_zero_scores.items(), key=lambda x: x[1], reverse=True)[:min(n, len(non_zero_scores))]
+    
+    # 選択された感情が少なくとも1つ以上あることを確認
+    if not top_n:
+        raise ValueError("有効な感情スコアがありません")
+    
+    return dict(top_n)
+
+# 感情スコアをスケーリングする関数を追加
+def scale_emotion_scores(scores):
+    """
+    小さな感情スコアを視覚化しやすくスケーリングする
+    方法1: 最大値を1.0にスケーリング
+    方法2: すべての値を一定倍にする
+    方法3: 最小閾値を設定（一定値以下は最低値にする）
+    """
+    if not scores:
+        return {}
+        
+    # 最大値を基準にスケーリング
+    max_val = max(scores.values())
+    if max_val > 0:
+        return {k: v/max_val for k, v in scores.items()}
+    
+    return scores  # スケーリングできない場合は元の値を返す
+
+# 感情の英語から日本語への対応表 - 新しいモデルの形式に対応
+EMOTION_NAMES_JA = {
+    # 新しいモデルの感情マッピング
+    "amaze": "びっくり！",
+    "anger": "おこったぞおおおお",
+    "dislike": "きらい、、、",
+    "excite": "興奮するぅうう",
+    "fear": "こわいよぉ",
+    "joy": "うれしいい！",
+    "like": "好きだよぉ",
+    "relief": "安心すりゅぅ",
+    "sad": "悲しいよぉ",
+    "shame": "恥ずかしい ///"
+}
+
+# レーダーチャートのラベルの見た目（テーマ）。ラベル画像はテーマごとに一度だけ描画する
+LABEL_THEME = {'fontsize': 40, 'color': 'white', 'dpi': 100}
+# ラベル画像とグラフ外周との距離（ピクセル）
+LABEL_PAD_PX = 14
+# ラベル画像と画像の端との最小の距離（ピクセル）
+LABEL_MARGIN_PX = 8
+
+_label_sprites = {}
+_label_sprites_lock = threading.Lock()
+
+def _render_label_sprite(label, fontsize, color, dpi):
+    # 一度大きさを測ってから、テキストがちょうど収まる透明キャンバスに描き直す
+    fig = Figure(dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    text = fig.text(0, 0, label, fontsize=fontsize, color=color)
+    extent = text.get_window_extent(renderer=canvas.get_renderer())
+    width = int(np.ceil(extent.width)) + 4
+    height = int(np.ceil(extent.height)) + 4
+    fig.set_size_inches(width / dpi, height / dpi)
+    fig.patch.set_alpha(0)
+    text.set_position((0.5, 0.5))
+    text.set_horizontalalignment('center')
+    text.set_verticalalignment('center')
+    canvas.draw()
+    sprite = np.asarray(canvas.buffer_rgba()).copy()
+    sprite.setflags(write=False)
+    return sprite
+
+def get_label_sprite(label, theme=None):
+    """ラベルを描画した RGBA 配列 (高さ, 幅, 4) を返す（テーマごとにキャッシュ）"""
+    theme = theme or LABEL_THEME
+    key = (label, theme['fontsize'], theme['color'], theme['dpi'])
+    sprite = _label_sprites.get(key)
+    if sprite is None:
+        with _label_sprites_lock:
+            sprite = _label_sprites.get(key)
+            if sprite is None:
+                sprite = _render_label_sprite(label, theme['fontsize'], theme['color'], theme['dpi'])
+                _label_sprites[key] = sprite
+    return sprite
+
+def prerender_label_sprites(theme=None):
+    """すべての感情ラベルを事前に描画しておく"""
+    for label in EMOTION_NAMES_JA.values():
+        get_label_sprite(label, theme)
+
+def _place_label_sprites(ax, angles, labels, theme=None):
+    # 極座標の外周 (r=1) の外側にラベル画像を置く。配置は目盛りラベルと同じく角度で左右上下を揃え、
+    # 長いラベルが画像の端で切れないよう、はみ出す分は内側にずらす（軸の範囲と大きさが決まってから呼ぶ）
+    fig = ax.figure
+    fig_width, fig_height = fig.bbox.width, fig.bbox.height
+    ax.apply_aspect()
+    for angle, label in zip(angles, labels):
+        sprite = get_label_sprite(label, theme)
+        height, width = sprite.shape[:2]
+        # 画面上の角度（theta_offset=π/2、時計回り）
+        phi = np.pi / 2 - angle
+        dx, dy = np.cos(phi), np.sin(phi)
+        align_x = 0.0 if dx > 0.1 else (1.0 if dx < -0.1 else 0.5)
+        align_y = 0.0 if dy > 0.1 else (1.0 if dy < -0.1 else 0.5)
+        # ラベル画像の左下（図のピクセル座標）
+        x, y = ax.transData.transform((angle, 1.0))
+        left = x + dx * LABEL_PAD_PX - align_x * width
+        bottom = y + dy * LABEL_PAD_PX - align_y * height
+        left = min(max(left, LABEL_MARGIN_PX), fig_width - LABEL_MARGIN_PX - width)
+        bottom = min(max(bottom, LABEL_MARGIN_PX), fig_height - LABEL_MARGIN_PX - height)
+        box = AnnotationBbox(
+            OffsetImage(sprite, dpi_cor=False),
+            (left, bottom),
+            xycoords='figure pixels',
+            box_alignment=(0, 0),
+            frameon=False,
+            pad=0,
+            annotation_clip=False,
+        )
+        ax.add_artist(box)
+
+# 推論結果からグラフに載せるスコアを選ぶ関数
+def prepare_chart_scores(emotion_scores):
+    """
+    neutral を除外して上位5つを選び、最大値が1.0になるようスケーリングする
+    スコアが得られなかった場合は None を返す
+    """
+    # 先にneutralを明示的に除外（大文字小文字を区別しない）
+    emotion_scores = {k: v for k, v in emotion_scores.items()
+                      if k.lower() != 'neutral'}
+    if not emotion_scores:
+        return None
+
+    # スコア上位5つを選択してスケーリング
+    top_emotions = get_top_emotions(emotion_scores, 5)
+    return scale_emotion_scores(top_emotions)
+
+# スケーリング済みスコアからグラフ画像を作る関数（レンダリングワーカーで実行される）
+def render_emotion_chart(scaled_emotions, profile='png_fast'):
+    """レーダーチャートを描画してエンコード済みの BytesIO を返す"""
+    return encode_image(render_emotion_chart_image(scaled_emotions), profile).buffer
+
+def render_emotion_chart_image(scaled_emotions):
+    """レーダーチャートを描画して PIL.Image (RGB) を返す"""
+    # 5角形グラフの生成（savefig を経由せず Agg のバッファから直接画像にする）
+    fig = create_emotion_polygon(scaled_emotions)
+    fig.set_dpi(LABEL_THEME['dpi'])
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    width, height = canvas.get_width_height()
+    img = Image.frombuffer('RGBA', (width, height), canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+    return img.convert('RGB')
+
+# グラフ作成関数を修正（動的に感情の数に対応）
+# pyplot のグローバル状態はスレッドセーフでないため Figure を直接作る
+def create_emotion_polygon(emotion_scores):
+    # データの検証
+    if not emotion_scores:
+        raise ValueError("感情スコアが空です")
+    
+    # 念のため最終確認でneutralを除外
+    emotion_scores = {k: v for k, v in emotion_scores.items() if k.lower() != 'neutral'}
+    
+    # 英語のラベルを日本語に変換
+    japanese_scores = {}
+    for eng_key, score in emotion_scores.items():
+        ja_key = EMOTION_NAMES_JA.get(eng_key)
+        if ja_key:
+            japanese_scores[ja_key] = score
+        else:
+            # 未知の感情ラベルの場合はデバッグ出力して英語のまま使用
+            japanese_scores[eng_key] = score
+            print(f"警告: 未知の感情ラベル '{eng_key}' が検出されました")
+    
+    # 日本語変換後のスコアで置き換え
+    emotion_scores = japanese_scores
+    
+    # カテゴリーの順序をランダム化する
+    items = list(emotion_scores.items())
+    random.shuffle(items)  # 順序をランダムに並べ替え
+    emotion_scores = dict(items)
+    
+    # カテゴリーとスコアを取得
+    categories = list(emotion_scores.keys())
+    values = [emotion_scores[cat] for cat in categories]
+    
+    # データ検証
+    if len(categories) < 1:
+        raise ValueError("表示する感情がありません")
+    
+    # 角度の計算 - カテゴリが1つしかない場合の特別処理
+    num_categories = len(categories)
+    if num_categories == 1:
+        # 1つだけの場合は円グラフに変更
+        fig = Figure(figsize=(12, 8))  # 16:9のアスペクト比に変更
+        ax = fig.add_subplot()
+        
+        # カスタムカラーで装飾したバー - 青系の色に変更
+        color = '#5865F2'  # Discord Blurple（Discordの青色）に変更
+        bar = ax.bar([categories[0]], [values[0]], width=0.5, color=color, alpha=0.9)
+        ax.set_ylim(0, 1.1)  # 少し余裕を持たせる
+        
+        # 枠線の色を変更
+        for spine in ax.spines.values():
+            spine.set_color('#ffffff')
+        
+        # タイトルを装飾
+        ax.set_title(f"感情分析結果: {categories[0]}", fontsize=18, color='white', fontweight='bold')
+        
+        # バーの上に値を表示
+        ax.text(0, values[0] + 0.05, f"{values[0]:.2f}", ha='center', fontsize=14, color='#7289DA')
+        
+        # グリッドを追加 - 白色で鮮明に
+        ax.yaxis.grid(True, linestyle='-', alpha=0.7, color='white', linewidth=1.5)
+        
+        # 背景色を設定
+        ax.set_facecolor('#36393F')  # 既に設定済み
+        fig.patch.set_facecolor('#36393F')  # 外枠もDiscordの背景色に
+        
+        return fig
+    
+    # 角度の計算 (n等分) とデータの繰り返し
+    angles = np.linspace(0, 2 * np.pi, num_categories, endpoint=False).tolist()
+    values += values[:1]  # 最初の値を最後にも追加して円を閉じる
+    angles += angles[:1]  # 最初の角度を最後にも追加
+
+    # 極座標プロットの設定
+    fig = Figure(figsize=(12, 9), dpi=LABEL_THEME['dpi'])
+    ax = fig.add_subplot(projection='polar')
+    
+    # 背景色とグリッドの設定
+    ax.set_facecolor('#36393F')  # Discordのダークテーマカラー
+    fig.patch.set_facecolor('#36393F')  # 外枠も同じ色に
+    
+    # 角度の設定
+    ax.set_theta_offset(np.pi / 2)
+    ax.set_theta_direction(-1)
+
+    # カスタムカラーマップを作成
+    colors = [(0.35, 0.4, 0.95, 0.7), (0.45, 0.6, 0.95, 0.8), (0.55, 0.7, 0.95, 0.9)]  # 青系グラデーション
+    cmap = LinearSegmentedColormap.from_list('custom_cmap', colors, N=256)
+    
+    # データ描画
+    line = ax.plot(angles, values, linewidth=4, linestyle='-', color='#7289DA')[0]  # データ線は青のまま、太く
+    # グラデーションカラーで塗り潰し
+    ax.fill(angles, values, alpha=0.7, color='#5865F2')  # 透明度を下げてよりはっきりと
+    
+    # マーカーを別途追加（より大きく装飾的に）
+    ax.scatter(angles[:-1], values[:-1], s=180, c='#40E0D0', alpha=1.0, 
+               edgecolors='#00BFFF', linewidth=3, zorder=10)  # サイズと線の太さを増加
+    
+    # 放射状の線を白色で太く、はっきりと設定
+    ax.grid(True, color='white', alpha=0.7, linestyle='-', linewidth=1.5)
+    
+    # 目盛りの位置だけ設定し、ラベルは最後にラベル画像で置く
+    ax.set_xticks(angles[:-1])
+    ax.set_xticklabels([])
+    
+    # 半径の範囲を設定
+    ax.set_ylim(0, 1)
+    
+    # 同心円のグリッド線をスタイリング - 白色で鮮明に
+    ax.set_rticks([0.25, 0.5, 0.75, 1.0])  # より目立つ値に調整
+    gridlines = ax.yaxis.get_gridlines()
+    for gl in gridlines:
+        gl.set_color('white')
+        gl.set_alpha(0.6)  # 透明度を下げてはっきりと
+        gl.set_linestyle('-')
+        gl.set_linewidth(1.5)  # 線を太く
+    
+    # 目盛りを非表示に設定
+    ax.set_yticklabels([])  # 数値を非表示
+    
+    # 目盛りの色（ラベルの大きさは LABEL_THEME で指定）
+    ax.tick_params(colors='white', grid_color='white')
+    
+    # 外枠を非表示
+    ax.spines['polar'].set_visible(False)
+
+    # 軸ラベルは事前に描画したラベル画像を貼り付ける（毎回のテキストレイアウトを省く）
+    _place_label_sprites(ax, angles[:-1], categories)
+    
+    return fig
@@ -0,0 +1,50 @@
+"""
+フォントの読み込みキャッシュ
+
+ImageFont.truetype の読み込みやグリフ確認は重いので、一度読んだフォントを使い回す。
+FreeType のフェイスは複数スレッドから同時に使うと安全でないため、キャッシュはスレッドごとに持つ。
+"""
+import functools
+import threading
+
+from PIL import ImageFont
+
+_local = threading.local()
+
+
+def _thread_cache() -> dict:
+    cache = getattr(_local, 'cache', None)
+    if cache is None:
+        cache = _local.cache = {}
+    return cache
+
+
+def truetype(path, size):
+    """ImageFont.truetype のキャッシュ付き版"""
+    cache = _thread_cache()
+    key = ('truetype', path, size)
+    font = cache.get(key)
+    if font is None:
+        font = cache[key] = ImageFont.truetype(path, size)
+    return font
+
+
+def per_thread(func):
+    """引数ごとに戻り値をスレッド単位でキャッシュするデコレータ（フォントローダー用）"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = _thread_cache()
+        key = (func.__module__, func.__qualname__, args, tuple(sorted(kwargs.items())))
+        try:
+            return cache[key]
+        except KeyError:
+            result = cache[key] = func(*args, **kwargs)
+            return result
+
+    return wrapper
+
+
+def clear():
+    """このスレッドのキャッシュを破棄する"""
+    _thread_cache().clear()
@@ -0,0 +1,290 @@
+"""
+送信用画像のエンコード
+
+名前付きプロファイルで PNG / WebP の保存設定をまとめて管理し、コマンドごとに使い分ける。
+エンコード後のサイズと所要時間はプロファイルごとに集計する。
+
+プロファイル:
+    png_fast      低い圧縮レベルの PNG（写真を含むめいく画像向け）
+    png_ui        256色パレットに減色した PNG（Discord 風 UI のような単色の多い画像向け）
+    webp_lossless ロスレス WebP
+    gif_anim      全フレームで共通の256色パレットを使うアニメーション GIF
+    apng          アニメーション PNG（フルカラー、GIF より大きくなりやすい）
+"""
+import io
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+from PIL import Image
+
+PROFILES = {
+    'png_fast': {
+        'format': 'PNG',
+        'extension': 'png',
+        'save': {'compress_level': 1, 'optimize': False},
+    },
+    'png_ui': {
+        'format': 'PNG',
+        'extension': 'png',
+        'quantize': 256,
+        'save': {'compress_level': 6, 'optimize': False},
+    },
+    'webp_lossless': {
+        'format': 'WEBP',
+        'extension': 'webp',
+        'save': {'lossless': True, 'quality': 50, 'method': 2},
+    },
+    'gif_anim': {
+        'format': 'GIF',
+        'extension': 'gif',
+        'animated': True,
+        'quantize': 256,
+        'save': {'loop': 0, 'disposal': 1, 'optimize': False},
+    },
+    'apng': {
+        'format': 'PNG',
+        'extension': 'png',
+        'animated': True,
+        'save': {'loop': 0, 'compress_level': 1, 'optimize': False},
+    },
+}
+
+# コマンドごとのプロファイル（環境変数 IMAGE_PROFILE_<COMMAND> で上書きできる）
+COMMAND_PROFILES = {
+    'meme': 'png_fast',
+    'meme_edit': 'png_fast',
+    'gyotaku': 'png_ui',
+    'kimochi': 'png_ui',
+    # アニメーションで出力するとき（ANIMATED_OUTPUT=1）のプロファイル
+    'animated': 'gif_anim',
+}
+DEFAULT_PROFILE = 'png_fast'
+
+
+class EncodedImage:
+    """エンコード済み画像とその統計情報"""
+
+    __slots__ = ('buffer', 'profile', 'format', 'extension', 'size', 'seconds')
+
+    def __init__(self, buffer: io.BytesIO, profile: str, seconds: float):
+        spec = PROFILES[profile]
+        self.buffer = buffer
+        self.profile = profile
+        self.format = spec['format']
+        self.extension = spec['extension']
+        self.size = buffer.getbuffer().nbytes
+        self.seconds = seconds
+
+    def filename(self, stem: str) -> str:
+        return f"{stem}.{self.extension}"
+
+    def copy(self) -> 'EncodedImage':
+        """同じ内容で別のバッファを持つ EncodedImage（複数の返信に同じ画像を添付するとき用）"""
+        return EncodedImage(io.BytesIO(self.buffer.getvalue()), self.profile, self.seconds)
+
+
+def profile_for(command: str) -> str:
+    """コマンド名から使用するプロファイル名を決める"""
+    override = os.getenv(f'IMAGE_PROFILE_{command.upper()}')
+    if override in PROFILES:
+        return override
+    return COMMAND_PROFILES.get(command, DEFAULT_PROFILE)
+
+
+_stats_lock = threading.Lock()
+_stats = defaultdict(lambda: {'count': 0, 'bytes': 0, 'seconds': 0.0})
+
+
+def encode_image(img: Image.Image, profile: str = DEFAULT_PROFILE) -> EncodedImage:
+    """
+    画像をプロファイルに従ってエンコードする
+
+    Args:
+        img: PIL 画像
+        profile: プロファイル名（PROFILES のキー）
+
+    Returns:
+        EncodedImage: buffer は seek(0) 済み
+    """
+    spec = PROFILES.get(profile)
+    if spec is None:
+        raise ValueError(f"未知のエンコードプロファイル: {profile}")
+
+    started = time.perf_counter()
+    if spec.get('quantize') and img.mode in ('RGB', 'RGBA'):
+        # FASTOCTREE(=2) はディザなしでも速く、フラットな UI 画像なら見た目はほぼ変わらない
+        img = img.quantize(colors=spec['quantize'], method=2, dither=0)
+    elif spec['format'] == 'PNG' and img.mode not in ('RGB', 'RGBA', 'L', 'P'):
+        img = img.convert('RGB')
+
+    buf = io.BytesIO()
+    img.save(buf, format=spec['format'], **spec['save'])
+    buf.seek(0)
+    encoded = EncodedImage(buf, profile, time.perf_counter() - started)
+    record_stats(encoded)
+    return encoded
+
+
+# shared_palette で減色に使う縮小画像の画素数の上限
+PALETTE_SAMPLE_PIXELS = 512 * 1024
+
+
+def shared_palette(images, colors: int = 256, max_pixels: int = PALETTE_SAMPLE_PIXELS) -> Image.Image:
+    """
+    複数の画像で共通に使うパレット画像（mode 'P'）を作る
+
+    各画像を縦横 1/4 以下に縮小して縦に並べた小さな画像から減色するので、
+    全体をつないで減色するより速く、どの画像の色もパレットに入る。
+    縮小率は縮小画像の合計が max_pixels に収まるように決めるので、画像が何枚あっても
+    サンプルの大きさは一定になる。
+    """
+    area = sum(im.width * im.height for im in images)
+    scale = min(0.25, (max_pixels / area) ** 0.5) if area else 0.25
+    thumbs = [
+        im.resize((max(1, int(im.width * scale)), max(1, int(im.height * scale))), Image.NEAREST).convert('RGB')
+        for im in images
+    ]
+    mosaic = Image.new('RGB', (max(t.width for t in thumbs), sum(t.height for t in thumbs)))
+    y = 0
+    for t in thumbs:
+        mosaic.paste(t, (0, y))
+        y += t.height
+    return mosaic.quantize(colors=colors, method=2, dither=0)
+
+
+def encode_animation(frames, profile: str) -> EncodedImage:
+    """
+    フレームの列をアニメーション画像にエンコードする
+
+    Args:
+        frames: (PIL 画像, 表示時間ミリ秒) のリスト（画像はすべて同じサイズ）
+        profile: 'animated' を持つプロファイル名
+
+    Returns:
+        EncodedImage: buffer は seek(0) 済み
+    """
+    spec = PROFILES.get(profile)
+    if spec is None or not spec.get('animated'):
+        raise ValueError(f"アニメーション用ではないプロファイル: {profile}")
+
+    started = time.perf_counter()
+    images = [im.convert('RGB') for im, _ in frames]
+    durations = [duration for _, duration in frames]
+    if spec.get('quantize'):
+        # フレームごとに減色するとパレットの計算が毎回かかり、色もちらつくので共通のパレットに合わせる
+        palette = shared_palette(images, spec['quantize'])
+        images = [im.quantize(palette=palette, dither=0) for im in images]
+
+    buf = io.BytesIO()
+    images[0].save(buf, format=spec['format'], save_all=True, append_images=images[1:],
+                   duration=durations, **spec['save'])
+    buf.seek(0)
+    encoded = EncodedImage(buf, profile, time.perf_counter() - started)
+    record_stats(encoded)
+    return encoded
+
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# IDAT チャンクにまとめて書き出す大きさ
+_IDAT_CHUNK = 256 * 1024
+
+
+def _png_chunk(out, tag: bytes, data: bytes) -> None:
+    out.write(struct.pack('>I', len(data)))
+    out.write(tag)
+    out.write(data)
+    out.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+
+def stream_png(size, bands, profile: str = DEFAULT_PROFILE, palette: Image.Image = None) -> EncodedImage:
+    """
+    横長の帯（幅は size[0]、上から順）を1本ずつ受け取りながら PNG にエンコードする
+
+    全体の画像を一度も作らないので、縦に長い画像でもメモリは帯1本分と圧縮後のデータで済む。
+
+    Args:
+        size: (幅, 高さ)。帯の高さの合計は高さと一致していること
+        bands: RGB の PIL 画像を順に返すイテラブル
+        profile: PNG のプロファイル名
+        palette: 減色するプロファイルで使うパレット画像（mode 'P'）。各帯をこのパレットに合わせる
+
+    Returns:
+        EncodedImage: buffer は seek(0) 済み
+    """
+    import numpy as np
+
+    spec = PROFILES.get(profile)
+    if spec is None or spec['format'] != 'PNG':
+        raise ValueError(f"PNG 以外のプロファイルは逐次エンコードできません: {profile}")
+    if spec.get('quantize') and palette is None:
+        raise ValueError(f"プロファイル {profile} にはパレットが必要です")
+    use_palette = bool(spec.get('quantize'))
+
+    started = time.perf_counter()
+    width, height = size
+    out = io.BytesIO()
+    out.write(_PNG_SIGNATURE)
+    color_type = 3 if use_palette else 2
+    _png_chunk(out, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))
+    if use_palette:
+        colors = palette.getpalette()[:spec['quantize'] * 3]
+        _png_chunk(out, b'PLTE', bytes(colors))
+
+    compressor = zlib.compressobj(spec['save'].get('compress_level', 6))
+    pending = bytearray()
+    previous = None
+    rows = 0
+    for band in bands:
+        if band.width != width:
+            raise ValueError(f"帯の幅が一致しません: {band.width} != {width}")
+        if use_palette:
+            # パレット画像は Pillow と同じくフィルタなし（0）で書く
+            data = np.frombuffer(band.quantize(palette=palette, dither=0).tobytes(), dtype=np.uint8)
+            data = data.reshape(band.height, width)
+            filtered = np.zeros((band.height, width + 1), dtype=np.uint8)
+            filtered[:, 1:] = data
+        else:
+            if band.mode != 'RGB':
+                band = band.convert('RGB')
+            data = np.frombuffer(band.tobytes(), dtype=np.uint8).reshape(band.height, width * 3)
+            # Up フィルタ（2）: 1行上との差分。UI のように縦に同じ色が続く画像でよく縮む
+            above = np.empty_like(data)
+            above[1:] = data[:-1]
+            above[0] = previous if previous is not None else 0
+            filtered = np.empty((band.height, width * 3 + 1), dtype=np.uint8)
+            filtered[:, 0] = 2
+            filtered[:, 1:] = data - above
+            previous = data[-1].copy()
+        rows += band.height
+        pending += compressor.compress(filtered.tobytes())
+        if len(pending) >= _IDAT_CHUNK:
+            _png_chunk(out, b'IDAT', bytes(pending))
+            pending.clear()
+    if rows != height:
+        raise ValueError(f"帯の高さの合計が一致しません: {rows} != {height}")
+    pending += compressor.flush()
+    _png_chunk(out, b'IDAT', bytes(pending))
+    _png_chunk(out, b'IEND', b'')
+    out.seek(0)
+    encoded = EncodedImage(out, profile, time.perf_counter() - started)
+    record_stats(encoded)
+    return encoded
+
+
+def record_stats(encoded: EncodedImage) -> None:
+    """エンコード結果を集計に加える（別プロセスでエンコードした結果にも使う）"""
+    with _stats_lock:
+        stat = _stats[encoded.profile]
+        stat['count'] += 1
+        stat['bytes'] += encoded.size
+        stat['seconds'] += encoded.seconds
+
+
+def encoder_stats() -> dict:
+    """プロファイルごとのエンコード回数・合計バイト数・合計時間を返す"""
+    with _stats_lock:
+        return {name: dict(stat) for name, stat in _stats.items()}
@@ -0,0 +1,226 @@
+"""
+推論サービスのクライアント
+
+環境変数 INFERENCE_SOCKET に推論デーモン（inference_server.py）の Unix ソケットが指定されていれば
+そこに問い合わせ、指定が無いか接続できなければこのプロセスでモデルを読み込んで推論する。
+同じノードで複数のボットプロセスを動かしても、モデルはデーモンの1つ分だけで済む。
+ローカルに切り替えるのはソケットが無い・接続を拒否された場合だけで、デーモンが混んでいて
+応答が遅れた場合（タイムアウト）はエラーにする（全プロセスがモデルを読み込み始めないように）。
+
+プロトコル（すべてビッグエンディアン）:
+    リクエスト: u32 本体長 | u32 request_id | u8 op | u16 件数 | (u32 長さ | UTF-8) × 件数
+    レスポンス: u32 本体長 | u32 request_id | u8 status | u16 件数 | float32 × 件数 × 列数
+                status が 1 のときは件数のかわりに u32 長さ | UTF-8 のエラーメッセージ
+    op 1 = emotion（列は EMOTION_LABELS の順の10個）、op 2 = seiteki（生スコア1個）
+"""
+import itertools
+import os
+import socket
+import struct
+import threading
+import time
+
+OP_EMOTION = 1
+OP_SEITEKI = 2
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+EMOTION_LABELS = ('amaze', 'anger', 'dislike', 'excite', 'fear', 'joy', 'like', 'relief', 'sad', 'shame')
+OP_COLUMNS = {OP_EMOTION: len(EMOTION_LABELS), OP_SEITEKI: 1}
+
+_LEN = struct.Struct('>I')
+_REQ_HEAD = struct.Struct('>IBH')
+_RES_HEAD = struct.Struct('>IBH')
+
+# デーモンに接続できなかったとき、次に試すまでの秒数
+RETRY_SECONDS = 30
+
+
+def encode_request(request_id: int, op: int, texts) -> bytes:
+    parts = [_REQ_HEAD.pack(request_id, op, len(texts))]
+    for text in texts:
+        data = text.encode('utf-8')
+        parts.append(_LEN.pack(len(data)))
+        parts.append(data)
+    body = b''.join(parts)
+    return _LEN.pack(len(body)) + body
+
+
+def decode_request(body: bytes):
+    request_id, op, count = _REQ_HEAD.unpack_from(body)
+    offset = _REQ_HEAD.size
+    texts = []
+    for _ in range(count):
+        (length,) = _LEN.unpack_from(body, offset)
+        offset += _LEN.size
+        texts.append(body[offset:offset + length].decode('utf-8'))
+        offset += length
+    return request_id, op, texts
+
+
+def encode_response(request_id: int, op: int, rows) -> bytes:
+    columns = OP_COLUMNS[op]
+    values = [v for row in rows for v in row]
+    body = _RES_HEAD.pack(request_id, STATUS_OK, len(rows)) + struct.pack(f'>{len(values)}f', *values)
+    assert len(values) == len(rows) * columns
+    return _LEN.pack(len(body)) + body
+
+
+def encode_error(request_id: int, message: str) -> bytes:
+    data = message.encode('utf-8')
+    body = _RES_HEAD.pack(request_id, STATUS_ERROR, 0) + _LEN.pack(len(data)) + data
+    return _LEN.pack(len(body)) + body
+
+
+def decode_response(body: bytes, op: int):
+    request_id, status, count = _RES_HEAD.unpack_from(body)
+    offset = _RES_HEAD.size
+    if status != STATUS_OK:
+        (length,) = _LEN.unpack_from(body, offset)
+        raise RuntimeError(body[offset + _LEN.size:offset + _LEN.size + length].decode('utf-8'))
+    columns = OP_COLUMNS[op]
+    values = struct.unpack_from(f'>{count * columns}f', body, offset)
+    return request_id, [values[i * columns:(i + 1) * columns] for i in range(count)]
+
+
+def _recv_exact(sock, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('推論サービスとの接続が切れました')
+        buf += chunk
+    return bytes(buf)
+
+
+class InferenceClient:
+    """
+    推論デーモンのクライアント（ブロッキング）
+
+    スケジューラのワーカースレッドから呼ばれるので、接続はスレッドごとに持つ。
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def request(self, op: int, texts):
+        request_id = next(self._ids) & 0xffffffff
+        reused = getattr(self._local, 'sock', None) is not None
+        # 接続できなければ OSError をそのまま送る（呼び出し側でローカルの推論に切り替えるか決める）
+        sock = self._connection()
+        try:
+            sock.sendall(encode_request(request_id, op, texts))
+            (length,) = _LEN.unpack(_recv_exact(sock, _LEN.size))
+            body = _recv_exact(sock, length)
+        except socket.timeout as e:
+            self._close()
+            raise TimeoutError(f'推論サービスが {self.timeout:g} 秒以内に応答しませんでした') from e
+        except OSError:
+            self._close()
+            if reused:
+                # デーモンの再起動などで切れていた接続を使い回した場合は、つなぎ直して1回だけ送り直す
+                return self.request(op, texts)
+            raise
+        got_id, rows = decode_response(body, op)
+        if got_id != request_id:
+            self._close()
+            raise ConnectionError('推論サービスの応答が要求と一致しません')
+        return rows
+
+
+_client = None
+_client_lock = threading.Lock()
+_remote_down_until = 0.0
+
+
+def get_client():
+    """
+    INFERENCE_SOCKET が指定されていればデーモンのクライアントを返す（指定が無ければ None）
+
+    .env はボットの起動処理で読み込まれるので、import 時ではなく最初に使うときに環境変数を読む。
+    """
+    global _client
+    if _client is None:
+        path = os.getenv('INFERENCE_SOCKET')
+        if not path:
+            return None
+        with _client_lock:
+            if _client is None:
+                _client = InferenceClient(path)
+    return _client
+
+
+def _remote(op: int, texts):
+    """デーモンに問い合わせる。使えなければ None（ローカルで推論する）"""
+    global _remote_down_until
+    client = get_client()
+    if client is None or time.monotonic() < _remote_down_until:
+        return None
+    try:
+        return client.request(op, texts)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        # デーモンが動いていない場合だけローカルで推論する（タイムアウトなどはそのままエラーにする）
+        _remote_down_until = time.monotonic() + RETRY_SECONDS
+        print(f"推論サービスに接続できないため、このプロセスで推論します: {e}")
+        return None
+
+
+def get_emotion_scores_batch(texts):
+    rows = _remote(OP_EMOTION, list(texts))
+    if rows is None:
+        import emotion
+        return emotion.get_emotion_scores_batch(texts)
+    return [dict(zip(EMOTION_LABELS, row)) for row in rows]
+
+
+def get_emotion_scores(text):
+    return get_emotion_scores_batch([text])[0]
+
+
+def sexual_scores_batch(texts):
+    rows = _remote(OP_SEITEKI, list(texts))
+    if rows is None:
+        import seiteki
+        return seiteki.sexual_scores_batch(texts)
+    return [row[0] for row in rows]
+
+
+def classify_sexual_content(text: str) -> int:
+    from seiteki import score_to_level
+    return score_to_level(sexual_scores_batch([text])[0])
+
+
+def uses_remote() -> bool:
+    return get_client() is not None
+
+
+def preload():
+    """デーモンを使わない場合だけ、このプロセスにモデルを読み込む"""
+    if get_client() is not None:
+        return
+    import emotion
+    import seiteki
+    emotion.preload()
+    seiteki.preload()
@@ -0,0 +1,181 @@
+"""
+推論デーモン
+
+emotion / seiteki のモデルを1つずつだけ読み込み、Unix ドメインソケットで複数のボットプロセスからの
+リクエストを受け付ける。短い待ち時間（INFERENCE_BATCH_WINDOW_MS）の間に届いたリクエストは
+プロセスをまたいでひとつのバッチにまとめて推論する。プロトコルは inference_client を参照。
+
+環境変数:
+    INFERENCE_SOCKET            ソケットのパス（既定: /tmp/emotionbot-inference.sock）
+    INFERENCE_MAX_BATCH         1回の推論にまとめる最大件数（既定: 32）
+    INFERENCE_BATCH_WINDOW_MS   バッチを集める待ち時間（既定: 5）
+    INFERENCE_METRICS_PORT      メトリクスのポート（ボットの METRICS_PORT とは別に指定する。
+                                INFERENCE_METRICS_HOST / INFERENCE_METRICS_JSON_PATH も同様）
+
+使い方:
+    python inference_server.py
+    INFERENCE_SOCKET=/run/emotionbot/inference.sock python bot.py   # クライアント側
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import metrics
+from inference_client import (
+    EMOTION_LABELS,
+    OP_EMOTION,
+    OP_SEITEKI,
+    decode_request,
+    encode_error,
+    encode_response,
+)
+
+DEFAULT_SOCKET = '/tmp/emotionbot-inference.sock'
+
+
+def _run_emotion(texts):
+    import emotion
+    return [[scores[label] for label in EMOTION_LABELS] for scores in emotion.get_emotion_scores_batch(texts)]
+
+
+def _run_seiteki(texts):
+    import seiteki
+    return [[score] for score in seiteki.sexual_scores_batch(texts)]
+
+
+MODEL_RUNNERS = {
+    OP_EMOTION: _run_emotion,
+    OP_SEITEKI: _run_seiteki,
+}
+
+
+class Batcher:
+    """
+    op ごとにリクエストを集めてまとめて推論する
+
+    最初のリクエストが届いてから window 秒待つか、max_batch 件たまった時点で推論する。
+    推論は専用スレッド1本で順番に行う（モデルは1組だけなので並列にしても速くならない）。
+    """
+
+    def __init__(self, op, runner, executor, max_batch=32, window=0.005):
+        self.op = op
+        self.runner = runner
+        self.executor = executor
+        self.max_batch = max_batch
+        self.window = window
+        self._queue = asyncio.Queue()
+        self.batches = 0
+        self.texts = 0
+
+    async def submit(self, texts):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((texts, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            size = len(pending[0][0])
+            deadline = loop.time() + self.window
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            texts = [t for item, _ in pending for t in item]
+            started = time.perf_counter()
+            try:
+                rows = await loop.run_in_executor(self.executor, self.runner, texts)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            metrics.observe('inference_batch', time.perf_counter() - started, op=str(self.op))
+            self.batches += 1
+            self.texts += len(texts)
+            offset = 0
+            for item, future in pending:
+                if not future.done():
+                    future.set_result(rows[offset:offset + len(item)])
+                offset += len(item)
+
+
+class InferenceServer:
+    def __init__(self, path, max_batch=32, window=0.005):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+        self.batchers = {op: Batcher(op, runner, self.executor, max_batch, window) for op, runner in MODEL_RUNNERS.items()}
+        self.connections = 0
+        self._tasks = []
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(4)
+                except asyncio.IncompleteReadError:
+                    break
+                body = await reader.readexactly(int.from_bytes(header, 'big'))
+                request_id, op, texts = decode_request(body)
+                batcher = self.batchers.get(op)
+                if batcher is None:
+                    writer.write(encode_error(request_id, f'unknown op {op}'))
+                else:
+                    try:
+                        rows = await batcher.submit(texts)
+                        writer.write(encode_response(request_id, op, rows))
+                    except Exception as e:
+                        writer.write(encode_error(request_id, str(e)))
+                await writer.drain()
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            **{f'op{op}': {'batches': b.batches, 'texts': b.texts} for op, b in self.batchers.items()},
+        }
+
+    async def serve(self):
+        # モデルを先に読み込んでから受け付けを始める
+        loop = asyncio.get_running_loop()
+        for runner in MODEL_RUNNERS.values():
+            await loop.run_in_executor(self.executor, runner, ['warm up'])
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o660)
+        self._tasks = [loop.create_task(batcher.run()) for batcher in self.batchers.values()]
+        metrics.register_collector('inference_server', self.stats)
+        # 同じホストのボットと METRICS_PORT がぶつからないよう、デーモン用の環境変数で開く
+        await metrics.start_exporter('INFERENCE_METRICS')
+        print(f"推論サービスを開始しました: {self.path}")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    load_dotenv()
+    server = InferenceServer(
+        os.getenv('INFERENCE_SOCKET', DEFAULT_SOCKET),
+        max_batch=int(os.getenv('INFERENCE_MAX_BATCH', '32')),
+        window=float(os.getenv('INFERENCE_BATCH_WINDOW_MS', '5')) / 1000,
+    )
+    asyncio.run(server.serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+「きもい」コマンドの返信画像
+
+kimoi/0.png 〜 kimoi/4.png を一度だけ読み込み（起動後のウォームアップか初回利用時）、変更不可のテーブルとして保持する。
+パスはこのモジュールからの相対で解決するので、カレントディレクトリに依存しない。
+環境変数 KIMOI_PROFILE に image_encoder のプロファイル名を指定すると、読み込み時に再エンコードする。
+"""
+import io
+import os
+import threading
+from types import MappingProxyType
+from typing import Optional, Tuple
+
+KIMOI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kimoi')
+KIMOI_SCORES = range(5)
+
+
+def _load_table(profile: Optional[str] = None):
+    table = {}
+    for score in KIMOI_SCORES:
+        path = os.path.join(KIMOI_DIR, f'{score}.png')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            print(f"きもい画像の読み込みに失敗: {path}: {e}")
+            continue
+
+        filename = f'{score}.png'
+        if profile:
+            try:
+                from PIL import Image
+                from image_encoder import encode_image
+                with Image.open(io.BytesIO(data)) as im:
+                    im.load()
+                    encoded = encode_image(im, profile)
+                data = encoded.buffer.getvalue()
+                filename = encoded.filename(str(score))
+            except Exception as e:
+                print(f"きもい画像の再エンコードに失敗（元の画像を使用）: {path}: {e}")
+        table[score] = (data, filename)
+    return MappingProxyType(table)
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def preload():
+    """画像のテーブルを読み込む（KIMOI_PROFILE は .env を読み込んだ後のこの時点で参照する）"""
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                _table = _load_table(os.getenv('KIMOI_PROFILE') or None)
+    return _table
+
+
+def open_kimoi_image(score: int) -> Optional[Tuple[io.BytesIO, str]]:
+    """
+    スコアに対応する画像を返す
+
+    Returns:
+        (BytesIO, ファイル名)。画像が無ければ None。
+        BytesIO は共有の bytes を参照するだけなので返信ごとに新しく作ってよい。
+    """
+    entry = preload().get(score)
+    if entry is None:
+        return None
+    data, filename = entry
+    return io.BytesIO(data), filename
@@ -0,0 +1,153 @@
+"""
+シャード分割で複数プロセスを起動するランチャー
+
+Discord のシャードを SHARD_PROCESSES 個のグループに分け、グループごとに bot.py を別プロセスで起動する。
+各プロセスは AutoShardedBot として担当のシャードだけに接続し、描画ワーカーや推論モデルを個別に持つ。
+異常終了したプロセスはバックオフを入れながら再起動する。
+
+環境変数（.env でも可）:
+    SHARD_COUNT           全体のシャード数。auto なら Discord の推奨値（既定: auto）
+    SHARD_PROCESSES       起動するプロセス数（既定: CPU コア数とシャード数の小さい方）
+    SHARD_RENDER_PROCESSES  各プロセスの RENDER_PROCESSES（既定: 0）
+    SHARD_TORCH_THREADS   各プロセスの推論スレッド数 OMP_NUM_THREADS（既定: コア数 / プロセス数）
+
+METRICS_PORT を指定した場合、プロセスごとに METRICS_PORT + 番号 のポートを使う。
+
+使い方:
+    python launcher.py
+    SHARD_COUNT=8 SHARD_PROCESSES=4 python launcher.py
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+# 再起動のバックオフ（秒）。安定して動いた後はリセットする
+RESTART_BACKOFF = (1, 5, 15, 60)
+STABLE_SECONDS = 300
+
+
+def recommended_shards(token: str) -> int:
+    """Discord の /gateway/bot から推奨シャード数を取得する"""
+    req = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {token}', 'User-Agent': 'DiscordBot (launcher, 1.0)'},
+    )
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return int(json.load(resp)['shards'])
+
+
+def shard_groups(shard_count: int, processes: int):
+    """シャードIDをプロセスごとに振り分ける（0,4,8 / 1,5,9 ... のように交互に）"""
+    return [list(range(i, shard_count, processes)) for i in range(processes)]
+
+
+class ShardProcess:
+    def __init__(self, index: int, shard_ids, shard_count: int, env: dict):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.env = env
+        self.env['SHARD_COUNT'] = str(shard_count)
+        self.env['SHARD_IDS'] = ','.join(map(str, shard_ids))
+        self.proc = None
+        self.started_at = 0.0
+        self.failures = 0
+        self.restart_at = 0.0
+
+    def start(self):
+        self.proc = subprocess.Popen([sys.executable, BOT_PATH], env=self.env)
+        self.started_at = time.monotonic()
+        print(f"[launcher] プロセス {self.index}（シャード {self.shard_ids}）を起動しました: pid {self.proc.pid}")
+
+    def poll(self, now: float):
+        """終了していれば再起動を予約し、予約時刻になったら再起動する"""
+        if self.proc is not None:
+            code = self.proc.poll()
+            if code is None:
+                return
+            self.proc = None
+            if now - self.started_at >= STABLE_SECONDS:
+                self.failures = 0
+            delay = RESTART_BACKOFF[min(self.failures, len(RESTART_BACKOFF) - 1)]
+            self.failures += 1
+            self.restart_at = now + delay
+            print(f"[launcher] プロセス {self.index} が終了しました（code {code}）。{delay} 秒後に再起動します")
+        elif now >= self.restart_at:
+            self.start()
+
+    def terminate(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+    def wait(self, timeout: float):
+        if self.proc is None:
+            return
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def build_processes():
+    load_dotenv()
+    cores = os.cpu_count() or 1
+    shard_count = os.getenv('SHARD_COUNT', 'auto')
+    if shard_count == 'auto':
+        shard_count = recommended_shards(os.getenv('DISCORD_TOKEN'))
+    shard_count = int(shard_count)
+    processes = int(os.getenv('SHARD_PROCESSES', str(min(cores, shard_count))))
+    processes = max(1, min(processes, shard_count))
+    torch_threads = os.getenv('SHARD_TORCH_THREADS', str(max(1, cores // processes)))
+
+    base_port = os.getenv('METRICS_PORT')
+    json_path = os.getenv('METRICS_JSON_PATH')
+    children = []
+    for index, shard_ids in enumerate(shard_groups(shard_count, processes)):
+        env = dict(os.environ)
+        env['RENDER_PROCESSES'] = os.getenv('SHARD_RENDER_PROCESSES', env.get('RENDER_PROCESSES', '0'))
+        env['OMP_NUM_THREADS'] = torch_threads
+        if base_port:
+            env['METRICS_PORT'] = str(int(base_port) + index)
+        if json_path:
+            root, ext = os.path.splitext(json_path)
+            env['METRICS_JSON_PATH'] = f'{root}.{index}{ext}'
+        children.append(ShardProcess(index, shard_ids, shard_count, env))
+    print(f"[launcher] シャード {shard_count} 個を {processes} プロセスで起動します")
+    return children
+
+
+def main():
+    children = build_processes()
+    stopping = False
+
+    def stop(signum, _frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for child in children:
+        child.start()
+    while not stopping:
+        now = time.monotonic()
+        for child in children:
+            child.poll(now)
+        time.sleep(1)
+
+    print("[launcher] 停止します")
+    for child in children:
+        child.terminate()
+    for child in children:
+        child.wait(30)
+
+
+if __name__ == '__main__':
+    main()
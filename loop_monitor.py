@@ -0,0 +1,169 @@
+"""
+イベントループの遅延監視
+
+ループ上のハートビート（interval 秒ごと）で予定時刻からの遅れを計測し、metrics の 'loop_lag' に記録する。
+別スレッドのウォッチドッグがハートビートの途絶を見張り、threshold 秒以上ループが止まっていたら
+ループスレッドのスタックを sys._current_frames() で1回だけ採取してログに出す。
+（ブロックしている最中に採取するので、同期的な推論や Pillow の処理をしている行がそのまま分かる）
+
+どちらも interval ごとに数マイクロ秒の処理なので本番で常時有効にしておける。
+asyncio のデバッグモード（slow callback の警告）は set_debug() で実行中に切り替えられる。
+
+環境変数:
+    LOOP_MONITOR=0               監視を無効にする
+    LOOP_MONITOR_INTERVAL=0.1    ハートビートの間隔（秒）
+    LOOP_STALL_THRESHOLD=0.25    スタックを採取する停止時間（秒）
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+# スタックを表示するときに残すフレーム数（内側から）
+STACK_DEPTH = 12
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self.loop = None
+        self._loop_thread_id = None
+        self._last_beat = 0.0
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        # 統計
+        self.beats = 0
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.last_stall = None  # {'seconds', 'handler', 'stack', 'time'}
+
+    # ---- ループ側 ----
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.beats += 1
+            if lag > self.max_lag:
+                self.max_lag = lag
+            metrics.observe('loop_lag', lag)
+
+    # ---- ウォッチドッグスレッド ----
+    def _watch(self):
+        reported = False
+        while not self._stopped.wait(self.interval):
+            stalled = time.monotonic() - self._last_beat - self.interval
+            if stalled < self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+            # 1回の停止につき1回だけ採取する
+            reported = True
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            self._report_stall(stalled, stack)
+
+    def _report_stall(self, stalled, stack):
+        self.stalls += 1
+        handler = _find_handler(stack)
+        lines = traceback.format_list(stack[-STACK_DEPTH:])
+        self.last_stall = {
+            'seconds': stalled,
+            'handler': handler,
+            'stack': ''.join(lines),
+            'time': time.time(),
+        }
+        print(f"[ループ監視] イベントループが {stalled:.2f}s 以上停止しています（{handler}）\n" + ''.join(lines), end='')
+
+    # ---- 公開 API ----
+    def start(self, loop=None):
+        """実行中のループで監視を始める（2回目以降は何もしない）"""
+        if self._task is not None:
+            return
+        self.loop = loop or asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = self.loop.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+        print(f"[ループ監視] 開始（間隔 {self.interval}s, 停止検出 {self.threshold}s）")
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def set_debug(self, enabled: bool, slow_callback: float = None):
+        """asyncio のデバッグモードを切り替える（slow_callback 秒以上のコールバックを警告する）"""
+        if self.loop is None:
+            raise RuntimeError('監視が開始されていません')
+        if slow_callback is not None:
+            self.loop.slow_callback_duration = slow_callback
+        self.loop.set_debug(enabled)
+
+    def stats(self) -> dict:
+        return {
+            'beats': self.beats,
+            'stalls': self.stalls,
+            'max_lag_seconds': self.max_lag,
+            'debug': bool(self.loop and self.loop.get_debug()),
+            'slow_callback_seconds': self.loop.slow_callback_duration if self.loop else None,
+            'last_stall_seconds': self.last_stall['seconds'] if self.last_stall else 0.0,
+            'last_stall_handler': self.last_stall['handler'] if self.last_stall else None,
+        }
+
+
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _find_handler(stack):
+    """スタックから原因のハンドラ名を推定する（bot.py の最も内側のフレーム、なければリポジトリ内の最も内側）"""
+    own = [e for e in stack if e.filename.startswith(_REPO_DIR) and not e.filename.endswith('loop_monitor.py')]
+    handlers = [e for e in own if os.path.basename(e.filename) == 'bot.py']
+    entry = (handlers or own or stack or [None])[-1]
+    if entry is None:
+        return 'unknown'
+    return f"{os.path.basename(entry.filename)}:{entry.name}"
+
+
+_monitor = None
+
+
+def get_monitor() -> LoopMonitor:
+    """プロセスで共有する LoopMonitor（.env を読み込んだ後に設定を読むよう、最初に使うときに作る）"""
+    global _monitor
+    if _monitor is None:
+        _monitor = LoopMonitor(
+            interval=float(os.getenv('LOOP_MONITOR_INTERVAL', '0.1')),
+            threshold=float(os.getenv('LOOP_STALL_THRESHOLD', '0.25')),
+        )
+    return _monitor
+
+
+metrics.register_collector('loop', lambda: get_monitor().stats())
+
+
+def running():
+    """監視を開始していればその LoopMonitor を返す（LOOP_MONITOR=0 などで開始していなければ None）"""
+    if _monitor is None or _monitor.loop is None:
+        return None
+    return _monitor
+
+
+def start():
+    """環境変数 LOOP_MONITOR=0 でなければ監視を始める"""
+    if os.getenv('LOOP_MONITOR', '1') != '0':
+        get_monitor().start()
@@ -1,10 +1,16 @@
 from PIL import Image, ImageDraw, ImageFont
 import io
 import os
-import colorsys
+import functools
 from typing import Optional, Tuple
 
+import animation
+import font_cache
+import text_layout
+from image_encoder import encode_image
 
+
+@font_cache.per_thread
 def _load_font(size, weight='Regular'):
     """フォントを読み込む"""
     repo_dir = os.path.dirname(__file__)
@@ -30,82 +36,282 @@ def _load_font(size, weight='Regular'):
     return ImageFont.load_default()
 
 
-def create_rainbow_gradient(text: str, start_hue: float = 0.0) -> list:
+# 自動調整するフォントサイズの範囲
+AUTO_FIT_MIN_SIZE = 24
+AUTO_FIT_MAX_SIZE = 120
+
+
+def _line_height(font_size):
+    return font_size + 20
+
+
+def _meme_font(font_name, size):
+    """めいくのフォント名とサイズからフォントを読み込む"""
+    repo_dir = os.path.dirname(__file__)
+
+    # フォント名に応じてパスを選択
+    if font_name == 'noto':
+        font_path = os.path.join(repo_dir, 'NotoSansCJKjp-Regular.ttf')
+    elif font_name == 'gg-sans':
+        font_path = os.path.join(repo_dir, 'gg-sans-2', 'gg sans Bold.ttf')
+    else:
+        # デフォルト（自動選択）
+        return _load_font(size, 'Bold')
+
+    if os.path.exists(font_path):
+        try:
+            return font_cache.truetype(font_path, size)
+        except Exception:
+            pass
+    return _load_font(size, 'Bold')
+
+
+@functools.lru_cache(maxsize=256)
+def fit_font_size(text: str, font_name: str, max_width: int, max_height: int) -> int:
     """
-    文字ごとに虹色のグラデーションカラーを生成
+    折り返した行が max_width × max_height に収まる最大のフォントサイズを二分探索で求める
+
+    フォントはサイズごとにキャッシュされ、文字の送り幅もフォントごとに text_layout が
+    キャッシュするので、1回の探索は数回の折り返し計算で済む。結果もテキストごとに覚えておく
+    （編集ボタンで色やレイアウトだけ変えたときは探索し直さない）。
+
+    Args:
+        text: 表示するテキスト
+        font_name: フォント名（'default', 'noto', 'gg-sans'）
+        max_width: テキスト領域の幅
+        max_height: テキスト領域の高さ
+
+    Returns:
+        int: フォントサイズ（最小サイズでも収まらない場合は AUTO_FIT_MIN_SIZE）
+    """
+    lo, hi = AUTO_FIT_MIN_SIZE, AUTO_FIT_MAX_SIZE
+    best = AUTO_FIT_MIN_SIZE
+    while lo <= hi:
+        size = (lo + hi) // 2
+        font = _meme_font(font_name, size)
+        lines = text_layout.wrap_text(text, font, max_width)
+        fits = (
+            _line_height(size) * len(lines) <= max_height
+            and all(text_layout.text_width(line, font) <= max_width for line in lines)
+        )
+        if fits:
+            best = size
+            lo = size + 1
+        else:
+            hi = size - 1
+    return best
+
+
+# 虹色テキストの彩度・明度と影
+RAINBOW_SATURATION = 0.9
+RAINBOW_VALUE = 0.95
+SHADOW_OFFSET = 3
+SHADOW_ALPHA = 180
+
+
+def _hsv_to_rgb(hue, saturation: float, value: float):
+    """色相の配列（0.0-1.0）を RGB の uint8 配列 (N, 3) にする（colorsys.hsv_to_rgb のベクトル版）"""
+    import numpy as np
+
+    h6 = (np.asarray(hue, dtype=np.float64) % 1.0) * 6.0
+    sector = h6.astype(np.int64) % 6
+    f = h6 - np.floor(h6)
+    v = np.full_like(f, value)
+    p = np.full_like(f, value * (1.0 - saturation))
+    q = value * (1.0 - saturation * f)
+    t = value * (1.0 - saturation * (1.0 - f))
+    # sector ごとの (r, g, b) の組み合わせ
+    r = np.choose(sector, (v, q, p, p, t, v))
+    g = np.choose(sector, (t, v, v, q, p, p))
+    b = np.choose(sector, (p, p, t, v, v, q))
+    return (np.stack((r, g, b), axis=-1) * 255).astype(np.uint8)
+
+
+def rainbow_row(text: str, font, left: int, right: int, start_hue: float = 0.0, smooth: bool = False):
+    """
+    1行分の虹色グラデーション（列ごとの RGB）を作る
 
     Args:
         text: テキスト
+        font: フォント（文字ごとの色の境界を送り幅から求める）
+        left, right: 描画原点からの列の範囲
         start_hue: 開始色相（0.0-1.0）
+        smooth: True なら列ごとに連続的に色相を変え、False なら従来どおり文字ごとに1色にする
 
     Returns:
-        list of RGB tuples
+        numpy.ndarray: uint8 の (right - left, 3)
     """
-    colors = []
-    text_len = len(text)
+    import numpy as np
+
+    columns = np.arange(left, right)
+    if smooth or not text:
+        hues = start_hue + np.clip(columns, 0, None) / max(text_layout.text_width(text, font), 1)
+    else:
+        # 列がどの文字に属するかを累積の送り幅から求め、文字の位置で色相を決める
+        edges = np.cumsum([text_layout.char_advance(font, ch) for ch in text])
+        index = np.minimum(np.searchsorted(edges, columns, side='right'), len(text) - 1)
+        hues = start_hue + index / len(text)
+    return _hsv_to_rgb(hues, RAINBOW_SATURATION, RAINBOW_VALUE)
 
-    for i, char in enumerate(text):
-        # 文字位置に応じて色相を変化させる
-        hue = (start_hue + (i / max(text_len, 1))) % 1.0
-        saturation = 0.9
-        value = 0.95
 
-        # HSVからRGBに変換
-        r, g, b = colorsys.hsv_to_rgb(hue, saturation, value)
-        colors.append((int(r * 255), int(g * 255), int(b * 255)))
+@functools.lru_cache(maxsize=64)
+def _line_mask(text: str, font) -> Tuple[Image.Image, int]:
+    """
+    1行をアルファマスクに描いて (マスク, 左の余白) を返す
 
-    return colors
+    幅はキャッシュした送り幅と行の高さから決めるので、textbbox でレイアウトし直さない。
+    はみ出すグリフ（斜体やjなど）のために左右に余白を取る。編集ボタンで色やレイアウトだけ
+    変えて描き直すときは、同じ行のマスクを使い回す（マスクは読み取り専用で扱う）。
+    """
+    ascent, descent = font.getmetrics()
+    pad = max(2, font.size // 4)
+    width = int(text_layout.text_width(text, font)) + pad * 2
+    mask = Image.new('L', (width, ascent + descent + pad), 0)
+    ImageDraw.Draw(mask).text((pad, 0), text, font=font, fill=255)
+    return mask, pad
 
 
 def draw_text_with_rainbow(
-    draw: ImageDraw.Draw,
+    img: Image.Image,
     position: Tuple[int, int],
     text: str,
     font: ImageFont.FreeTypeFont,
-    start_hue: float = 0.0
+    start_hue: float = 0.0,
+    smooth: bool = False
 ) -> int:
     """
     虹色のテキストを描画
 
+    行を一度だけアルファマスクに描き、影は同じマスクをずらして1回、本体は横方向の
+    グラデーション画像をマスク越しに1回貼り付ける。
+
     Args:
-        draw: ImageDraw オブジェクト
+        img: 描画先の画像（RGB）
         position: 描画位置 (x, y)
         text: テキスト
         font: フォント
         start_hue: 開始色相
+        smooth: 文字ごとではなく滑らかなグラデーションにするか
 
     Returns:
         描画後のx座標
     """
+    import numpy as np
+
     x, y = position
-    colors = create_rainbow_gradient(text, start_hue)
+    if not text:
+        return x
+    mask, pad = _line_mask(text, font)
+    x0 = x - pad
 
-    for char, color in zip(text, colors):
-        # 影を描画（より目立たせる）
-        shadow_offset = 3
-        draw.text((x + shadow_offset, y + shadow_offset), char, font=font, fill=(0, 0, 0, 180))
+    shadow = mask.point(lambda a: a * SHADOW_ALPHA // 255)
+    img.paste((0, 0, 0), (x0 + SHADOW_OFFSET, y + SHADOW_OFFSET), shadow)
 
-        # メインテキストを描画
-        draw.text((x, y), char, font=font, fill=color)
+    row = rainbow_row(text, font, -pad, mask.width - pad, start_hue, smooth)
+    gradient = Image.fromarray(np.ascontiguousarray(np.broadcast_to(row, (mask.height,) + row.shape)), 'RGB')
+    img.paste(gradient, (x0, y), mask)
 
-        # 次の文字の位置を計算
-        bbox = draw.textbbox((0, 0), char, font=font)
-        char_width = bbox[2] - bbox[0]
-        x += char_width
+    return x + int(text_layout.text_width(text, font))
 
-    return x
+
+@functools.lru_cache(maxsize=8)
+def _avatar_mask(width: int, height: int, swap_layout: bool) -> Image.Image:
+    """
+    アバター画像を背景に合成するための斜めのグラデーションマスク（サイズとレイアウトごとに一度だけ作る）
+
+    画像:テキスト = 1:3 の割合で、左側配置なら左25%、右側配置なら右25%が画像になる。
+    各ピクセルの値は以前の1ピクセルずつの計算と同じ式を numpy で一度に求める。
+    """
+    import numpy as np
+
+    # グラデーションの幅（ぼかしの範囲）
+    gradient_width = 150
+    # 画像領域の境界: 右側配置なら 75%、左側配置なら 25%
+    gradient_start = int(width * 0.75) if swap_layout else int(width * 0.25)
+
+    # 斜めの距離を計算（y座標で少し傾ける）
+    xs = np.arange(width)[np.newaxis, :]
+    diagonal_offset = (np.arange(height) * 0.2).astype(np.int64)[:, np.newaxis]
+    if swap_layout:
+        # 右側の場合は右から左へ
+        adjusted_x = xs + diagonal_offset
+        ratio = (adjusted_x - gradient_start) / gradient_width
+        alpha = np.where(adjusted_x > gradient_start + gradient_width, 255,
+                         np.where(adjusted_x > gradient_start, (255 * ratio).astype(np.int64), 0))
+    else:
+        # 左側の場合は左から右へ
+        adjusted_x = xs - diagonal_offset
+        ratio = (gradient_start - adjusted_x) / gradient_width
+        alpha = np.where(adjusted_x < gradient_start - gradient_width, 255,
+                         np.where(adjusted_x < gradient_start, (255 * ratio).astype(np.int64), 0))
+    return Image.fromarray(alpha.astype(np.uint8), 'L')
 
 
 def generate_meme_image(
     text: str,
     bg_color: str = 'black',
     rainbow_text: bool = False,
-    font_size: int = 60,
+    font_size: Optional[int] = None,
     swap_layout: bool = False,
     author_name: str = '',
     font_name: str = 'default',
-    avatar_image: bytes = None
+    avatar_image: bytes = None,
+    rainbow_smooth: bool = False,
+    profile: str = 'png_fast'
 ) -> io.BytesIO:
+    """
+    ミーム画像を生成してエンコードする
+
+    引数は render_meme_image と同じ。profile は image_encoder のプロファイル名。
+
+    Returns:
+        BytesIO: エンコード済み画像データ
+    """
+    img = render_meme_image(
+        text=text,
+        bg_color=bg_color,
+        rainbow_text=rainbow_text,
+        font_size=font_size,
+        swap_layout=swap_layout,
+        author_name=author_name,
+        font_name=font_name,
+        avatar_image=avatar_image,
+        rainbow_smooth=rainbow_smooth,
+    )
+    return encode_image(img, profile).buffer
+
+
+def encode_meme(profile: str = 'png_fast', animate: Optional[str] = None, **kwargs):
+    """
+    ミーム画像を生成して EncodedImage を返す（引数は render_meme_image と同じ）
+
+    animate にアニメーション用のプロファイル名を渡すと、アバターがアニメーションしていれば
+    フレームごとに描いたアニメーション画像にする。アバターが静止画の場合や、フレーム数・時間・
+    サイズの上限を超えた場合は profile の静止画になる。
+    """
+    # 背景は高さ 720 に引き伸ばすので、フレームはそれ以上の大きさでデコードしない
+    frames = animation.decode(kwargs.get('avatar_image'), 720) if animate else None
+    if frames is not None:
+        def render_frame(indices):
+            return render_meme_image(**{**kwargs, 'avatar_image': frames.images[indices[0]]})
+
+        encoded = animation.animate([frames], render_frame, animate)
+        if encoded is not None:
+            return encoded
+    return encode_image(render_meme_image(**kwargs), profile)
+
+
+def render_meme_image(
+    text: str,
+    bg_color: str = 'black',
+    rainbow_text: bool = False,
+    font_size: Optional[int] = None,
+    swap_layout: bool = False,
+    author_name: str = '',
+    font_name: str = 'default',
+    avatar_image: bytes = None,
+    rainbow_smooth: bool = False
+) -> Image.Image:
     """
     ミーム画像を生成
 
@@ -113,14 +319,15 @@ def generate_meme_image(
         text: 表示するテキスト
         bg_color: 背景色 ('black' or 'white')
         rainbow_text: 虹色テキストを使用するか
-        font_size: フォントサイズ
+        font_size: フォントサイズ（None ならテキスト領域に収まる最大のサイズ）
         swap_layout: レイアウトを左右反転するか
         author_name: 作者名（下部に小さく表示）
         font_name: フォント名（'default', 'noto', 'gg-sans'）
-        avatar_image: ユーザーのアバター画像（bytes）
+        avatar_image: ユーザーのアバター画像（bytes、またはアニメーションのフレームの PIL 画像）
+        rainbow_smooth: 虹色を文字ごとではなく滑らかなグラデーションにするか
 
     Returns:
-        BytesIO: PNG画像データ
+        Image: RGB 画像
     """
     # 画像サイズ
     width = 1280
@@ -142,7 +349,11 @@ def generate_meme_image(
     # アバター画像を背景として使用（斜めのグラデーションマスク付き）
     if avatar_image:
         try:
-            avatar_img = Image.open(io.BytesIO(avatar_image)).convert('RGB')
+            if isinstance(avatar_image, Image.Image):
+                # アニメーションのフレーム
+                avatar_img = avatar_image.convert('RGB')
+            else:
+                avatar_img = Image.open(io.BytesIO(avatar_image)).convert('RGB')
 
             # アバター画像のアスペクト比を保ってトリミング
             # 画面の高さに合わせて、中央部分を切り取る
@@ -163,60 +374,8 @@ def generate_meme_image(
             # トリミングした画像を画面全体にリサイズ
             avatar_full = avatar_cropped.resize((width, height), Image.LANCZOS)
 
-            # 斜めのグラデーションマスクを作成
-            mask = Image.new('L', (width, height), 0)
-
-            # グラデーションの幅（ぼかしの範囲）
-            gradient_width = 150
-
-            # 画像:テキスト = 1:3 または 3:1 の割合
-            # 左側配置の場合: 左25%が画像、右75%がテキスト
-            # 右側配置の場合: 左75%がテキスト、右25%が画像
-            if swap_layout:
-                # 右側に配置（右下から左上へ）- 右25%が画像
-                # 画像領域の中心: 87.5% (75% + 12.5%)
-                avatar_center = int(width * 0.875)
-                gradient_start = int(width * 0.75)
-            else:
-                # 左側に配置（左下から右上へ）- 左25%が画像
-                # 画像領域の中心: 12.5%
-                avatar_center = int(width * 0.125)
-                gradient_start = int(width * 0.25)
-
-            # 各ピクセルごとにグラデーションを計算
-            for y in range(height):
-                for x in range(width):
-                    # 斜めの距離を計算（y座標で少し傾ける）
-                    diagonal_offset = int(y * 0.2)  # 傾きを少し緩やかに
-
-                    if swap_layout:
-                        # 右側の場合は右から左へ
-                        adjusted_x = x + diagonal_offset
-
-                        # グラデーション範囲内でアルファ値を計算
-                        if adjusted_x > gradient_start + gradient_width:
-                            alpha = 255  # 完全に表示
-                        elif adjusted_x > gradient_start:
-                            # グラデーション範囲内
-                            ratio = (adjusted_x - gradient_start) / gradient_width
-                            alpha = int(255 * ratio)
-                        else:
-                            alpha = 0  # 完全に透明
-                    else:
-                        # 左側の場合は左から右へ
-                        adjusted_x = x - diagonal_offset
-
-                        # グラデーション範囲内でアルファ値を計算
-                        if adjusted_x < gradient_start - gradient_width:
-                            alpha = 255  # 完全に表示
-                        elif adjusted_x < gradient_start:
-                            # グラデーション範囲内
-                            ratio = (gradient_start - adjusted_x) / gradient_width
-                            alpha = int(255 * ratio)
-                        else:
-                            alpha = 0  # 完全に透明
-
-                    mask.putpixel((x, y), alpha)
+            # 斜めのグラデーションマスク
+            mask = _avatar_mask(width, height, swap_layout)
 
             # マスクを使ってアバター画像を合成
             img.paste(avatar_full, (0, 0), mask)
@@ -226,27 +385,6 @@ def generate_meme_image(
 
     draw = ImageDraw.Draw(img, 'RGBA')
 
-    # フォントの読み込み
-    repo_dir = os.path.dirname(__file__)
-
-    # フォント名に応じてパスを選択
-    if font_name == 'noto':
-        font_path = os.path.join(repo_dir, 'NotoSansCJKjp-Regular.ttf')
-    elif font_name == 'gg-sans':
-        font_path = os.path.join(repo_dir, 'gg-sans-2', 'gg sans Bold.ttf')
-    else:
-        # デフォルト（自動選択）
-        font_path = None
-        font = _load_font(font_size, 'Bold')
-
-    if font_path and os.path.exists(font_path):
-        try:
-            font = ImageFont.truetype(font_path, font_size)
-        except Exception:
-            font = _load_font(font_size, 'Bold')
-    elif font_path:
-        font = _load_font(font_size, 'Bold')
-
     # テキスト領域の計算（画像:テキスト = 1:3 の割合）
     text_padding = 80
 
@@ -260,29 +398,19 @@ def generate_meme_image(
         text_area_right = width - text_padding
 
     text_area_width = text_area_right - text_area_left
+    # 上下は日付・作者名と重ならないよう左右と同じだけ空ける
+    text_area_height = height - text_padding * 2
 
-    # テキストを複数行に分割
-    words = text.split()
-    lines = []
-    current_line = ""
+    # フォントサイズの指定がなければ、テキスト領域に収まる最大のサイズにする
+    if not font_size:
+        font_size = fit_font_size(text, font_name, text_area_width, text_area_height)
+    font = _meme_font(font_name, font_size)
 
-    for word in words:
-        test_line = current_line + word + " "
-        bbox = draw.textbbox((0, 0), test_line, font=font)
-        line_width = bbox[2] - bbox[0]
-
-        if line_width <= text_area_width:
-            current_line = test_line
-        else:
-            if current_line:
-                lines.append(current_line.strip())
-            current_line = word + " "
-
-    if current_line:
-        lines.append(current_line.strip())
+    # テキストを複数行に分割（日本語は文字単位、英語は単語単位で禁則処理つき）
+    lines = text_layout.wrap_text(text, font, text_area_width)
 
     # テキストの描画位置を計算
-    line_height = font_size + 20
+    line_height = _line_height(font_size)
     total_text_height = line_height * len(lines)
     text_start_y = (height - total_text_height) // 2
 
@@ -297,7 +425,7 @@ def generate_meme_image(
 
         if rainbow_text:
             # 虹色で描画
-            draw_text_with_rainbow(draw, (x, y), line, font, start_hue=i * 0.1)
+            draw_text_with_rainbow(img, (x, y), line, font, start_hue=i * 0.1, smooth=rainbow_smooth)
         else:
             # 影を描画
             shadow_offset = 3
@@ -347,11 +475,6 @@ def generate_meme_image(
 
     draw.text((watermark_x, watermark_y), watermark_text, font=watermark_font, fill=watermark_color)
 
-    # BytesIOに保存（圧縮なし、最高品質）
-    buf = io.BytesIO()
-    img.save(buf, format='PNG', compress_level=0, optimize=False)
-    buf.seek(0)
-
-    return buf
+    return img
 
 
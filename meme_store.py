@@ -0,0 +1,175 @@
+"""
+めいく機能の設定ストア
+
+メッセージIDごとの設定を TTL とエントリ数上限つきで保持する。
+アバター画像などの bytes は AssetCache に一度だけ格納し、設定側はキーで参照する。
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# MemeEditView のタイムアウトと揃える（秒）
+MEME_VIEW_TIMEOUT = 300
+
+
+class AssetCache:
+    """
+    内容ハッシュをキーに bytes を共有するキャッシュ
+
+    acquire() で参照カウントを増やしたアセットは release() されるまで保持される。
+    参照されていないアセットは合計 max_bytes まで LRU で残し、超えた分から破棄する。
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> bytes
+        self._refs = {}  # key -> 参照カウント
+        self._unpinned_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def acquire(self, data: Optional[bytes]) -> Optional[str]:
+        """bytes を格納（既存なら共有）して参照を1つ増やし、キーを返す"""
+        if not data:
+            return None
+        key = self.key_for(data)
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = bytes(data)
+                self._refs[key] = 0
+            elif self._refs[key] == 0:
+                self._unpinned_bytes -= len(self._data[key])
+            self._refs[key] += 1
+            self._data.move_to_end(key)
+        return key
+
+    def release(self, key: Optional[str]) -> None:
+        """参照を1つ減らす。参照が無くなったアセットは LRU の破棄対象になる"""
+        if key is None:
+            return
+        with self._lock:
+            if key not in self._refs or self._refs[key] == 0:
+                return
+            self._refs[key] -= 1
+            if self._refs[key] == 0:
+                self._unpinned_bytes += len(self._data[key])
+                self._evict_locked()
+
+    def get(self, key: Optional[str]) -> Optional[bytes]:
+        if key is None:
+            return None
+        with self._lock:
+            data = self._data.get(key)
+            if data is not None:
+                self._data.move_to_end(key)
+            return data
+
+    def _evict_locked(self) -> None:
+        if self._unpinned_bytes <= self.max_bytes:
+            return
+        for key in list(self._data.keys()):
+            if self._unpinned_bytes <= self.max_bytes:
+                break
+            if self._refs.get(key, 0) == 0:
+                self._unpinned_bytes -= len(self._data.pop(key))
+                del self._refs[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(len(v) for v in self._data.values())
+            return {
+                'entries': len(self._data),
+                'bytes': total,
+                'pinned_bytes': total - self._unpinned_bytes,
+            }
+
+
+class MemeSettingsStore:
+    """
+    めいく画像の設定をメッセージIDごとに保持するストア
+
+    - 最後のアクセスから ttl 秒で失効（View のタイムアウトと同じくアクセスで延長）
+    - max_entries を超えたら古いものから破棄
+    - 'avatar_image' の bytes は AssetCache に移し、設定には 'avatar_key' だけを残す
+    """
+
+    def __init__(self, asset_cache: AssetCache, ttl: float = MEME_VIEW_TIMEOUT, max_entries: int = 2000):
+        self.asset_cache = asset_cache
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # message_id -> (expires_at, settings)
+        self._lock = threading.Lock()
+
+    def intern_settings(self, settings: dict) -> dict:
+        """設定内の avatar_image をアセットキーに置き換える（settings をその場で書き換える）"""
+        if 'avatar_image' in settings:
+            avatar = settings.pop('avatar_image')
+            settings['avatar_key'] = self.asset_cache.acquire(avatar)
+        return settings
+
+    def put(self, message_id: int, settings: dict) -> dict:
+        self.intern_settings(settings)
+        now = time.monotonic()
+        with self._lock:
+            old = self._entries.pop(message_id, None)
+            self._entries[message_id] = (now + self.ttl, settings)
+            dropped = self._expire_locked(now)
+            while len(self._entries) > self.max_entries:
+                dropped.append(self._entries.popitem(last=False)[1][1])
+        if old is not None and old[1] is not settings:
+            dropped.append(old[1])
+        self._release(dropped)
+        return settings
+
+    def get(self, message_id: int) -> Optional[dict]:
+        now = time.monotonic()
+        with self._lock:
+            dropped = self._expire_locked(now)
+            entry = self._entries.get(message_id)
+            if entry is not None:
+                # アクセスで有効期限を延長
+                self._entries[message_id] = (now + self.ttl, entry[1])
+                self._entries.move_to_end(message_id)
+        self._release(dropped)
+        return entry[1] if entry is not None else None
+
+    def discard(self, message_id: int) -> None:
+        with self._lock:
+            entry = self._entries.pop(message_id, None)
+        if entry is not None:
+            self._release([entry[1]])
+
+    def avatar_for(self, settings: dict) -> Optional[bytes]:
+        """設定が参照するアバター画像の bytes を返す"""
+        if 'avatar_image' in settings:
+            return settings['avatar_image']
+        return self.asset_cache.get(settings.get('avatar_key'))
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            dropped = self._expire_locked(time.monotonic())
+        self._release(dropped)
+        return len(dropped)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire_locked(self, now: float) -> list:
+        # 期限切れのエントリを先頭から取り除く（アクセス時に末尾へ移動するので先頭ほど古い）
+        dropped = []
+        while self._entries:
+            message_id, (expires_at, settings) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[message_id]
+            dropped.append(settings)
+        return dropped
+
+    def _release(self, settings_list: list) -> None:
+        for settings in settings_list:
+            self.asset_cache.release(settings.get('avatar_key'))
@@ -0,0 +1,134 @@
+"""
+チャンネルのメッセージ履歴キャッシュ
+
+魚拓は参照メッセージとその前の N 件を取得する。同じ会話に対して「魚拓3」「魚拓5」と続けたときに
+REST API を呼び直さないよう、参照メッセージごとに「それより前のメッセージ列」を TTL つきで保持し、
+足りない分だけ続きから取得する。編集・削除のイベントを受けたらそのチャンネルのキャッシュを捨てる。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class _ChannelEntry:
+    __slots__ = ('messages', 'runs', 'size', 'locks')
+
+    def __init__(self):
+        self.messages = OrderedDict()  # message_id -> (expires_at, message)（期限の早い順）
+        self.runs = OrderedDict()   # anchor_id -> [expires_at, [古い方へ並んだメッセージ], 先頭まで取得済みか]
+        self.size = 0               # runs に入っているメッセージの合計
+        self.locks = {}             # anchor_id -> [asyncio.Lock, 使用中の呼び出し数]
+
+
+class HistoryCache:
+    """
+    Args:
+        ttl: キャッシュを使う秒数
+        max_channels: 保持するチャンネル数（超えたら最近使っていないものから破棄）
+        max_messages: 1チャンネルで保持する履歴の合計件数
+    """
+
+    def __init__(self, ttl: float = 120, max_channels: int = 256, max_messages: int = 500):
+        self.ttl = ttl
+        self.max_channels = max_channels
+        self.max_messages = max_messages
+        self._channels = OrderedDict()  # channel_id -> _ChannelEntry
+        self.hits = 0
+        self.fetched = 0
+
+    def _entry(self, channel_id) -> _ChannelEntry:
+        entry = self._channels.get(channel_id)
+        if entry is None:
+            entry = self._channels[channel_id] = _ChannelEntry()
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        else:
+            self._channels.move_to_end(channel_id)
+        return entry
+
+    async def fetch_message(self, channel, message_id):
+        """channel.fetch_message のキャッシュつき版"""
+        entry = self._entry(channel.id)
+        now = time.monotonic()
+        cached = entry.messages.get(message_id)
+        if cached is not None and cached[0] > now:
+            self.hits += 1
+            return cached[1]
+        with metrics.timed('message_fetch'):
+            msg = await channel.fetch_message(message_id)
+        entry.messages[message_id] = (now + self.ttl, msg)
+        entry.messages.move_to_end(message_id)
+        # TTL は一定なので先頭から期限切れになる。件数も履歴と同じ上限で抑える
+        while entry.messages and (next(iter(entry.messages.values()))[0] <= now or len(entry.messages) > self.max_messages):
+            entry.messages.popitem(last=False)
+        return msg
+
+    async def history_before(self, channel, anchor, limit: int) -> list:
+        """
+        anchor より前のメッセージを新しい順に最大 limit 件返す
+
+        キャッシュ済みの分は再取得せず、足りない分だけ最後に取得したメッセージの続きから取得する。
+        同じ参照メッセージへの取得は順番に行う（件数の違う魚拓が同時に来ても同じ続きを二重に足さない）。
+        """
+        if limit <= 0:
+            return []
+        entry = self._entry(channel.id)
+        slot = entry.locks.get(anchor.id)
+        if slot is None:
+            slot = entry.locks[anchor.id] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                return await self._history_before(entry, channel, anchor, limit)
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0 and entry.locks.get(anchor.id) is slot:
+                del entry.locks[anchor.id]
+
+    async def _history_before(self, entry: _ChannelEntry, channel, anchor, limit: int) -> list:
+        now = time.monotonic()
+        run = entry.runs.get(anchor.id)
+        if run is None or run[0] <= now:
+            if run is not None:
+                entry.size -= len(run[1])
+            run = entry.runs[anchor.id] = [now + self.ttl, [], False]
+        entry.runs.move_to_end(anchor.id)
+
+        older = run[1]
+        missing = limit - len(older)
+        if missing > 0 and not run[2]:
+            before = older[-1] if older else anchor
+            with metrics.timed('history_fetch'):
+                fetched = [m async for m in channel.history(limit=missing, before=before.created_at)]
+            self.fetched += len(fetched)
+            older.extend(fetched)
+            # 取得中に他の参照メッセージの _trim で捨てられた列は数えない
+            if entry.runs.get(anchor.id) is run:
+                entry.size += len(fetched)
+            # 要求より少なければチャンネルの先頭まで取得し終えている
+            run[2] = len(fetched) < missing
+            self._trim(entry)
+        else:
+            self.hits += 1
+        return older[:limit]
+
+    def _trim(self, entry: _ChannelEntry) -> None:
+        # 最近使っていない参照メッセージの履歴から捨てる（使用中の1件は残す）
+        while entry.size > self.max_messages and len(entry.runs) > 1:
+            _, (_, older, _) = entry.runs.popitem(last=False)
+            entry.size -= len(older)
+
+    def invalidate(self, channel_id) -> None:
+        """チャンネルのキャッシュを捨てる（メッセージの編集・削除時）"""
+        self._channels.pop(channel_id, None)
+
+    def stats(self) -> dict:
+        return {
+            'channels': len(self._channels),
+            'messages': sum(e.size for e in self._channels.values()),
+            'referenced': sum(len(e.messages) for e in self._channels.values()),
+            'hits': self.hits,
+            'fetched': self.fetched,
+        }
@@ -0,0 +1,213 @@
+"""
+処理段階ごとのレイテンシ計測
+
+メッセージ取得・履歴取得・メンバー解決・アセット取得・推論・描画・エンコード・アップロードなど
+各段階の所要時間をヒストグラムに記録し、Prometheus 形式の HTTP エンドポイント
+（METRICS_PORT）か、ポートを開けない環境では定期的な JSON ファイル（METRICS_JSON_PATH）で公開する。
+
+使い方:
+    with metrics.timed('message_fetch'):
+        msg = await channel.fetch_message(...)
+
+    metrics.observe('encode', seconds, profile='png_fast')
+"""
+import asyncio
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# ヒストグラムのバケット境界（秒）
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRIC_PREFIX = 'emotionbot'
+
+
+class Histogram:
+    """固定バケットのヒストグラム（累積ではなくバケットごとの件数を持つ）"""
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """バケット境界から近似した分位点（最後のバケットに入った場合は inf）"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+
+_lock = threading.Lock()
+_histograms = {}  # (stage, labels) -> Histogram
+_collectors = {}  # 名前 -> () -> dict（ゲージ値などを返す関数）
+
+
+def observe(stage: str, seconds: float, **labels) -> None:
+    key = (stage, tuple(sorted(labels.items())))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = Histogram()
+        hist.observe(seconds)
+
+
+@contextmanager
+def timed(stage: str, **labels):
+    """with ブロックの所要時間を stage として記録する（例外時も記録）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started, **labels)
+
+
+def register_collector(name: str, func) -> None:
+    """エクスポート時に呼ばれる関数を登録する。戻り値の dict はそのまま JSON に、数値はゲージとして出力する"""
+    _collectors[name] = func
+
+
+def snapshot() -> dict:
+    """現在の計測値を JSON にできる dict で返す"""
+    with _lock:
+        items = [(stage, labels, list(h.counts), h.count, h.sum, h.quantile(0.5), h.quantile(0.99))
+                 for (stage, labels), h in _histograms.items()]
+    stages = []
+    for stage, labels, counts, count, total, p50, p99 in sorted(items):
+        stages.append({
+            'stage': stage,
+            'labels': dict(labels),
+            'count': count,
+            'sum': total,
+            'p50_le': p50 if p50 != float('inf') else None,
+            'p99_le': p99 if p99 != float('inf') else None,
+            'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], counts)),
+        })
+    collected = {}
+    for name, func in list(_collectors.items()):
+        try:
+            collected[name] = func()
+        except Exception as e:
+            collected[name] = {'error': str(e)}
+    return {'time': time.time(), 'stages': stages, 'collectors': collected}
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    inner = ','.join(f'{k}="{str(v)}"' for k, v in labels.items())
+    return '{' + inner + '}'
+
+
+def _flatten(prefix: str, value, out: list):
+    # コレクターの戻り値から数値だけを取り出してゲージにする
+    if isinstance(value, bool):
+        out.append((prefix, int(value)))
+    elif isinstance(value, (int, float)):
+        out.append((prefix, value))
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            _flatten(f'{prefix}_{k}', v, out)
+
+
+def render_prometheus() -> str:
+    """Prometheus のテキスト形式で出力する"""
+    snap = snapshot()
+    name = f'{METRIC_PREFIX}_stage_seconds'
+    lines = [f'# HELP {name} Latency of each processing stage.', f'# TYPE {name} histogram']
+    for st in snap['stages']:
+        labels = {'stage': st['stage'], **st['labels']}
+        cumulative = 0
+        for le, c in st['buckets'].items():
+            cumulative += c
+            lines.append(f'{name}_bucket{_format_labels({**labels, "le": le})} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {st["sum"]}')
+        lines.append(f'{name}_count{_format_labels(labels)} {st["count"]}')
+
+    for collector, value in snap['collectors'].items():
+        gauges = []
+        _flatten(f'{METRIC_PREFIX}_{collector}', value, gauges)
+        for gauge_name, v in gauges:
+            gauge_name = ''.join(ch if ch.isalnum() or ch == '_' else '_' for ch in gauge_name)
+            lines.append(f'# TYPE {gauge_name} gauge')
+            lines.append(f'{gauge_name} {v}')
+    return '\n'.join(lines) + '\n'
+
+
+async def _serve_http(host: str, port: int):
+    from aiohttp import web
+
+    async def handle(_request):
+        return web.Response(text=render_prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"メトリクスを公開しています: http://{host}:{port}/metrics")
+    return runner
+
+
+async def _dump_json_periodically(path: str, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            data = json.dumps(snapshot(), ensure_ascii=False)
+            tmp = f'{path}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"メトリクスの書き出しに失敗: {e}")
+
+
+_exporter_started = False
+_background_tasks = set()
+
+
+async def start_exporter(env_prefix: str = 'METRICS'):
+    """
+    環境変数に応じてエクスポーターを開始する（複数回呼んでも一度だけ）
+
+    METRICS_PORT: Prometheus 形式の HTTP エンドポイントを開くポート（METRICS_HOST 既定 127.0.0.1）
+    METRICS_JSON_PATH: ポートを使わない場合に JSON を書き出すパス（METRICS_DUMP_INTERVAL 秒ごと）
+
+    Args:
+        env_prefix: 環境変数名の METRICS の部分（同じホストで動く別のサービスはポートを分ける）
+    """
+    global _exporter_started
+    if _exporter_started:
+        return
+    _exporter_started = True
+
+    port = os.getenv(f'{env_prefix}_PORT')
+    if port:
+        try:
+            await _serve_http(os.getenv(f'{env_prefix}_HOST', '127.0.0.1'), int(port))
+            return
+        except Exception as e:
+            print(f"メトリクスのエンドポイントを開けませんでした: {e}")
+
+    path = os.getenv(f'{env_prefix}_JSON_PATH')
+    if path:
+        interval = float(os.getenv(f'{env_prefix}_DUMP_INTERVAL', '60'))
+        task = asyncio.create_task(_dump_json_periodically(path, interval))
+        _background_tasks.add(task)
+        print(f"メトリクスを {interval:.0f} 秒ごとに書き出します: {path}")
@@ -0,0 +1,161 @@
+"""
+ユーザー・チャンネル・ギルドごとのレート制限（トークンバケット）
+
+コマンドごとにコスト（消費するトークン数）を決め、ユーザー・チャンネル・ギルドのバケットすべてに
+足りる場合だけ実行を許可する。バケットは確認したときにまとめて補充する（タイマーは使わない）ので、
+1回の確認は O(1) で、保持するキー数はスコープごとの上限を超えたら最近使っていないものから捨てる。
+捨てたバケットは満タンになっているのとほぼ同じなので、取りこぼしは問題にならない。
+
+環境変数（容量/秒数 の形式。例: 10/60 は 60 秒で 10 トークン回復、最大 10 トークン）:
+    RATE_LIMIT_USER     既定 12/60
+    RATE_LIMIT_CHANNEL  既定 40/60
+    RATE_LIMIT_GUILD    既定 120/60
+    RATE_LIMIT=0        レート制限を無効にする
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+
+# コマンドごとのコスト。魚拓はまとめる件数に応じて増える
+COMMAND_COSTS = {
+    'kimoi': 1.0,
+    'kimochi': 2.0,
+    'meme': 3.0,
+    'meme_edit': 2.0,
+    'gyotaku': 1.0,
+}
+GYOTAKU_COST_PER_MESSAGE = 0.5
+
+# check() の結果。retry_after はあと何秒で実行できるか、scope は足りなかったバケット、
+# notify はクールダウンを知らせるべきか（同じユーザーへの通知はクールダウン中1回だけ）
+Decision = namedtuple('Decision', 'allowed retry_after scope notify')
+ALLOWED = Decision(True, 0.0, None, False)
+
+
+def command_cost(command: str, messages: int = 1) -> float:
+    cost = COMMAND_COSTS.get(command, 1.0)
+    if command == 'gyotaku':
+        cost += GYOTAKU_COST_PER_MESSAGE * max(0, messages - 1)
+    return cost
+
+
+class BucketScope:
+    """
+    あるスコープ（user / channel / guild）のバケットの集まり
+
+    Args:
+        capacity: バケットの容量（トークン数）
+        per: 空から満タンまで回復する秒数
+        max_keys: 保持するキー数の上限
+    """
+
+    def __init__(self, capacity: float, per: float, max_keys: int = 10000):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+
+    def peek(self, key, now: float) -> float:
+        """現在のトークン数（補充後）"""
+        entry = self._buckets.get(key)
+        if entry is None:
+            return self.capacity
+        tokens, updated = entry
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def take(self, key, tokens: float, now: float) -> None:
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+    def wait_for(self, available: float, cost: float) -> float:
+        # cost が容量を超える場合は満タンまで待てば実行できる扱いにする
+        need = min(cost, self.capacity) - available
+        return max(0.0, need / self.rate)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def _parse_rule(value: str, default: str):
+    capacity, _, per = (value or default).partition('/')
+    return float(capacity), float(per or 60)
+
+
+class RateLimiter:
+    def __init__(self, user=(12, 60), channel=(40, 60), guild=(120, 60), max_keys: int = 10000, enabled: bool = True):
+        self.enabled = enabled
+        self.scopes = {
+            'user': BucketScope(*user, max_keys=max_keys),
+            'channel': BucketScope(*channel, max_keys=max_keys),
+            'guild': BucketScope(*guild, max_keys=max_keys),
+        }
+        self._notified = OrderedDict()  # user_id -> 通知済みのクールダウン終了時刻
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: {'allowed': 0, 'limited': 0})
+        self._limited_by = defaultdict(int)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            user=_parse_rule(os.getenv('RATE_LIMIT_USER'), '12/60'),
+            channel=_parse_rule(os.getenv('RATE_LIMIT_CHANNEL'), '40/60'),
+            guild=_parse_rule(os.getenv('RATE_LIMIT_GUILD'), '120/60'),
+            enabled=os.getenv('RATE_LIMIT', '1') != '0',
+        )
+
+    def check(self, command: str, cost: float, user_id=None, channel_id=None, guild_id=None) -> Decision:
+        """すべてのバケットに cost 分のトークンがあれば消費して許可する（足りなければ何も消費しない）"""
+        if not self.enabled:
+            return ALLOWED
+        keys = {'user': user_id, 'channel': channel_id, 'guild': guild_id}
+        now = time.monotonic()
+        with self._lock:
+            available = {}
+            worst = None
+            for name, key in keys.items():
+                if key is None:
+                    continue
+                scope = self.scopes[name]
+                tokens = scope.peek(key, now)
+                available[name] = tokens
+                if tokens < min(cost, scope.capacity):
+                    wait = scope.wait_for(tokens, cost)
+                    if worst is None or wait > worst[0]:
+                        worst = (wait, name)
+
+            if worst is None:
+                for name, tokens in available.items():
+                    scope = self.scopes[name]
+                    scope.take(keys[name], max(0.0, tokens - cost), now)
+                self._counts[command]['allowed'] += 1
+                return ALLOWED
+
+            self._counts[command]['limited'] += 1
+            self._limited_by[worst[1]] += 1
+            retry_after = worst[0]
+            notify = self._notified.get(user_id, 0.0) <= now
+            if notify:
+                self._notified[user_id] = now + retry_after
+                self._notified.move_to_end(user_id)
+                if len(self._notified) > self._max_keys:
+                    self._notified.popitem(last=False)
+            return Decision(False, retry_after, worst[1], notify)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'commands': {k: dict(v) for k, v in self._counts.items()},
+                'limited_by': dict(self._limited_by),
+                'keys': {name: len(scope) for name, scope in self.scopes.items()},
+            }
+
+
+def cooldown_message(decision: Decision) -> str:
+    seconds = max(1, math.ceil(decision.retry_after))
+    return f"少し間をあけてください。あと {seconds} 秒ほどで使えます。"
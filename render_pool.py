@@ -0,0 +1,324 @@
+"""
+画像レンダリングのバックエンド
+
+- LocalRenderBackend: 呼び出したスレッドでそのまま描画する（デフォルト）
+- ProcessRenderBackend: プロセスプールで描画する。Pillow / matplotlib の描画は
+  GIL を長く握るため、スレッドではコア数に応じてスケールしない。
+
+ジョブは (種類, ペイロード, アセット) の小さな記述として渡す。アバターや絵文字などの
+bytes はペイロード内では AssetRef（内容ハッシュ）で参照し、本体は共有メモリに一度だけ
+置いてワーカー側のキャッシュに載せる。描画結果もワーカーが共有メモリに書き込み、
+親プロセスはそこから読み出すだけなので pickle を経由しない。
+"""
+import io
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+from image_encoder import DEFAULT_PROFILE, EncodedImage, encode_image, record_stats
+import metrics
+from meme_store import AssetCache
+from tile_cache import TileCache
+
+# ペイロード内でアセット bytes を指す参照
+AssetRef = namedtuple('AssetRef', 'key')
+
+
+def asset_ref(assets: dict, data):
+    """data を assets に登録して AssetRef を返す（data が空なら None）"""
+    if not data:
+        return None
+    key = AssetCache.key_for(data)
+    assets[key] = data
+    return AssetRef(key)
+
+
+def _resolve(value, lookup):
+    # ペイロードを再帰的にたどって AssetRef を bytes に置き換える
+    if isinstance(value, AssetRef):
+        return lookup(value.key)
+    if isinstance(value, dict):
+        return {k: _resolve(v, lookup) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_resolve(v, lookup) for v in value]
+    return value
+
+
+# 各ジョブは PIL.Image を返し、エンコードは run_render_job 側でまとめて行う
+
+def _job_meme(payload):
+    from meme_generator import render_meme_image
+    return render_meme_image(**payload)
+
+
+# 魚拓のメッセージタイル（描画するプロセスごとに持つ）
+# .env はボットの起動処理で読み込まれるので、import 時ではなく最初に使うときに作る
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache() -> TileCache:
+    global _tile_cache
+    if _tile_cache is None:
+        with _tile_cache_lock:
+            if _tile_cache is None:
+                _tile_cache = TileCache(int(os.getenv('TILE_CACHE_BYTES', str(64 * 1024 * 1024))))
+    return _tile_cache
+
+
+# プロセスプールで描画する場合、このプロセスのキャッシュは使われないので 0 件のままになる
+metrics.register_collector('tiles', lambda: get_tile_cache().stats())
+
+
+def _job_stack(payload):
+    from discord_renderer import render_messages_stack_image
+    return render_messages_stack_image(payload['items'], tile_cache=get_tile_cache(), **payload.get('options', {}))
+
+
+def _job_chart(payload):
+    from emotion_chart import render_emotion_chart_image
+    return render_emotion_chart_image(payload['scores'])
+
+
+def _encode_meme(payload, profile):
+    # アニメーションにする場合はフレームごとに描画してまとめてエンコードする
+    from meme_generator import encode_meme
+    return encode_meme(profile, **payload)
+
+
+def _encode_stack(payload, profile):
+    # 魚拓は全体の画像を作らずに逐次エンコードする（縦に長くてもメモリが膨らまない）
+    from discord_renderer import encode_messages_stack
+    return encode_messages_stack(payload['items'], profile, tile_cache=get_tile_cache(), **payload.get('options', {}))
+
+
+RENDER_JOBS = {
+    'meme': _job_meme,
+    'stack': _job_stack,
+    'chart': _job_chart,
+}
+
+# 描画とエンコードを一緒に行うジョブ（EncodedImage を返す）
+ENCODING_JOBS = {
+    'meme': _encode_meme,
+    'stack': _encode_stack,
+}
+
+
+def _run_job(kind, payload, profile, lookup) -> EncodedImage:
+    if kind in ENCODING_JOBS:
+        started = time.perf_counter()
+        encoded = ENCODING_JOBS[kind](_resolve(payload, lookup), profile)
+        metrics.observe('render', time.perf_counter() - started - encoded.seconds, kind=kind)
+        metrics.observe('encode', encoded.seconds, profile=encoded.profile)
+        return encoded
+    with metrics.timed('render', kind=kind):
+        img = RENDER_JOBS[kind](_resolve(payload, lookup))
+    encoded = encode_image(img, profile)
+    metrics.observe('encode', encoded.seconds, profile=profile)
+    return encoded
+
+
+def run_render_job(kind: str, payload: dict, assets: dict = None, profile: str = DEFAULT_PROFILE) -> EncodedImage:
+    """ジョブを現在のプロセスで実行してエンコード済み画像を返す"""
+    assets = assets or {}
+    return _run_job(kind, payload, profile, assets.get)
+
+
+class LocalRenderBackend:
+    """呼び出し元のスレッドで描画するバックエンド"""
+
+    def render(self, kind: str, payload: dict, assets: dict = None, profile: str = DEFAULT_PROFILE) -> EncodedImage:
+        return run_render_job(kind, payload, assets, profile)
+
+    def cached_tile(self, key):
+        """描画済みのタイルがあれば返す（返したタイルはペイロードの 'tile' に入れて使う）"""
+        return get_tile_cache().get(key)
+
+    def shutdown(self):
+        pass
+
+
+# ---- ワーカープロセス側 ----
+
+_worker_assets = OrderedDict()  # key -> bytes
+_worker_assets_bytes = 0
+_WORKER_ASSET_LIMIT = 64 * 1024 * 1024
+
+
+def _worker_asset(key, refs):
+    global _worker_assets_bytes
+    data = _worker_assets.get(key)
+    if data is not None:
+        _worker_assets.move_to_end(key)
+        return data
+    ref = refs.get(key)
+    if ref is None:
+        return None
+    name, size = ref
+    # spawn したワーカーは親と同じ resource_tracker を使うので、attach だけなら登録は重複しない
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    _worker_assets[key] = data
+    _worker_assets_bytes += size
+    while _worker_assets_bytes > _WORKER_ASSET_LIMIT and len(_worker_assets) > 1:
+        _, old = _worker_assets.popitem(last=False)
+        _worker_assets_bytes -= len(old)
+    return data
+
+
+def _init_worker():
+    # フォントと描画モジュールを先に読み込んで、最初のジョブから温まった状態にする
+    import discord_renderer
+    import emotion_chart
+    import meme_generator
+    for size in (16, 18, 20, 21):
+        discord_renderer._load_font(size)
+        meme_generator._load_font(size)
+    discord_renderer._get_fallback_fonts(21, 'Regular')
+    discord_renderer._get_fallback_fonts(21, 'Bold')
+    discord_renderer._get_fallback_fonts(15, 'Semibold')
+    discord_renderer._load_font(15, weight='Semibold')
+    meme_generator._load_font(60, 'Bold')
+    emotion_chart.prerender_label_sprites()
+
+
+def _run_in_worker(kind, payload, profile, refs, result_name):
+    encoded = _run_job(kind, payload, profile, lambda key: _worker_asset(key, refs))
+    view = encoded.buffer.getbuffer()
+    size = len(view)
+    # 結果の共有メモリは親が決めた名前で作る（親はワーカーが落ちても名前で後始末できる）
+    shm = shared_memory.SharedMemory(name=result_name, create=True, size=max(1, size))
+    try:
+        shm.buf[:size] = view
+    except BaseException:
+        shm.unlink()
+        raise
+    finally:
+        view.release()
+        shm.close()
+    # アニメーションにした場合などは依頼と別のプロファイルになる
+    return size, encoded.seconds, encoded.profile
+
+
+# ---- 親プロセス側 ----
+
+class ProcessRenderBackend:
+    """
+    プロセスプールで描画するバックエンド
+
+    Args:
+        processes: ワーカープロセス数
+        asset_bytes: 共有メモリに置いておくアセットの合計上限（使用中のものは除く）
+    """
+
+    def __init__(self, processes: int, asset_bytes: int = 64 * 1024 * 1024):
+        self.processes = max(1, processes)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=get_context('spawn'),
+            initializer=_init_worker,
+        )
+        self._asset_limit = asset_bytes
+        self._published = OrderedDict()  # key -> SharedMemory
+        self._pins = {}  # key -> 使用中のジョブ数
+        self._lock = threading.Lock()
+        self._result_ids = itertools.count()
+
+    def cached_tile(self, key):
+        # タイルはワーカーごとに持っていて親からは分からないので、常にアセットを揃えて渡す。
+        # ワーカーは tile_key が自分のキャッシュにあれば描画を省くが、アセットの取得と転送は省けず、
+        # キャッシュもワーカーごとに分かれる（ヒット率はワーカー数に応じて下がる）
+        return None
+
+    def render(self, kind: str, payload: dict, assets: dict = None, profile: str = DEFAULT_PROFILE) -> EncodedImage:
+        assets = assets or {}
+        refs = self._publish(assets)
+        name = f'rp{os.getpid()}_{next(self._result_ids)}'
+        started = time.perf_counter()
+        try:
+            future = self._pool.submit(_run_in_worker, kind, payload, profile, refs, name)
+            size, seconds, encoded_profile = future.result()
+            shm = shared_memory.SharedMemory(name=name)
+            try:
+                data = bytes(shm.buf[:size])
+            finally:
+                shm.close()
+        finally:
+            self._unpin(assets.keys())
+            _unlink_result(name)
+        # ワーカー内の計測は親から見えないので、往復時間を render として記録する
+        metrics.observe('render', time.perf_counter() - started - seconds, kind=kind)
+        metrics.observe('encode', seconds, profile=encoded_profile)
+        encoded = EncodedImage(io.BytesIO(data), encoded_profile, seconds)
+        record_stats(encoded)
+        return encoded
+
+    def _publish(self, assets: dict) -> dict:
+        refs = {}
+        with self._lock:
+            for key, data in assets.items():
+                shm = self._published.get(key)
+                if shm is None:
+                    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+                    shm.buf[:len(data)] = data
+                    self._published[key] = shm
+                self._published.move_to_end(key)
+                self._pins[key] = self._pins.get(key, 0) + 1
+                refs[key] = (shm.name, len(data))
+        return refs
+
+    def _unpin(self, keys):
+        with self._lock:
+            for key in keys:
+                self._pins[key] -= 1
+                if self._pins[key] <= 0:
+                    del self._pins[key]
+            self._evict_locked()
+
+    def _evict_locked(self):
+        total = sum(shm.size for shm in self._published.values())
+        for key in list(self._published.keys()):
+            if total <= self._asset_limit:
+                break
+            if key in self._pins:
+                continue
+            shm = self._published.pop(key)
+            total -= shm.size
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            for shm in self._published.values():
+                shm.close()
+                shm.unlink()
+            self._published.clear()
+
+
+def _unlink_result(name):
+    # 結果の共有メモリを削除する。ワーカーが作る前に失敗した・落ちた場合は存在しない
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def create_render_backend(processes: int = None):
+    """環境変数 RENDER_PROCESSES が 1 以上ならプロセスプール、それ以外はローカルで描画する"""
+    if processes is None:
+        processes = int(os.getenv('RENDER_PROCESSES', '0'))
+    if processes > 0:
+        print(f"プロセスプールで描画します（{processes} プロセス）")
+        return ProcessRenderBackend(processes)
+    return LocalRenderBackend()
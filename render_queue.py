@@ -0,0 +1,197 @@
+"""
+画像生成ジョブのスケジューラ
+
+on_message / ボタンから来る重い処理（推論・描画）を優先度つきキューに積み、
+決まった数のワーカーでだけ実行する。キューが一杯、またはギルド/ユーザーごとの
+同時実行上限を超えた場合は SchedulerBusy を送出して「混雑中」と返せるようにする。
+"""
+import asyncio
+import functools
+import itertools
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+# コマンドごとの優先度（小さいほど先に処理）
+# ボタン操作は対話的なので最優先、まとめて描画する魚拓は最後
+COMMAND_PRIORITIES = {
+    'meme_edit': 0,
+    'kimoi': 1,
+    'kimochi': 2,
+    'meme': 3,
+    'gyotaku': 4,
+}
+DEFAULT_PRIORITY = 5
+
+
+class SchedulerBusy(Exception):
+    """キューが一杯、または同時実行上限に達している"""
+
+
+class _Job:
+    __slots__ = ('command', 'func', 'future', 'guild_id', 'user_id', 'enqueued_at')
+
+    def __init__(self, command, func, future, guild_id, user_id):
+        self.command = command
+        self.func = func
+        self.future = future
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.enqueued_at = time.monotonic()
+
+
+class RenderScheduler:
+    """
+    優先度つきの画像生成ジョブキュー
+
+    Args:
+        workers: 同時に実行するジョブ数
+        max_queue: 待機できるジョブ数の上限（超えたら SchedulerBusy）
+        per_guild: 1ギルドあたりの待機＋実行中ジョブ数の上限
+        per_user: 1ユーザーあたりの待機＋実行中ジョブ数の上限
+        executor: ジョブを実行する Executor（None ならスレッドプールを作る）
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        max_queue: int = 32,
+        per_guild: int = 6,
+        per_user: int = 2,
+        executor: Optional[Executor] = None,
+    ):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.per_guild = per_guild
+        self.per_user = per_user
+        self.executor = executor or ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='render')
+
+        self._queue = None
+        self._tasks = []
+        self._seq = itertools.count()
+        self._guild_load = defaultdict(int)
+        self._user_load = defaultdict(int)
+        self._running = 0
+
+        # メトリクス
+        self._submitted = defaultdict(int)
+        self._rejected = defaultdict(int)
+        self._failed = defaultdict(int)
+        self._wait_samples = defaultdict(lambda: deque(maxlen=512))
+        self._run_samples = defaultdict(lambda: deque(maxlen=512))
+        self._max_depth = 0
+
+    def _ensure_started(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.PriorityQueue()
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f'render-worker-{i}'))
+
+    async def submit(
+        self,
+        command: str,
+        func: Callable,
+        *args,
+        guild_id: Optional[int] = None,
+        user_id: Optional[int] = None,
+        **kwargs,
+    ):
+        """
+        func(*args, **kwargs) をワーカーで実行して結果を返す
+
+        Raises:
+            SchedulerBusy: キューや同時実行上限に空きが無い場合
+        """
+        self._ensure_started()
+
+        if self._queue.qsize() >= self.max_queue:
+            self._rejected[command] += 1
+            raise SchedulerBusy('queue full')
+        if guild_id is not None and self._guild_load[guild_id] >= self.per_guild:
+            self._rejected[command] += 1
+            raise SchedulerBusy('guild limit')
+        if user_id is not None and self._user_load[user_id] >= self.per_user:
+            self._rejected[command] += 1
+            raise SchedulerBusy('user limit')
+
+        loop = asyncio.get_running_loop()
+        job = _Job(command, functools.partial(func, *args, **kwargs), loop.create_future(), guild_id, user_id)
+        self._acquire(job)
+        priority = COMMAND_PRIORITIES.get(command, DEFAULT_PRIORITY)
+        self._queue.put_nowait((priority, next(self._seq), job))
+        self._submitted[command] += 1
+        self._max_depth = max(self._max_depth, self._queue.qsize())
+        return await job.future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.future.cancelled():
+                    continue
+                started = time.monotonic()
+                self._wait_samples[job.command].append(started - job.enqueued_at)
+                self._running += 1
+                try:
+                    result = await loop.run_in_executor(self.executor, job.func)
+                except Exception as e:
+                    self._failed[job.command] += 1
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                else:
+                    if not job.future.done():
+                        job.future.set_result(result)
+                finally:
+                    self._running -= 1
+                    self._run_samples[job.command].append(time.monotonic() - started)
+            finally:
+                self._release(job)
+                self._queue.task_done()
+
+    def _acquire(self, job):
+        if job.guild_id is not None:
+            self._guild_load[job.guild_id] += 1
+        if job.user_id is not None:
+            self._user_load[job.user_id] += 1
+
+    def _release(self, job):
+        for load, key in ((self._guild_load, job.guild_id), (self._user_load, job.user_id)):
+            if key is None:
+                continue
+            load[key] -= 1
+            if load[key] <= 0:
+                del load[key]
+
+    def metrics(self) -> dict:
+        """キュー深さ・待ち時間などのスナップショットを返す"""
+
+        def _summary(samples):
+            if not samples:
+                return {'count': 0}
+            ordered = sorted(samples)
+            return {
+                'count': len(ordered),
+                'p50': ordered[len(ordered) // 2],
+                'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                'max': ordered[-1],
+            }
+
+        commands = set(self._submitted) | set(self._rejected)
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'max_queue_depth': self._max_depth,
+            'running': self._running,
+            'commands': {
+                c: {
+                    'submitted': self._submitted[c],
+                    'rejected': self._rejected[c],
+                    'failed': self._failed[c],
+                    'wait_seconds': _summary(self._wait_samples[c]),
+                    'run_seconds': _summary(self._run_samples[c]),
+                }
+                for c in sorted(commands)
+            },
+        }
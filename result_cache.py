@@ -0,0 +1,111 @@
+"""
+送信済み画像の URL キャッシュ
+
+同じメッセージに同じコマンドが来たとき、同じ画像をエンコードしてアップロードし直すかわりに、
+前回の返信の添付ファイル URL を埋め込み（embed）で参照して返す。
+
+Discord の添付ファイル URL は署名つきで、クエリの ex（16進の UNIX 時刻）で有効期限が決まる。
+期限の margin 秒前を過ぎたもの・ex の無いもので ttl を過ぎたものは使わず、呼び出し側で再アップロードする。
+結果は添付ファイルを持つ返信のメッセージ ID と、内容が依存するメッセージの ID（魚拓なら範囲内のメッセージ）を付けて
+登録し、返信が削除されたとき・依存するメッセージが編集・削除されたときにその結果だけを捨てる。
+"""
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
+
+
+def url_expiry(url: str):
+    """URL の ex パラメータから有効期限（UNIX 時刻）を返す（無ければ None）"""
+    try:
+        values = parse_qs(urlparse(url).query).get('ex')
+        return int(values[0], 16) if values else None
+    except (ValueError, TypeError):
+        return None
+
+
+class ResultUrlCache:
+    """
+    Args:
+        max_entries: 保持する結果の数
+        ttl: ex の無い URL を使う秒数
+        margin: 有効期限のこの秒数前からは使わない
+    """
+
+    def __init__(self, max_entries: int = 2000, ttl: float = 6 * 3600, margin: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.margin = margin
+        self._entries = OrderedDict()  # key -> (expires_at, [url], reply_id, 依存するメッセージ ID のタプル)
+        self._by_reply = {}  # 返信のメッセージ ID -> set(key)
+        self._by_message = {}  # 依存するメッセージ ID -> set(key)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, key):
+        """有効な URL のリストを返す（無いか期限切れなら None）"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] - self.margin <= time.time():
+            self.expired += 1
+            self.invalidate(key)
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, urls, reply_id=None, message_ids=()) -> None:
+        """
+        Args:
+            key: 結果のキー
+            urls: 返信の添付ファイルの URL
+            reply_id: 添付ファイルを持つ返信のメッセージ ID（削除されたら URL も使えない）
+            message_ids: 結果の内容が依存するメッセージの ID
+        """
+        urls = [u for u in urls if u]
+        if not urls:
+            return
+        now = time.time()
+        expiries = [url_expiry(u) or now + self.ttl for u in urls]
+        self.invalidate(key)
+        message_ids = tuple(message_ids)
+        self._entries[key] = (min(expiries), urls, reply_id, message_ids)
+        if reply_id is not None:
+            self._by_reply.setdefault(reply_id, set()).add(key)
+        for message_id in message_ids:
+            self._by_message.setdefault(message_id, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self.invalidate(next(iter(self._entries)))
+
+    def invalidate(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, _, reply_id, message_ids = entry
+        _discard(self._by_reply, reply_id, key)
+        for message_id in message_ids:
+            _discard(self._by_message, message_id, key)
+
+    def message_edited(self, message_id) -> None:
+        """message_id の内容に依存する結果を捨てる"""
+        for key in list(self._by_message.get(message_id, ())):
+            self.invalidate(key)
+
+    def message_deleted(self, message_id) -> None:
+        """message_id に依存する結果と、message_id が返信だった結果を捨てる"""
+        self.message_edited(message_id)
+        for key in list(self._by_reply.get(message_id, ())):
+            self.invalidate(key)
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'expired': self.expired}
+
+
+def _discard(index: dict, message_id, key) -> None:
+    keys = index.get(message_id)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del index[message_id]
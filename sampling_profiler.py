@@ -0,0 +1,142 @@
+"""
+実行中のボットのサンプリングプロファイラ
+
+別スレッドから sys._current_frames() で全スレッド（イベントループ・スケジューラのワーカー・
+to_thread のスレッド）のスタックを interval 秒ごとに採取し、collapsed stack 形式
+（"スレッド;モジュール:関数;... 件数"）にまとめる。計測対象のコードに手を入れないので、
+再起動せずに本番で使える。フレームグラフの SVG も外部ツールなしでここで描く。
+
+RENDER_PROCESSES>0 のときの描画ワーカープロセスの中は採取できない（親プロセスでは待機として見える）。
+"""
+import html
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+
+MAX_SECONDS = 120
+_running = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """別のプロファイルを実行中"""
+
+
+def _frame_label(code):
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{code.co_name}"
+
+
+def sample(seconds: float, interval: float = 0.005) -> Counter:
+    """
+    seconds 秒間スタックを採取する（ブロックするのでスレッドから呼ぶ）
+
+    Returns:
+        Counter: collapsed stack 文字列 -> サンプル数
+    """
+    seconds = min(seconds, MAX_SECONDS)
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        me = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                parts = []
+                while frame is not None:
+                    parts.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                parts.append(names.get(ident, f'thread-{ident}'))
+                stacks[';'.join(reversed(parts))] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _running.release()
+
+
+def collapsed(stacks: Counter) -> str:
+    """flamegraph.pl や speedscope に読み込める collapsed stack 形式"""
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def top_frames(stacks: Counter, n: int = 10, skip_idle: bool = True):
+    """サンプル数の多い末端フレーム（self time）の上位 n 件"""
+    leaf = Counter()
+    for stack, count in stacks.items():
+        frame = stack.rsplit(';', 1)[-1]
+        if skip_idle and frame.split(':')[-1] in _IDLE_FUNCTIONS:
+            continue
+        leaf[frame] += count
+    return leaf.most_common(n)
+
+
+# 待機しているだけのフレーム（上位表示から除く）
+_IDLE_FUNCTIONS = {'wait', 'select', 'poll', 'epoll', '_worker', 'sleep', 'acquire', 'get', 'run_forever', '_run_once'}
+
+
+def _build_tree(stacks):
+    root = {'name': 'all', 'value': 0, 'children': {}}
+    for stack, count in stacks.items():
+        node = root
+        node['value'] += count
+        for name in stack.split(';'):
+            node = node['children'].setdefault(name, {'name': name, 'value': 0, 'children': {}})
+            node['value'] += count
+    return root
+
+
+def _color(name):
+    # 名前から決まる暖色（同じ関数は毎回同じ色になる）
+    h = zlib.crc32(name.encode('utf-8'))
+    return f"rgb({205 + h % 50},{(h >> 8) % 180 + 50},{(h >> 16) % 55})"
+
+
+def flamegraph_svg(stacks: Counter, title: str = 'profile', width: int = 1200, row: int = 16) -> str:
+    """collapsed stack からフレームグラフの SVG を作る"""
+    root = _build_tree(stacks)
+    total = root['value'] or 1
+    rects = []
+    max_depth = 0
+
+    def walk(node, x, depth):
+        nonlocal max_depth
+        max_depth = max(max_depth, depth)
+        w = node['value'] / total * width
+        if w < 0.3:
+            return
+        rects.append((x, depth, w, node['name'], node['value']))
+        cx = x
+        for child in sorted(node['children'].values(), key=lambda c: c['name']):
+            walk(child, cx, depth + 1)
+            cx += child['value'] / total * width
+
+    walk(root, 0.0, 0)
+    top = 24
+    height = top + (max_depth + 1) * row + 4
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+        f'<rect width="100%" height="100%" fill="#fafafa"/>',
+        f'<text x="4" y="16" font-size="13">{html.escape(title)}（{total} samples）</text>',
+    ]
+    for x, depth, w, name, value in rects:
+        # 根を下にして積み上げる
+        y = height - (depth + 1) * row - 2
+        label = html.escape(name)
+        pct = value / total * 100
+        out.append(
+            f'<g><title>{label} ({value} samples, {pct:.1f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row - 1}" fill="{_color(name)}"/>'
+        )
+        chars = int(w / 7)
+        if chars >= 3:
+            text = name if len(name) <= chars else name[:chars - 2] + '..'
+            out.append(f'<text x="{x + 2:.1f}" y="{y + row - 4}">{html.escape(text)}</text>')
+        out.append('</g>')
+    out.append('</svg>')
+    return '\n'.join(out)
@@ -1,12 +1,46 @@
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+import os
+import threading
 
-tokenizer = AutoTokenizer.from_pretrained("oshizo/japanese-sexual-moderation-v2")
-model = AutoModelForSequenceClassification.from_pretrained("oshizo/japanese-sexual-moderation-v2")
-classifier = pipeline("text-classification", model=model, tokenizer=tokenizer)
+import metrics
 
-def classify_sexual_content(text: str) -> str:
-    result = classifier(text)[0]
-    score = result["score"]
+model_name = "oshizo/japanese-sexual-moderation-v2"
+
+# パイプラインは初回利用時（またはウォームアップ時）に作る
+classifier = None
+_load_lock = threading.Lock()
+
+def preload():
+    """分類パイプラインを読み込む（読み込み済みなら何もしない）"""
+    global classifier
+    if classifier is not None:
+        return
+    with _load_lock:
+        if classifier is not None:
+            return
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+        # MODEL_LOCAL_ONLY=1 のときはキャッシュ済みの重みだけを使い、ネットワークに接続しない
+        # （.env を読み込んだ後に判断するよう、import 時ではなくここで参照する）
+        local_only = os.getenv('MODEL_LOCAL_ONLY') == '1'
+        tokenizer = AutoTokenizer.from_pretrained(model_name, local_files_only=local_only)
+        model = AutoModelForSequenceClassification.from_pretrained(model_name, local_files_only=local_only)
+        classifier = pipeline("text-classification", model=model, tokenizer=tokenizer)
+
+def sexual_scores_batch(texts, batch_size=None):
+    """
+    複数のテキストの生スコア（pipeline が返す最上位ラベルの確率）をまとめて求める
+
+    Returns:
+        list: テキストごとのスコア（texts と同じ順番）
+    """
+    preload()
+    texts = list(texts)
+    # pipeline はトークナイズと推論を一度に行うので、まとめて forward として記録する
+    with metrics.timed('forward', model='seiteki'):
+        results = classifier(texts, batch_size=batch_size or len(texts))
+    return [r["score"] for r in results]
+
+def score_to_level(score: float) -> int:
+    """生スコアを 0〜4 の段階に変換する"""
     if score <= 0.2:
         return 0
     elif score <= 0.4:
@@ -18,7 +52,11 @@ def classify_sexual_content(text: str) -> str:
     else:
         return 4
 
-# テキストを分類
-text = "チンコ食べたい"
-result = classify_sexual_content(text)
-print(result)  # 0
\ No newline at end of file
+def classify_sexual_content(text: str) -> str:
+    return score_to_level(sexual_scores_batch([text])[0])
+
+if __name__ == '__main__':
+    # テキストを分類
+    text = "チンコ食べたい"
+    result = classify_sexual_content(text)
+    print(result)  # 0
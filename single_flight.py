@@ -0,0 +1,59 @@
+"""
+同じ内容の処理の同時実行をまとめる（single-flight）
+
+話題のメッセージに何人も同時に「きもち」「めいく」と返信したとき、同じ取得・推論・描画を
+人数分行わないよう、キーが同じ処理が実行中ならその結果を待って共有する。
+返信はそれぞれのメッセージに対して行うので、結果の画像は呼び出し側で EncodedImage.copy() して使う。
+"""
+import asyncio
+from collections import defaultdict
+
+
+def edited_marker(message):
+    """キーに含める編集時刻（未編集なら None）"""
+    edited_at = getattr(message, 'edited_at', None)
+    return edited_at.timestamp() if edited_at is not None else None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}  # key -> Future
+        self.leaders = defaultdict(int)
+        self.joined = defaultdict(int)
+
+    async def do(self, key, func):
+        """
+        key が同じ処理が実行中ならその結果を待ち、無ければ func() を実行する
+
+        Args:
+            key: (コマンド名, ...) のタプル。先頭の要素ごとに統計を取る
+            func: 引数なしでコルーチンを返す関数
+
+        例外も実行中だった呼び出し全員に同じものが送られる。
+        処理は最初の呼び出しとは別のタスクで実行するので、どの呼び出しがキャンセルされても
+        （最初の呼び出しでも）処理は止まらず、残りの呼び出しには結果が届く。
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self.joined[key[0]] += 1
+        else:
+            task = asyncio.get_running_loop().create_task(func())
+            self._inflight[key] = task
+            self.leaders[key[0]] += 1
+            task.add_done_callback(lambda t: self._finished(key, t))
+        # 待っている側がキャンセルされても実行中の処理は止めない
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 待っている呼び出しが無くても「取り出されなかった例外」の警告を出さない
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            'inflight': len(self._inflight),
+            'leaders': dict(self.leaders),
+            'joined': dict(self.joined),
+        }
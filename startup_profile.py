@@ -0,0 +1,76 @@
+"""
+起動時間のプロファイル
+
+`python -X importtime -c "import bot"` を別プロセスで実行し、import にかかった時間を
+トップレベルのパッケージごとに集計して表示する。bot.py は import しただけでは
+Discord に接続しないので、ここで測れるのは接続までに必要な準備時間になる。
+
+使い方:
+    python startup_profile.py            # 上位20件
+    python startup_profile.py --top 40
+    python startup_profile.py --module emotion_chart
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+_LINE_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def profile_imports(module: str):
+    """module を import したときの (self_us, cumulative_us, depth, name) のリストを返す"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=repo_dir,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        # import 自体が失敗しても、そこまでの計測結果は表示する
+        tail = proc.stderr.strip().splitlines()[-1:] or ['']
+        print(f"警告: import {module} が失敗しました: {tail[0]}")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if not m:
+            continue
+        self_us, cumulative_us, indent, name = m.groups()
+        # importtime の出力は2文字ずつインデントされる
+        rows.append((int(self_us), int(cumulative_us), len(indent) // 2, name))
+    return rows
+
+
+def summarize(rows, top: int):
+    total_us = sum(r[0] for r in rows)
+    by_package = defaultdict(int)
+    for self_us, _, _, name in rows:
+        by_package[name.split('.')[0]] += self_us
+
+    print(f"import 合計: {total_us / 1000:.1f} ms（{len(rows)} モジュール）")
+    print()
+    print(f"{'パッケージ':<28}{'self合計[ms]':>14}{'割合':>8}")
+    for name, us in sorted(by_package.items(), key=lambda x: x[1], reverse=True)[:top]:
+        share = us / total_us * 100 if total_us else 0
+        print(f"{name:<28}{us / 1000:>14.1f}{share:>7.1f}%")
+
+    print()
+    print(f"{'モジュール（cumulative 上位）':<40}{'cumulative[ms]':>16}")
+    for self_us, cumulative_us, depth, name in sorted(rows, key=lambda r: r[1], reverse=True)[:top]:
+        print(f"{name:<40}{cumulative_us / 1000:>16.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='import 時間のプロファイル')
+    parser.add_argument('--module', default='bot', help='計測するモジュール（既定: bot）')
+    parser.add_argument('--top', type=int, default=20, help='表示する件数')
+    args = parser.parse_args()
+    summarize(profile_imports(args.module), args.top)
+
+
+if __name__ == '__main__':
+    main()
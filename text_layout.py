@@ -0,0 +1,156 @@
+"""
+テキストの折り返し
+
+日本語のように空白のない文章でも折り返せるよう、CJK の文字の前後では文字単位、
+英文などは空白（とハイフンの後ろ）で改行する。句読点や閉じ括弧が行頭に来ないよう、
+開き括弧が行末に残らないよう禁則処理を行う。
+
+文字幅はフォントごとにキャッシュした送り幅（font.getlength）を足し合わせて累積幅を作り、
+各行の改行位置は累積幅と改行候補を二分探索して求める。行ごとに textbbox で測り直さないので、
+全体の計算量は文字数に対してほぼ線形になる。カーニングは考慮しない。
+
+使い方:
+    lines = text_layout.wrap_text(text, font, max_width)
+
+    breaker = text_layout.LineBreaker(text, font)
+    end, next_start = breaker.fit(0, remaining_width, force=False)
+"""
+import bisect
+import unicodedata
+
+# 行頭禁則: 行の先頭に置かない文字
+NO_LINE_START = frozenset(
+    '、。，．・：；？！‼⁇⁈⁉ー～〜‐゠–'
+    'ぁぃぅぇぉっゃゅょゎゕゖァィゥェォッャュョヮヵヶㇰㇱㇲㇳㇴㇵㇶㇷㇸㇹㇺㇻㇼㇽㇾㇿ々〻ゝゞヽヾ'
+    ')]}）］｝〕〉》」』】〙〗〟’”｠»'
+    ',.:;?!%'
+)
+
+# 行末禁則: 行の末尾に置かない文字
+NO_LINE_END = frozenset('([{（［｛〔〈《「『【〘〖〝‘“｟«')
+
+
+def _is_wide(ch: str) -> bool:
+    # 全角・東アジアの文字（絵文字の多くも含む）は前後どちらでも改行できる
+    return unicodedata.east_asian_width(ch) in ('W', 'F')
+
+
+def char_advance(font, ch: str) -> float:
+    """1文字の送り幅（フォントごとにキャッシュする）"""
+    cache = getattr(font, '_advance_cache', None)
+    if cache is None:
+        cache = font._advance_cache = {}
+    advance = cache.get(ch)
+    if advance is None:
+        advance = cache[ch] = font.getlength(ch)
+    return advance
+
+
+def text_width(text: str, font) -> float:
+    """キャッシュした送り幅の合計で text の幅を求める"""
+    return sum(char_advance(font, ch) for ch in text)
+
+
+class LineBreaker:
+    """
+    1段落分の文字列の累積幅と改行候補を持ち、指定幅に収まる改行位置を求める
+
+    Args:
+        text: 改行を含まない文字列
+        font: ImageFont（getlength を持つもの）
+    """
+
+    def __init__(self, text: str, font):
+        self.text = text
+        cumulative = [0.0]
+        total = 0.0
+        for ch in text:
+            total += char_advance(font, ch)
+            cumulative.append(total)
+        self.cumulative = cumulative
+        self.breaks = self._break_positions(text)
+
+    @staticmethod
+    def _break_positions(text: str) -> list:
+        # 位置 i で改行できる = text[:i] を行末にできる。空白で改行した場合、空白は次の行に持ち越さない
+        positions = []
+        for i in range(1, len(text)):
+            prev, ch = text[i - 1], text[i]
+            if ch.isspace():
+                if not prev.isspace():
+                    positions.append(i)
+            elif prev.isspace():
+                continue
+            elif prev == '-' and i >= 2 and text[i - 2].isalnum() and ch.isalnum():
+                positions.append(i)
+            elif (_is_wide(prev) or _is_wide(ch)) and ch not in NO_LINE_START and prev not in NO_LINE_END:
+                positions.append(i)
+        positions.append(len(text))
+        return positions
+
+    def width(self, start: int, end: int) -> float:
+        return self.cumulative[end] - self.cumulative[start]
+
+    def skip_spaces(self, pos: int) -> int:
+        text = self.text
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        return pos
+
+    def fit(self, start: int, max_width: float, force: bool = True):
+        """
+        start から始まる行を max_width に収まるところで切る
+
+        Args:
+            start: 行の開始位置
+            max_width: 行に使える幅
+            force: 改行候補が1つも収まらないときに、文字単位で切ってでも進めるか
+
+        Returns:
+            (end, next_start): 行は text[start:end]、次の行は next_start から。
+            force=False で何も収まらない場合は end == start になる
+        """
+        # 収まる最長の位置（累積幅は単調増加なので二分探索できる）
+        limit = bisect.bisect_right(self.cumulative, self.cumulative[start] + max_width, lo=start) - 1
+        index = bisect.bisect_right(self.breaks, limit) - 1
+        if index >= 0 and self.breaks[index] > start:
+            end = self.breaks[index]
+        elif not force:
+            return start, self.skip_spaces(start)
+        else:
+            # 1語が行幅より長い場合は収まるところで切る（最低1文字は進める）
+            end = max(limit, start + 1)
+        return end, self.skip_spaces(end)
+
+    def lines(self, max_width: float) -> list:
+        """段落を max_width ごとの行に分割する"""
+        text = self.text
+        result = []
+        start = self.skip_spaces(0)
+        while start < len(text):
+            end, next_start = self.fit(start, max_width)
+            result.append(text[start:end])
+            start = next_start
+        return result
+
+
+def wrap_text(text: str, font, max_width: float) -> list:
+    """
+    text を max_width に収まる行のリストにする（改行文字は段落の区切りとして扱う）
+
+    Args:
+        text: 折り返す文字列
+        font: 幅を測るフォント
+        max_width: 1行の最大幅（ピクセル）
+
+    Returns:
+        list of str: 行のリスト（空白だけのテキストなら空リスト）
+    """
+    if not text.strip():
+        return []
+    lines = []
+    for paragraph in text.split('\n'):
+        # 段落末尾の空白は最後の行に残って中央寄せの幅に入るので、折り返す前に除く
+        # （LineBreaker 自体はトークンの間の空白を保つため末尾の空白も行に含める）
+        lines.extend(LineBreaker(paragraph.rstrip(), font).lines(max_width) or [''])
+    return lines
@@ -0,0 +1,79 @@
+"""
+魚拓の描画済みメッセージタイルのキャッシュ
+
+メッセージ1件分の描画結果（PIL.Image）を (message_id, edited_at, 幅, テーマ, 作者状態ハッシュ) を
+キーにして保持する。同じ会話で「魚拓3」「魚拓5」「魚拓2-6」と続けても、新しいメッセージや
+編集されたメッセージだけを描画し、残りはキャッシュしたタイルを積むだけになる。
+
+作者状態ハッシュには表示名・ロール色・アバターとバッジのアセットキー・サーバータグを含めるので、
+どれかが変わればタイルも描き直される。
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 現状の Discord 風描画はダークテーマのみ
+DEFAULT_THEME = 'dark'
+
+
+def author_state(author_name, role_color=None, avatar_key=None, tag=None, badge_key=None) -> str:
+    """タイルの見た目に影響する作者側の情報をまとめたハッシュ"""
+    raw = '\x1f'.join(str(v) if v is not None else '' for v in (author_name, role_color, avatar_key, tag, badge_key))
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def tile_key(message_id, edited_at, width, theme=DEFAULT_THEME, author_hash=''):
+    edited = edited_at.timestamp() if edited_at is not None else None
+    return (message_id, edited, width, theme, author_hash)
+
+
+class TileCache:
+    """
+    タイル画像の LRU キャッシュ（画素数ベースで max_bytes まで）
+
+    格納した画像は変更しない前提で共有する（貼り付け元として読むだけ）。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._tiles = OrderedDict()  # key -> Image
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _size(img) -> int:
+        return img.width * img.height * len(img.getbands())
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            img = self._tiles.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return img
+
+    def put(self, key, img) -> None:
+        if key is None:
+            return
+        size = self._size(img)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self._bytes -= self._size(old)
+            self._tiles[key] = img
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._tiles:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= self._size(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._tiles), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}